@@ -0,0 +1,797 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# checkEngine.py checks many streaming radio urls at the same time.
+#
+# m3uCheck.py used to open one url at a time with no timeout, so a
+# directory of a few hundred m3u files took hours and one hung host
+# stalled the whole run. The engine runs the probes with asyncio:
+#
+#    concurrency   maximum number of probes running at once
+#    perHost       maximum number of probes running against one host
+#    timeout       seconds a single probe may take, including redirects
+#
+# The work is grouped by host, perHost workers take the streams of a
+# host one after the other. The probes of a host share one DNS lookup
+# (DNSCache) and all probes one TLS context. The sockets themselves
+# cannot be used again: a stream never ends, so every probe hangs up once
+# it has seen the audio.
+#
+# The hosts of a site share a domain, like ieig-fl.akacast.akamaistream.net
+# and itur-fl.akacast.akamaistream.net, and usually go down together. A
+# CircuitBreaker stops probing a site after tripAfter probes in a row
+# could not reach it: the connection was refused or timed out. A host
+# name that is not found, or a TLS error, is the trouble of that host
+# only and does not count. The streams of that site still waiting get a
+# provisional unreachable result without being probed, so a dead CDN
+# costs about one timeout instead of one timeout per stream. With
+# confirm, one more stream of the site is probed first and the breaker
+# closes again if it answers.
+#
+# A probe sends a GET for the stream and follows redirects and playlists
+# (.pls, .m3u) to the audio. A 2xx status is not enough: error pages,
+# captive portals and servers that send nothing answer 200 as well. The
+# probe reads at most probeBytes of the body and looks for audio in it
+# (sniffAudio), then hangs up. The result is one of the states
+# m3uCheck.py writes to the first line of the m3u file:
+#
+#    good            the stream sends MP3, AAC (ADTS) or Ogg frames, or
+#                    is an HLS playlist
+#    no audio        the stream answered with a 2xx status but what it
+#                    sent is not audio (an html page, nothing at all)
+#    unreachable     the host could not be reached or did not answer in time
+#    failed request  the host answered with an error status
+#    slow            like good, but the audio came later than the
+#                    deadline the probe was first given (see below)
+#
+# A good result also has the codec, the bitrate in kbit/s (0 if unknown)
+# and firstByte, the seconds until the first byte of the stream arrived.
+# connect is the seconds until the connection was open.
+#
+# A LatencyTracker keeps the connect and first byte times of the last
+# probes of every host and of all hosts. With one, a probe is not given
+# the whole timeout but a deadline from those times:
+#
+#    connect      deadlineFactor times the 95th percentile connect time
+#    first byte   deadlineFactor times the 95th percentile first byte time
+#
+# never less than minDeadline and never more than timeout. The times of
+# the host are used once it has minSamples probes, the times of all hosts
+# before. A probe that ran out of time counts with the time it waited,
+# a lower bound of its real time: left out, the hosts that hang would
+# make the percentiles too low. A probe that misses a deadline shorter
+# than timeout is not called dead: it is probed again with the whole
+# timeout once the other streams are done.
+# If it answers then it is slow, if not it is unreachable. Of the streams
+# of one site that missed their deadline, the first is probed again on
+# its own. When it does not answer in the whole timeout either, the
+# others are unreachable without waiting for them again. A dead host
+# holds a probe slot for about a deadline instead of the whole timeout,
+# and a station far away still has the whole timeout to answer.
+#
+# sniffAudio finds the candidates with bytes.find, which runs in C, and
+# only decodes the frame headers it lands on. A frame counts when the
+# next frame header follows it where its length says, so a stray 0xff in
+# a page of text is not taken for audio.
+#
+#########################
+
+import asyncio
+import collections
+import socket
+import ssl
+import struct
+import time
+import urllib.parse
+
+resultGood = "good"
+resultUnreachable = "unreachable"
+resultFailed = "failed request"
+resultNoAudio = "no audio"
+resultSlow = "slow"
+
+defaultConcurrency = 32
+defaultPerHost = 4
+defaultTimeout = 15.0
+maxRedirects = 5
+defaultTripAfter = 3
+deadlineFactor = 3.0
+minDeadline = 1.0
+minSamples = 10
+# probe times kept per host and for all hosts
+hostSamples = 100
+allSamples = 1000
+dnsTtl = 300.0
+maxPlaylists = 3
+probeBytes = 16 * 1024
+# read in pieces, most streams show their audio in the first one
+probeRead = 4096
+
+redirectStatus = (301, 302, 303, 307, 308)
+playlistTypes = ("audio/x-mpegurl", "audio/mpegurl", "audio/x-scpls", "application/pls+xml",
+                 "application/x-mpegurl", "text/plain")
+# an HLS playlist is the stream itself, mpd plays it
+hlsMarker = "#EXT-X-"
+
+# kbit/s by (mpeg version, layer), version 3 is MPEG 1, layer 3 is layer I
+mpegBitrates = {
+    (3, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (3, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (3, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# by mpeg version: 0 is MPEG 2.5, 2 is MPEG 2
+mpegRates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+adtsRates = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+userAgent = "m3uCheck/1.0"
+
+# created once, building a TLS context reads the system certificates
+tlsContext = None
+
+
+class ProbeResult:
+    __slots__ = ("url", "result", "reason", "status", "seconds", "codec", "bitrate", "firstByte", "bytesRead",
+                 "provisional", "connect", "timedOut", "refused", "deadline")
+
+    def __init__(self, url, result, reason="", status=0, seconds=0.0):
+        self.url = url
+        self.result = result
+        self.reason = reason
+        self.status = status
+        self.seconds = seconds
+        self.codec = ""
+        self.bitrate = 0
+        self.firstByte = 0.0
+        self.bytesRead = 0
+        # not probed, the circuit breaker of the site was open
+        self.provisional = False
+        self.connect = 0.0
+        # the probe ran out of time, it did not fail, deadline is the
+        # seconds it had
+        self.timedOut = False
+        self.deadline = 0.0
+        # the host refused the connection
+        self.refused = False
+
+
+class ProbeError(Exception):
+    pass
+
+
+# A connection did not open in time
+class ProbeTimeout(Exception):
+    pass
+
+
+def hostOf(url):
+    try:
+        return (urllib.parse.urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+# The domain of the host, three labels for names like bbc.co.uk. An
+# address is its own site
+def siteOf(url):
+    host = hostOf(url)
+    labels = host.split(".")
+    if len(labels) <= 2 or labels[-1].isdigit() or ":" in host:
+        return host
+    if len(labels[-1]) == 2 and len(labels[-2]) <= 3:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+def sslContext():
+    global tlsContext
+    if tlsContext is None:
+        tlsContext = ssl.create_default_context()
+    return tlsContext
+
+
+class DNSCache:
+
+    # Keeps the address of every host name for ttl seconds. Probes of the
+    # same host that start together wait for one lookup
+    def __init__(self, ttl=dnsTtl):
+        self.ttl = ttl
+        self.addresses = {}
+        self.pending = {}
+        self.lookups = 0
+
+    async def lookup(self, host, port):
+        e = self.addresses.get(host)
+        now = time.monotonic()
+        if e is not None and e[1] > now:
+            return e[0]
+        f = self.pending.get(host)
+        if f is None:
+            f = self.pending[host] = asyncio.ensure_future(self.resolve(host, port))
+        try:
+            return await asyncio.shield(f)
+        finally:
+            if f.done() and self.pending.get(host) is f:
+                del self.pending[host]
+
+    async def resolve(self, host, port):
+        self.lookups += 1
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        if not infos:
+            raise ProbeError("no address for " + host)
+        address = infos[0][4][0]
+        self.addresses[host] = (address, time.monotonic() + self.ttl)
+        return address
+
+
+# Send a GET for url. dns, if given, turns the host name into an address
+# (see DNSCache). icyMeta asks for ICY metadata in the
+# stream (see streamMeta.py)
+async def openStream(url, dns=None, icyMeta=False):
+    u = urllib.parse.urlsplit(url)
+    if u.scheme not in ("http", "https"):
+        raise ProbeError("unsupported scheme: " + u.scheme)
+    if not u.hostname:
+        raise ProbeError("no host in url")
+
+    port = u.port or (443 if u.scheme == "https" else 80)
+    context = None
+    if u.scheme == "https":
+        context = sslContext()
+    if dns is None:
+        reader, writer = await asyncio.open_connection(u.hostname, port, ssl=context)
+    else:
+        address = await dns.lookup(u.hostname, port)
+        reader, writer = await asyncio.open_connection(
+            address, port, ssl=context, server_hostname=u.hostname if context else None)
+
+    path = u.path or "/"
+    if u.query:
+        path += "?" + u.query
+    host = u.hostname
+    if u.port:
+        host += ":" + str(u.port)
+    request = ("GET " + path + " HTTP/1.0\r\n"
+               "Host: " + host + "\r\n"
+               "User-Agent: " + userAgent + "\r\n"
+               "Accept: */*\r\n"
+               "Icy-MetaData: " + ("1" if icyMeta else "0") + "\r\n"
+               "Connection: close\r\n\r\n")
+    writer.write(request.encode("latin-1"))
+    await writer.drain()
+    return reader, writer
+
+
+# Read the status line and headers, shoutcast servers answer "ICY 200 OK"
+async def readHead(reader):
+    line = await reader.readline()
+    if not line:
+        raise ProbeError("connection closed before status line")
+    parts = line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ProbeError("bad status line: " + line.decode("latin-1").strip())
+    status = int(parts[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line or line in (b"\r\n", b"\n"):
+            break
+        k, sep, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return status, headers, reader
+
+
+def closeWriter(writer):
+    try:
+        writer.close()
+    except Exception:
+        pass
+
+
+#########################
+# audio sniffing
+
+# (codec, kbit/s, frame length) of an MPEG audio frame header at i, None
+# if there is none
+def mpegFrame(data, i):
+    b1 = data[i + 1]
+    b2 = data[i + 2]
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    index = b2 >> 4
+    rate = (b2 >> 2) & 3
+    if b1 & 0xe0 != 0xe0 or version == 1 or layer == 0 or index in (0, 15) or rate == 3:
+        return None
+    kbit = mpegBitrates[(3 if version == 3 else 2, layer)][index]
+    hz = mpegRates[version][rate]
+    padding = (b2 >> 1) & 1
+    if layer == 3:
+        length = (12000 * kbit // hz + padding) * 4
+    elif layer == 1 and version != 3:
+        length = 72000 * kbit // hz + padding
+    else:
+        length = 144000 * kbit // hz + padding
+    return ("mp" + str(4 - layer), kbit, length)
+
+# (codec, kbit/s, frame length) of an ADTS (AAC) frame header at i
+def adtsFrame(data, i):
+    if data[i + 1] & 0xf6 != 0xf0 or i + 7 > len(data):
+        return None
+    rate = (data[i + 2] >> 2) & 15
+    length = ((data[i + 3] & 3) << 11) | (data[i + 4] << 3) | (data[i + 5] >> 5)
+    if rate >= len(adtsRates) or length < 7:
+        return None
+    # a frame holds 1024 samples
+    return ("aac", length * 8 * adtsRates[rate] // 1024000, length)
+
+# An Ogg page at i, the codec is read from the first packet
+def oggPage(data, i):
+    if i + 28 > len(data) or data[i + 4] != 0:
+        return None
+    packet = i + 27 + data[i + 26]
+    head = bytes(data[packet:packet + 8])
+    if head.startswith(b"\x01vorbis"):
+        kbit = 0
+        if packet + 24 <= len(data):
+            kbit = max(0, struct.unpack_from("<i", data, packet + 20)[0]) // 1000
+        return ("vorbis", kbit)
+    if head.startswith(b"OpusHead"):
+        return ("opus", 0)
+    if head.startswith(b"\x7fFLAC"):
+        return ("flac", 0)
+    return ("ogg", 0)
+
+# Look for audio in the first bytes of a stream. Returns (codec, kbit/s)
+# or None. The bitrate is 0 when the stream does not say
+def sniffAudio(data):
+    if data.lstrip()[:7] == b"#EXTM3U" and hlsMarker.encode("latin-1") in data:
+        return ("hls", 0)
+    i = data.find(b"OggS")
+    if i >= 0:
+        found = oggPage(data, i)
+        if found is not None:
+            return found
+    n = len(data)
+    i = data.find(b"\xff")
+    while 0 <= i and i + 4 <= n:
+        frame = mpegFrame(data, i) or adtsFrame(data, i)
+        if frame is not None:
+            codec, kbit, length = frame
+            j = i + length
+            if j + 4 > n:
+                # the next frame is not read yet, nothing later can be checked
+                return None
+            if data[j] == 0xff and data[j + 1] & 0xfe == data[i + 1] & 0xfe:
+                return (codec, kbit)
+        i = data.find(b"\xff", i + 1)
+    return None
+
+
+#########################
+# playlists
+
+# First stream url of an m3u or pls playlist, None if there is none
+def playlistStream(text):
+    for line in text.splitlines():
+        line = line.strip()
+        if line.lower().startswith("file") and "=" in line:
+            line = line.partition("=")[2].strip()
+        elif line.startswith("#") or line.startswith("["):
+            continue
+        if "://" in line:
+            return line
+    return None
+
+def isPlaylist(url, headers):
+    contentType = headers.get("content-type", "").split(";")[0].strip().lower()
+    if contentType in playlistTypes:
+        return True
+    path = urllib.parse.urlsplit(url).path.lower()
+    if path.endswith(".m3u") or path.endswith(".pls"):
+        return not contentType.startswith("audio/") and not contentType.startswith("application/ogg")
+    return False
+
+
+#########################
+# probes
+
+# Read up to limit bytes of the body, stopping as soon as there is audio.
+# Returns (data, audio or None, seconds from started to the first byte)
+async def readAudio(reader, limit, started):
+    data = bytearray()
+    first = 0.0
+    while len(data) < limit:
+        b = await reader.read(min(probeRead, limit - len(data)))
+        if not b:
+            break
+        if not data:
+            first = time.monotonic() - started
+        data += b
+        found = sniffAudio(data)
+        if found is not None:
+            return data, found, first
+    return data, None, first
+
+def headerBitrate(headers):
+    try:
+        return int(headers.get("icy-br", "0").split(",")[0])
+    except ValueError:
+        return 0
+
+# Follow redirects and playlists to the stream and look for audio in it.
+# times, if given, gets the connect time as soon as it is known
+async def fetchAudio(url, started, dns=None, connectTimeout=None, times=None):
+    redirects = playlists = 0
+    connect = 0.0
+    while True:
+        try:
+            reader, writer = await asyncio.wait_for(openStream(url, dns), connectTimeout)
+        except asyncio.TimeoutError:
+            raise ProbeTimeout("no connection in %.1fs" % connectTimeout)
+        if not connect:
+            connect = time.monotonic() - started
+            if times is not None:
+                times["connect"] = connect
+        try:
+            status, headers, reader = await readHead(reader)
+            if status in redirectStatus and "location" in headers:
+                redirects += 1
+                if redirects > maxRedirects:
+                    raise ProbeError("too many redirects")
+                url = urllib.parse.urljoin(url, headers["location"])
+                continue
+            if not 200 <= status < 300:
+                r = ProbeResult(url, resultFailed, "HTTP " + str(status), status)
+                r.connect = connect
+                return r
+            data, found, first = await readAudio(reader, probeBytes, started)
+        finally:
+            closeWriter(writer)
+
+        if found is None and isPlaylist(url, headers):
+            nextUrl = playlistStream(data.decode("utf-8", "replace"))
+            if nextUrl is not None and playlists < maxPlaylists:
+                playlists += 1
+                url = urllib.parse.urljoin(url, nextUrl)
+                continue
+        if found is None:
+            contentType = headers.get("content-type", "no content type").split(";")[0].strip()
+            if data:
+                reason = contentType + ", no audio in " + str(len(data)) + " bytes"
+            else:
+                reason = contentType + ", empty body"
+            r = ProbeResult(url, resultNoAudio, reason, status)
+        else:
+            r = ProbeResult(url, resultGood, "HTTP " + str(status), status)
+            r.codec = found[0]
+            r.bitrate = found[1] or headerBitrate(headers)
+        r.connect = connect
+        r.firstByte = first
+        r.bytesRead = len(data)
+        return r
+
+# connectTimeout, if given, is the time each connection may take to open
+async def probe(url, timeout=defaultTimeout, dns=None, connectTimeout=None):
+    t = time.monotonic()
+    times = {}
+    try:
+        r = await asyncio.wait_for(fetchAudio(url, t, dns, connectTimeout, times), timeout)
+    except asyncio.TimeoutError:
+        r = ProbeResult(url, resultUnreachable, "timed out after %.1fs" % timeout, 0, time.monotonic() - t)
+        r.timedOut = True
+        r.deadline = timeout
+        r.connect = times.get("connect", 0.0)
+        return r
+    except ProbeTimeout as ex:
+        r = ProbeResult(url, resultUnreachable, str(ex), 0, time.monotonic() - t)
+        r.timedOut = True
+        r.deadline = connectTimeout
+        r.connect = times.get("connect", 0.0)
+        return r
+    except (OSError, ProbeError, ssl.SSLError, ValueError) as ex:
+        r = ProbeResult(url, resultUnreachable, str(ex) or type(ex).__name__, 0, time.monotonic() - t)
+        r.refused = isinstance(ex, ConnectionRefusedError)
+        return r
+
+    # the url asked for, not the one the audio came from
+    r.url = url
+    r.seconds = time.monotonic() - t
+    return r
+
+
+# The last probe times of one host, or of all hosts
+class LatencySamples:
+
+    # the percentiles are worked out again every resort probes, once
+    # there are that many
+    def __init__(self, size, resort=1):
+        self.connect = collections.deque(maxlen=size)
+        self.firstByte = collections.deque(maxlen=size)
+        self.resort = resort
+        self.added = 0
+        self.sorted = None
+
+    # firstByte is 0 when the probe found no audio
+    def add(self, connect, firstByte):
+        self.connect.append(connect)
+        if firstByte:
+            self.firstByte.append(firstByte)
+        self.added += 1
+        if self.added >= self.resort or len(self.connect) < self.resort:
+            self.added = 0
+            self.sorted = None
+
+    # (95th percentile connect, 95th percentile first byte) in seconds
+    def p95(self):
+        if self.sorted is None:
+            self.sorted = (percentile95(self.connect), percentile95(self.firstByte))
+        return self.sorted
+
+def percentile95(samples):
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * 0.95))]
+
+
+class LatencyTracker:
+
+    def __init__(self, factor=deadlineFactor, floor=minDeadline, samples=minSamples):
+        self.factor = factor
+        self.floor = floor
+        self.minSamples = samples
+        self.hosts = {}
+        self.all = LatencySamples(allSamples, 50)
+        self.slow = 0
+        self.retried = 0
+
+    # Keep the times of a probe that reached the host or ran out of time.
+    # What did not come in time took at least the time waited for it
+    def observe(self, host, r):
+        if r.timedOut:
+            connect = r.connect or r.seconds
+            firstByte = r.seconds
+        elif r.result == resultUnreachable or not r.connect:
+            return
+        else:
+            connect = r.connect
+            firstByte = r.firstByte
+        h = self.hosts.get(host)
+        if h is None:
+            h = self.hosts[host] = LatencySamples(hostSamples)
+        h.add(connect, firstByte)
+        self.all.add(connect, firstByte)
+
+    def samplesFor(self, host):
+        h = self.hosts.get(host)
+        if h is not None and len(h.connect) >= self.minSamples:
+            return h
+        if len(self.all.connect) >= self.minSamples:
+            return self.all
+        return None
+
+    # (connect deadline, whole probe deadline) for a probe of host, in
+    # seconds, never more than timeout
+    def deadlines(self, host, timeout):
+        h = self.samplesFor(host)
+        if h is None:
+            return timeout, timeout
+        connect, firstByte = h.p95()
+        c = min(timeout, max(self.floor, self.factor * connect))
+        return c, min(timeout, max(self.floor, c, self.factor * firstByte))
+
+    def report(self):
+        connect, firstByte = self.all.p95()
+        return ["probe times of %d hosts: connect p95 %.0f ms, first byte p95 %.0f ms" %
+                (len(self.hosts), connect * 1000, firstByte * 1000),
+                "   %d probes missed their deadline and were probed again, %d of them are slow" %
+                (self.retried, self.slow)]
+
+
+class CircuitBreaker:
+
+    def __init__(self, tripAfter=defaultTripAfter, confirm=False):
+        self.tripAfter = tripAfter
+        self.confirm = confirm
+        # site: unreachable probes in a row
+        self.failures = {}
+        self.tripped = set()
+        # site: event set when its confirmation probe is done
+        self.confirming = {}
+        # sites whose confirmation probe failed too
+        self.dead = set()
+        self.trips = 0
+        self.skipped = 0
+
+    def allow(self, site):
+        return site not in self.tripped
+
+    def record(self, site, r):
+        if r.result != resultUnreachable:
+            # the site answered, even an error status shows it is up
+            self.failures[site] = 0
+            self.tripped.discard(site)
+            return
+        if not r.timedOut and not r.refused:
+            # a host name not found says nothing about the other hosts
+            return
+        n = self.failures.get(site, 0) + 1
+        self.failures[site] = n
+        if n >= self.tripAfter and site not in self.tripped:
+            self.tripped.add(site)
+            self.trips += 1
+
+    # The result of url while the breaker of its site is open. check()
+    # probes it, which is done once per trip with confirm. None when
+    # check() gives None (the run is out of time)
+    async def whileOpen(self, site, url, check):
+        e = self.confirming.get(site)
+        if e is not None:
+            await e.wait()
+            if self.allow(site):
+                return await check()
+        elif self.confirm and site not in self.dead:
+            e = self.confirming[site] = asyncio.Event()
+            try:
+                r = await check()
+            finally:
+                del self.confirming[site]
+                e.set()
+            if r is not None and not self.allow(site):
+                self.dead.add(site)
+            return r
+        self.skipped += 1
+        r = ProbeResult(url, resultUnreachable, "not probed, " + site + " failed " +
+                        str(self.failures.get(site, 0)) + " times in a row")
+        r.provisional = True
+        return r
+
+
+class Progress:
+
+    def __init__(self, total, interval=1.0, out=print):
+        self.total = total
+        self.done = 0
+        self.counts = {}
+        self.provisional = 0
+        self.interval = interval
+        self.out = out
+        self.started = time.monotonic()
+        self.lastReport = 0.0
+
+    def update(self, r):
+        self.done += 1
+        self.counts[r.result] = self.counts.get(r.result, 0) + 1
+        if r.provisional:
+            self.provisional += 1
+        now = time.monotonic()
+        if self.out is not None and (now - self.lastReport >= self.interval or self.done == self.total):
+            self.lastReport = now
+            self.out(self.line())
+
+    def line(self):
+        s = "checked " + str(self.done) + "/" + str(self.total)
+        for k in (resultGood, resultSlow, resultNoAudio, resultUnreachable, resultFailed):
+            s += ", " + k + " " + str(self.counts.get(k, 0))
+        if self.provisional:
+            s += " (" + str(self.provisional) + " not probed)"
+        s += " (%.1fs)" % (time.monotonic() - self.started)
+        return s
+
+
+# Check all urls and call done(index, result) as each probe finishes.
+# Returns the results in the same order as urls. The urls are grouped by
+# host, perHost workers take the urls of a host one after the other. No
+# probe starts after deadline (a time.monotonic() time), the urls left
+# have None as their result. With latency (a LatencyTracker) the probes
+# get deadlines from the probe times, the ones that miss it are probed
+# again with the whole timeout at the end
+async def checkAll(urls, concurrency=defaultConcurrency, perHost=defaultPerHost,
+                   timeout=defaultTimeout, done=None, progress=None, breaker=None, dns=None,
+                   deadline=None, latency=None):
+    results = [None] * len(urls)
+    limit = asyncio.Semaphore(max(1, concurrency))
+    if dns is None:
+        dns = DNSCache()
+    # index: the deadline it missed
+    missed = {}
+    # site: future, True once the first stream of the site probed again
+    # answered (or could not be probed)
+    canaries = {}
+
+    def late():
+        return deadline is not None and time.monotonic() >= deadline
+
+    async def check(site, i, confirming=False, retry=False):
+        if not retry:
+            return await probeOne(site, i, confirming, retry)
+        f = canaries.get(site)
+        if f is not None:
+            if not await f:
+                r = ProbeResult(urls[i], resultUnreachable, "missed its deadline of %.1fs, and %s did "
+                                "not answer in %.1fs either" % (missed[i], site, timeout))
+                r.timedOut = True
+                return r
+            return await probeOne(site, i, confirming, retry)
+        f = canaries[site] = asyncio.get_running_loop().create_future()
+        r = None
+        try:
+            r = await probeOne(site, i, confirming, retry)
+        finally:
+            f.set_result(r is None or not r.timedOut)
+        return r
+
+    async def probeOne(site, i, confirming, retry):
+        async with limit:
+            if late():
+                return None
+            if breaker is not None and not confirming and not breaker.allow(site):
+                # tripped while this one waited for its turn
+                return None
+            host = hostOf(urls[i])
+            if latency is None or retry:
+                r = await probe(urls[i], timeout, dns)
+            else:
+                connectTimeout, probeTimeout = latency.deadlines(host, timeout)
+                r = await probe(urls[i], probeTimeout, dns, connectTimeout)
+                if r.timedOut and r.deadline < timeout:
+                    # maybe only slow, decided at the end
+                    missed[i] = probeTimeout
+                    latency.observe(host, r)
+                    return r
+            if latency is not None:
+                latency.observe(host, r)
+        if breaker is not None:
+            breaker.record(site, r)
+        if retry and r.result == resultGood and r.seconds > missed[i]:
+            r.result = resultSlow
+            r.reason = "audio after %.1fs, the deadline was %.1fs" % (r.seconds, missed[i])
+            latency.slow += 1
+        return r
+
+    async def worker(site, queue, retry):
+        while queue and not late():
+            i = queue.popleft()
+            r = None
+            if breaker is None or breaker.allow(site):
+                r = await check(site, i, False, retry)
+            if r is None and not late():
+                r = await breaker.whileOpen(site, urls[i], lambda: check(site, i, True, retry))
+            if r is None:
+                # out of time
+                break
+            if i in missed and not retry:
+                continue
+            results[i] = r
+            if progress is not None:
+                progress.update(r)
+            if done is not None:
+                done(i, r)
+
+    async def run(indices, retry):
+        hosts = collections.OrderedDict()
+        for i in indices:
+            hosts.setdefault(hostOf(urls[i]), collections.deque()).append(i)
+        workers = []
+        for host, queue in hosts.items():
+            # the breaker and the canaries are per site
+            site = siteOf(urls[queue[0]])
+            for n in range(min(max(1, perHost), len(queue))):
+                workers.append(worker(site, queue, retry))
+        await asyncio.gather(*workers)
+
+    await run(range(len(urls)), False)
+    if missed:
+        latency.retried += len(missed)
+        await run(sorted(missed), True)
+    return results
+
+
+def checkUrls(urls, concurrency=defaultConcurrency, perHost=defaultPerHost,
+              timeout=defaultTimeout, done=None, progress=None, breaker=None, dns=None,
+              deadline=None, latency=None):
+    return asyncio.run(checkAll(urls, concurrency, perHost, timeout, done, progress, breaker, dns,
+                                deadline, latency))
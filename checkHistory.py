@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# checkHistory.py remembers when every m3u file was checked and what the
+# check found, so m3uCheck.py can check again what is due instead of
+# skipping a checked file forever. A good station that dies is found,
+# and an unreachable one that comes back is too.
+#
+# The history is a json file (/home/pi/Stations/m3uCheck.history) with
+# one entry per m3u file:
+#
+#    {"stream": "http://...", "checked": 1760000000.0, "result": "good",
+#     "streak": 0, "seconds": 0.41, "bytes": 4096}
+#
+# streak is the number of failed checks in a row. An entry is due:
+#
+#    never checked, or the stream changed   at once
+#    good or slow                           goodAge after its check
+#    anything else                          failAge after its check,
+#                                           doubled for every failure in
+#                                           a row, up to maxBackoff
+#
+# plan picks the files to check in one run: the due ones, never checked
+# first and then the longest overdue, until the bytes the probes are
+# expected to read reach the budget. A station that has been dead for a
+# month is then tried about once a month, and a nightly run checks a
+# small part of the catalog.
+#
+# Files checked before there was a history are taken in with the state
+# in their first line and the time the file was last written (seed).
+#
+# CheckJournal makes a run safe to kill. The history is only saved at the
+# end of a run, so every result is also appended to m3uCheck.journal as
+# soon as its probe finishes, one json line each:
+#
+#    {"started": 1760000000.0, "files": ["a.m3u", "b.m3u", ...]}
+#    {"file": "a.m3u", "stream": "http://...", "result": "good", ...}
+#
+# The lines reach the disk at least every syncInterval seconds. A run
+# that finishes removes the journal. A journal that is still there is
+# from a run that died: its results are put into the history before
+# anything else (recover), and m3uCheck.py --resume checks only the
+# files of that run it did not get to (unfinished). A line cut short by
+# the crash is ignored, its file is checked again.
+#
+#########################
+
+import json
+import os
+import time
+
+defaultGoodAge = 7 * 86400.0
+defaultFailAge = 86400.0
+defaultMaxBackoff = 30 * 86400.0
+# bytes a probe is expected to read when the history does not know
+defaultProbeBytes = 16 * 1024
+defaultSyncInterval = 1.0
+
+goodStates = ("good", "slow", "use", "shelf")
+
+
+def historyFileName(directory):
+    return os.path.join(directory, "m3uCheck.history")
+
+def journalFileName(directory):
+    return os.path.join(directory, "m3uCheck.journal")
+
+
+class CheckHistory:
+
+    def __init__(self, fileName=None, goodAge=defaultGoodAge, failAge=defaultFailAge,
+                 maxBackoff=defaultMaxBackoff):
+        self.fileName = fileName
+        self.goodAge = goodAge
+        self.failAge = failAge
+        self.maxBackoff = maxBackoff
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        if self.fileName is None:
+            return
+        try:
+            f = open(self.fileName, 'r')
+            data = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict):
+            for k, v in data.items():
+                if isinstance(v, dict) and "checked" in v:
+                    self.entries[k] = v
+
+    def save(self):
+        if self.fileName is None or not self.dirty:
+            return
+        tmp = self.fileName + ".tmp"
+        f = open(tmp, 'w')
+        json.dump(self.entries, f, sort_keys=True)
+        f.close()
+        os.replace(tmp, self.fileName)
+        self.dirty = False
+
+    # A file checked before the history was kept
+    def seed(self, key, stream, state, checked):
+        if key in self.entries:
+            return
+        self.entries[key] = {"stream": stream, "checked": checked, "result": state,
+                             "streak": 0 if state in goodStates else 1, "seconds": 0.0, "bytes": 0}
+        self.dirty = True
+
+    # Keep the outcome of a checkEngine.ProbeResult
+    def record(self, key, stream, r, checked=None):
+        self.update(key, stream, r.result, r.seconds, r.bytesRead, checked or time.time())
+
+    # A check done at checked. The same check given twice (from a journal
+    # that was already in the history) counts once
+    def update(self, key, stream, result, seconds, bytesRead, checked):
+        e = self.entries.get(key)
+        if e is not None and e.get("checked") == checked and e.get("stream") == stream:
+            return
+        streak = 0
+        if result not in goodStates:
+            streak = 1
+            if e is not None and e.get("stream") == stream:
+                streak = e.get("streak", 0) + 1
+        self.entries[key] = {"stream": stream, "checked": checked, "result": result,
+                             "streak": streak, "seconds": round(seconds, 3), "bytes": bytesRead}
+        self.dirty = True
+
+    # When key is due, 0 if it was never checked
+    def due(self, key, stream):
+        e = self.entries.get(key)
+        if e is None or e.get("stream") != stream:
+            return 0.0
+        if e.get("result") in goodStates:
+            return e["checked"] + self.goodAge
+        wait = self.failAge * 2 ** min(max(e.get("streak", 1), 1) - 1, 30)
+        return e["checked"] + min(wait, self.maxBackoff)
+
+    def expectedBytes(self, key):
+        e = self.entries.get(key)
+        if e is None or not e.get("bytes"):
+            return defaultProbeBytes
+        return e["bytes"]
+
+    # The keys of files (key, stream) to check now, most overdue first.
+    # maxBytes limits the bytes the probes are expected to read, 0 is no
+    # limit
+    def plan(self, files, now=None, maxBytes=0):
+        if now is None:
+            now = time.time()
+        due = []
+        for key, stream in files:
+            t = self.due(key, stream)
+            if t <= now:
+                due.append((t, key))
+        due.sort()
+        keys = []
+        spent = 0
+        for t, key in due:
+            n = self.expectedBytes(key)
+            if maxBytes > 0 and spent + n > maxBytes:
+                break
+            spent += n
+            keys.append(key)
+        return keys
+
+    # Entries by result and how many are due now
+    def summary(self, files, now=None):
+        if now is None:
+            now = time.time()
+        counts = {}
+        due = 0
+        for key, stream in files:
+            e = self.entries.get(key)
+            k = e.get("result", "?") if e is not None else "never checked"
+            counts[k] = counts.get(k, 0) + 1
+            if self.due(key, stream) <= now:
+                due += 1
+        return counts, due
+
+
+class CheckJournal:
+
+    def __init__(self, fileName, syncInterval=defaultSyncInterval):
+        self.fileName = fileName
+        self.syncInterval = syncInterval
+        self.f = None
+        self.synced = 0.0
+        self.records = 0
+
+    # The run a journal left behind: (its first line or None, the results)
+    def read(self):
+        header = None
+        results = []
+        try:
+            f = open(self.fileName, 'r')
+        except OSError:
+            return header, results
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # cut short when the run died
+                continue
+            if not isinstance(record, dict):
+                continue
+            if "started" in record:
+                header = record
+            elif "file" in record and "result" in record:
+                results.append(record)
+        f.close()
+        return header, results
+
+    # Put the results of the run the journal was left by into history,
+    # apply(key, stream, result), if given, writes each into its file:
+    # the run may have died before it did. Returns what read does
+    def recover(self, history, apply=None):
+        header, results = self.read()
+        for e in results:
+            history.update(e["file"], e["stream"], e["result"], e["seconds"], e["bytes"], e["checked"])
+            if apply is not None:
+                apply(e["file"], e["stream"], e["result"])
+        return header, results
+
+    # A new journal for a run checking the files keys
+    def start(self, keys):
+        self.f = open(self.fileName, 'w')
+        self.f.write(json.dumps({"started": time.time(), "files": list(keys)}) + "\n")
+        self.sync()
+
+    def add(self, key, stream, r, checked):
+        self.f.write(json.dumps({"file": key, "stream": stream, "result": r.result, "reason": r.reason,
+                                 "seconds": round(r.seconds, 3), "bytes": r.bytesRead,
+                                 "checked": checked}) + "\n")
+        self.records += 1
+        # a killed process loses nothing that was flushed, a power cut
+        # loses at most syncInterval seconds
+        self.f.flush()
+        if time.monotonic() - self.synced >= self.syncInterval:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.synced = time.monotonic()
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    # The run finished and the history has its results
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.fileName)
+        except OSError:
+            pass
+
+
+# The files of the run a journal was left by (header and results from
+# read) that have no result in it, in the order of the run, leaving out
+# the ones not in known
+def unfinished(header, results, known):
+    finished = set(e["file"] for e in results)
+    return [k for k in header.get("files", []) if k in known and k not in finished]
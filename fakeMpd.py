@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# fakeMpd.py is a small stand-in for mpd that speaks enough of the mpd
+# protocol for streamPlayer.py and the benchmarks in streamBench.py.
+#
+# It does not play audio. It keeps a queue, a play state and a volume,
+# and answers the commands streamPlayer.py sends. It runs in a thread
+# inside the calling process:
+#
+#    server = fakeMpd.FakeMPD()
+#    server.start()
+#    client = mpdClient.MPDClient("127.0.0.1", server.port)
+#    ...
+#    server.stop()
+#
+# or on its own, so streamPlayer.py can be pointed at it with MPD_HOST
+# and MPD_PORT:
+#
+#    python3 fakeMpd.py [--port n | --socket path] [--latency cmd=seconds]
+#                       [--default-latency seconds] [--start-delay seconds]
+#                       [--trace file]
+#
+# To measure the player without real hardware it can:
+#    latency       sleep before answering a command, per command name
+#                  (latency["play"] = 0.02) or for every command
+#                  (defaultLatency)
+#    start delay   report a stream as playing only some time after play,
+#                  like mpd waiting for the first audio from the station
+#                  (streamStartDelay, or per stream with setStreamDelay)
+#    titles        report a Title for a stream in currentsong, like mpd
+#                  once it read the ICY title (titles[stream] = "...")
+#    trace         record every command with the time it was received,
+#                  the connection it came from and how long it took, when
+#                  tracing is set (--trace), the trace is not bounded
+#
+#########################
+
+import argparse
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+
+mpdVersion = "0.21.0"
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        fake = self.server.fake
+        self.client = fake.clientConnected(self)
+        try:
+            self.commands()
+        except (OSError, ValueError):
+            # the connection was closed, maybe by FakeMPD.stop
+            pass
+        finally:
+            fake.clientDisconnected(self.client)
+
+    def commands(self):
+        self.wfile.write(("OK MPD " + mpdVersion + "\n").encode("utf-8"))
+        inList = False
+        listOK = False
+        batch = []
+        while True:
+            l = self.rfile.readline()
+            if not l:
+                break
+            l = l.decode("utf-8", "replace").rstrip("\n")
+            if l == "command_list_begin" or l == "command_list_ok_begin":
+                inList = True
+                listOK = (l == "command_list_ok_begin")
+                batch = []
+                continue
+            if inList:
+                if l == "command_list_end":
+                    inList = False
+                    self.runBatch(batch, listOK)
+                else:
+                    batch.append(l)
+                continue
+            if l == "close":
+                break
+            if l == "idle" or l.startswith("idle "):
+                if not self.idle(parseLine(l)[1]):
+                    break
+                continue
+            self.runBatch([l], False)
+
+    # Wait until one of the subsystems changes or the client sends noidle.
+    # Returns False if the connection was closed
+    def idle(self, subsystems):
+        fake = self.server.fake
+        wake = fake.idleWaiter(self.client)
+        try:
+            while True:
+                changed = fake.takeEvents(self.client, subsystems)
+                if changed:
+                    self.send(["changed: " + c for c in changed] + ["OK"])
+                    return True
+                r, w, x = select.select([self.connection, wake], [], [])
+                if wake in r:
+                    wake.recv(64)
+                if self.connection in r:
+                    l = self.rfile.readline()
+                    if not l:
+                        return False
+                    # noidle, or anything else, ends the idle
+                    changed = fake.takeEvents(self.client, subsystems)
+                    self.send(["changed: " + c for c in changed] + ["OK"])
+                    return True
+        finally:
+            fake.idleDone(self.client)
+
+    def runBatch(self, batch, listOK):
+        out = []
+        for i, l in enumerate(batch):
+            try:
+                out.extend(self.server.fake.execute(l, self.client))
+            except FakeMPDAck as ack:
+                cmd = l.split(" ", 1)[0]
+                out.append("ACK [" + str(ack.code) + "@" + str(i) + "] {" + cmd + "} " + str(ack))
+                self.send(out)
+                return
+            if listOK:
+                out.append("list_OK")
+        out.append("OK")
+        self.send(out)
+
+    def send(self, out):
+        self.wfile.write(("\n".join(out) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class FakeMPDAck(Exception):
+
+    def __init__(self, msg, code=5):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Split a protocol line into the command and its (unquoted) arguments
+def parseLine(l):
+    args = []
+    i = 0
+    n = len(l)
+    while i < n:
+        while i < n and l[i] == " ":
+            i += 1
+        if i >= n:
+            break
+        if l[i] == '"':
+            i += 1
+            a = []
+            while i < n and l[i] != '"':
+                if l[i] == "\\" and i + 1 < n:
+                    i += 1
+                a.append(l[i])
+                i += 1
+            i += 1
+            args.append("".join(a))
+        else:
+            j = l.find(" ", i)
+            if j < 0:
+                j = n
+            args.append(l[i:j])
+            i = j
+    if not args:
+        return "", []
+    return args[0], args[1:]
+
+
+class FakeMPD:
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.lock = threading.RLock()
+
+        self.queue = []
+        self.nextId = 1
+        self.song = -1
+        self.state = "stop"
+        self.volume = 100
+        self.playlistVersion = 1
+        self.connections = 0
+
+        self.latency = {}
+        self.defaultLatency = 0.0
+        self.streamStartDelay = 0.0
+        self.streamDelays = {}
+        self.songStarted = 0.0
+        self.songDelay = 0.0
+        # stream: the title reported for it
+        self.titles = {}
+
+        self.tracing = False
+        self.trace = []
+        self.started = time.monotonic()
+
+        # idle: changed subsystems not yet reported to each connection,
+        # and the socket that wakes a connection waiting in idle
+        self.events = {}
+        self.wakers = {}
+        self.handlers = {}
+
+    # host is an address, or the path of a unix socket (starts with /)
+    def start(self):
+        if self.host.startswith("/"):
+            if os.path.exists(self.host):
+                os.remove(self.host)
+            self.server = ThreadingUnixServer(self.host, FakeMPDHandler)
+        else:
+            self.server = ThreadingTCPServer((self.host, self.port), FakeMPDHandler)
+            self.port = self.server.server_address[1]
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    # Stop listening and drop every connection, like mpd going away
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            with self.lock:
+                handlers = list(self.handlers.values())
+            for h in handlers:
+                try:
+                    h.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            if self.host.startswith("/") and os.path.exists(self.host):
+                os.remove(self.host)
+
+    def clientConnected(self, handler):
+        with self.lock:
+            self.connections += 1
+            self.events[self.connections] = set()
+            self.handlers[self.connections] = handler
+            return self.connections
+
+    def clientDisconnected(self, client):
+        with self.lock:
+            self.events.pop(client, None)
+            self.handlers.pop(client, None)
+
+    # Record that a subsystem (player, mixer, playlist, ...) changed
+    def notify(self, subsystem):
+        with self.lock:
+            for e in self.events.values():
+                e.add(subsystem)
+            for w, r in self.wakers.values():
+                try:
+                    w.send(b"x")
+                except OSError:
+                    pass
+
+    def takeEvents(self, client, subsystems):
+        with self.lock:
+            e = self.events.get(client, set())
+            if subsystems:
+                changed = sorted(e.intersection(subsystems))
+            else:
+                changed = sorted(e)
+            e.difference_update(changed)
+            return changed
+
+    def idleWaiter(self, client):
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        with self.lock:
+            self.wakers[client] = (a, b)
+        return b
+
+    def idleDone(self, client):
+        with self.lock:
+            pair = self.wakers.pop(client, ())
+        for x in pair:
+            x.close()
+
+    def queueChanged(self):
+        self.playlistVersion += 1
+        self.notify("playlist")
+
+    def setLatency(self, cmd, seconds):
+        self.latency[cmd] = seconds
+
+    def setStreamDelay(self, stream, seconds):
+        self.streamDelays[stream] = seconds
+
+    def clearTrace(self):
+        with self.lock:
+            self.trace = []
+
+    # (seconds since start, connection, command line, seconds taken)
+    def saveTrace(self, fileName):
+        f = open(fileName, 'w')
+        for t, client, l, took in list(self.trace):
+            f.write("%.6f %d %.6f %s\n" % (t, client, took, l))
+        f.close()
+
+    def execute(self, l, client=0):
+        t = time.monotonic()
+        cmd, args = parseLine(l)
+        f = getattr(self, "cmd_" + cmd, None)
+        if f is None:
+            raise FakeMPDAck("unknown command \"" + cmd + "\"")
+        delay = self.latency.get(cmd, self.defaultLatency)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            try:
+                return f(args)
+            finally:
+                if self.tracing:
+                    self.trace.append((t - self.started, client, l, time.monotonic() - t))
+
+    def startSong(self, pos):
+        self.song = pos
+        self.state = "play"
+        self.notify("player")
+        self.songStarted = time.monotonic()
+        self.songDelay = self.streamDelays.get(self.queue[pos]["file"], self.streamStartDelay)
+
+    # True once the stream would be producing audio
+    def audioStarted(self):
+        return self.state == "play" and time.monotonic() - self.songStarted >= self.songDelay
+
+    def intArg(self, args, i, default=None):
+        if len(args) <= i:
+            if default is None:
+                raise FakeMPDAck("too few arguments", 2)
+            return default
+        try:
+            return int(args[i])
+        except ValueError:
+            raise FakeMPDAck("Integer expected: " + args[i], 2)
+
+    def songInfo(self, pos):
+        s = self.queue[pos]
+        info = ["file: " + s["file"], "Pos: " + str(pos), "Id: " + str(s["id"])]
+        if s["file"] in self.titles:
+            info.append("Title: " + self.titles[s["file"]])
+        return info
+
+    # protocol commands
+
+    def cmd_ping(self, args):
+        return []
+
+    def cmd_clear(self, args):
+        self.queue = []
+        self.song = -1
+        self.state = "stop"
+        self.queueChanged()
+        return []
+
+    def cmd_add(self, args):
+        if not args:
+            raise FakeMPDAck("too few arguments", 2)
+        self.queue.append({"file": args[0], "id": self.nextId})
+        self.nextId += 1
+        self.queueChanged()
+        return []
+
+    def cmd_addid(self, args):
+        if not args:
+            raise FakeMPDAck("too few arguments", 2)
+        s = {"file": args[0], "id": self.nextId}
+        self.nextId += 1
+        if len(args) > 1:
+            pos = self.intArg(args, 1)
+            if pos < 0 or pos > len(self.queue):
+                raise FakeMPDAck("Bad song index", 2)
+            self.queue.insert(pos, s)
+            if self.song >= pos:
+                self.song += 1
+        else:
+            self.queue.append(s)
+        self.queueChanged()
+        return ["Id: " + str(s["id"])]
+
+    # a position or a START:END range
+    def rangeArg(self, args):
+        if not args:
+            raise FakeMPDAck("too few arguments", 2)
+        a, sep, b = args[0].partition(":")
+        try:
+            start = int(a)
+            end = int(b) if b else (len(self.queue) if sep else start + 1)
+        except ValueError:
+            raise FakeMPDAck("Integer expected: " + args[0], 2)
+        if start < 0 or end > len(self.queue) or start >= end:
+            raise FakeMPDAck("Bad song index", 2)
+        return start, end
+
+    def cmd_delete(self, args):
+        start, end = self.rangeArg(args)
+        del self.queue[start:end]
+        if start <= self.song < end:
+            self.song = -1
+            self.state = "stop"
+        elif self.song >= end:
+            self.song -= end - start
+        self.queueChanged()
+        return []
+
+    def cmd_play(self, args):
+        pos = self.intArg(args, 0, max(self.song, 0))
+        if pos < 0 or pos >= len(self.queue):
+            if not self.queue and not args:
+                return []
+            raise FakeMPDAck("Bad song index", 2)
+        self.startSong(pos)
+        return []
+
+    def cmd_playid(self, args):
+        sid = self.intArg(args, 0)
+        for pos, s in enumerate(self.queue):
+            if s["id"] == sid:
+                self.startSong(pos)
+                return []
+        raise FakeMPDAck("No such song", 50)
+
+    def cmd_stop(self, args):
+        self.state = "stop"
+        self.notify("player")
+        return []
+
+    def cmd_pause(self, args):
+        if self.state == "play":
+            self.state = "pause"
+        elif self.state == "pause":
+            self.state = "play"
+        self.notify("player")
+        return []
+
+    def cmd_next(self, args):
+        if self.song + 1 < len(self.queue):
+            self.startSong(self.song + 1)
+        return []
+
+    def cmd_previous(self, args):
+        if self.song > 0:
+            self.startSong(self.song - 1)
+        return []
+
+    def cmd_setvol(self, args):
+        v = self.intArg(args, 0)
+        if v < 0 or v > 100:
+            raise FakeMPDAck("Invalid volume value", 2)
+        self.volume = v
+        self.notify("mixer")
+        return []
+
+    def cmd_status(self, args):
+        out = ["volume: " + str(self.volume),
+               "repeat: 0", "random: 0", "single: 0", "consume: 0",
+               "playlist: " + str(self.playlistVersion),
+               "playlistlength: " + str(len(self.queue)),
+               "state: " + self.state]
+        if 0 <= self.song < len(self.queue):
+            out.append("song: " + str(self.song))
+            out.append("songid: " + str(self.queue[self.song]["id"]))
+        if self.audioStarted():
+            out.append("elapsed: %.3f" % (time.monotonic() - self.songStarted - self.songDelay))
+            out.append("bitrate: 128")
+            out.append("audio: 44100:24:2")
+        return out
+
+    def cmd_currentsong(self, args):
+        if 0 <= self.song < len(self.queue):
+            return self.songInfo(self.song)
+        return []
+
+    def cmd_playlistinfo(self, args):
+        out = []
+        for pos in range(len(self.queue)):
+            out.extend(self.songInfo(pos))
+        return out
+
+
+#########################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="stand-in for mpd")
+    parser.add_argument("--port", type=int, default=6600)
+    parser.add_argument("--socket", help="listen on this unix socket instead of TCP")
+    parser.add_argument("--latency", action="append", default=[], metavar="CMD=SECONDS",
+                        help="delay before answering a command, may be repeated")
+    parser.add_argument("--default-latency", dest="defaultLatency", type=float, default=0.0,
+                        help="delay before answering any command")
+    parser.add_argument("--start-delay", dest="startDelay", type=float, default=0.0,
+                        help="seconds from play until a stream reports audio")
+    parser.add_argument("--trace", help="write the command trace to this file on exit")
+    args = parser.parse_args()
+
+    if args.socket:
+        fake = FakeMPD(args.socket)
+    else:
+        fake = FakeMPD("127.0.0.1", args.port)
+    fake.tracing = args.trace is not None
+    fake.defaultLatency = args.defaultLatency
+    fake.streamStartDelay = args.startDelay
+    for l in args.latency:
+        cmd, sep, seconds = l.partition("=")
+        fake.setLatency(cmd, float(seconds))
+
+    fake.start()
+    if args.socket:
+        print("fake mpd listening on " + args.socket)
+    else:
+        print("fake mpd listening on 127.0.0.1:" + str(fake.port))
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+        if args.trace:
+            fake.saveTrace(args.trace)
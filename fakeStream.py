@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# fakeStream.py is a local http server that behaves like the streaming
+# radio servers m3uCheck.py checks. It is used by streamBench.py.
+#
+# The path of the url selects the behaviour:
+#
+#    /healthy      200 and a never ending stream of audio bytes
+#    /slow/s       waits s seconds, then behaves like /healthy
+#    /error        404
+#    /html         200 and an html page, like a captive portal or a
+#                  station's home page in place of its stream
+#    /empty        200 audio/mpeg and no body, dead air
+#    /aac          200 and AAC in ADTS frames
+#    /ogg          200 and Ogg Vorbis
+#    /hls          an HLS playlist
+#    /hang         accepts the connection but never answers
+#    /redirect/n   redirects n times, then behaves like /healthy
+#    /redirect/n/path
+#                  redirects n times, then to /path
+#    /token/s/path redirects to /path with Cache-Control: max-age=s, like
+#                  a redirect to a url with a token that lasts s seconds
+#    /m3u/path     an m3u playlist with the url of /path
+#    /pls/path     a pls playlist with the url of /path
+#    /icy/n        like /healthy with ICY metadata every n bytes of audio
+#                  (8192 without n) when the request asks for it with
+#                  Icy-MetaData: 1. The StreamTitle is the title
+#                  attribute, sent when it changes (and in the first
+#                  block), the other blocks are empty
+#    /icy/n/words  like /icy/n with the title words, _ for spaces
+#
+# Paths can be chained, /redirect/2/pls/m3u/healthy takes two redirects
+# and two playlists to reach the audio. delay is the time every answer
+# waits, like the round trip to a server far away.
+#
+# deadUrl() returns a url on a port nobody listens on.
+#
+#########################
+
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+# one MP3 frame, MPEG 1 layer III, 128 kbit/s, 44100 Hz
+audioChunk = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+# one AAC frame in ADTS, 44100 Hz stereo, about 128 kbit/s
+def adtsFrame(length=371):
+    return bytes([0xff, 0xf1, 0x50, 0x80 | (length >> 11), (length >> 3) & 0xff,
+                  ((length & 7) << 5) | 0x1f, 0xfc]) + b"\x00" * (length - 7)
+
+def oggPage(headerType, sequence, packet):
+    return (b"OggS" + bytes([0, headerType]) + struct.pack("<qIII", 0, 1, sequence, 0) +
+            bytes([1, len(packet)]) + packet)
+
+aacChunk = adtsFrame()
+# the Vorbis identification header, 44100 Hz stereo, 128 kbit/s nominal
+oggHead = oggPage(2, 0, b"\x01vorbis" + struct.pack("<IBIiii", 0, 2, 44100, 0, 128000, 0) + b"\xb8\x01")
+oggChunk = oggPage(0, 1, b"\x00" * 255)
+hlsPlaylist = "#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:10\n#EXTINF:10,\nsegment0.aac\n"
+htmlPage = b"<html><head><title>Sign in</title></head><body>" + b"<p>Please sign in to use this network</p>" * 40 + b"</body></html>"
+
+
+class FakeStreamHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = self.rfile.readline().decode("latin-1")
+            self.headers = {}
+            while True:
+                l = self.rfile.readline()
+                if not l or l in (b"\r\n", b"\n"):
+                    break
+                k, sep, v = l.decode("latin-1").partition(":")
+                self.headers[k.strip().lower()] = v.strip()
+            parts = request.split()
+            if len(parts) < 2:
+                return
+            self.route(parts[1])
+        except OSError:
+            pass
+
+    def route(self, path):
+        server = self.server.fake
+        server.requests += 1
+        if server.delay:
+            time.sleep(server.delay)
+        # the query (a token) does not change the behaviour
+        p = path.split("?")[0].strip("/").split("/")
+        rest = "/".join(p[1:]) or "healthy"
+        if p[0] == "hang":
+            server.stopping.wait(server.hangSeconds)
+        elif p[0] == "error":
+            self.head("404 Not Found", "text/html")
+            self.wfile.write(b"<html><body>not found</body></html>")
+        elif p[0] == "html":
+            self.head("200 OK", "text/html")
+            self.wfile.write(htmlPage)
+        elif p[0] == "empty":
+            self.head("200 OK", "audio/mpeg")
+        elif p[0] == "aac":
+            self.audio(aacChunk, "audio/aac")
+        elif p[0] == "ogg":
+            self.audio(oggChunk, "application/ogg", oggHead)
+        elif p[0] == "hls":
+            self.head("200 OK", "application/vnd.apple.mpegurl")
+            self.wfile.write(hlsPlaylist.encode("latin-1"))
+        elif p[0] == "redirect":
+            n = int(p[1]) if len(p) > 1 else 1
+            target = "/" + ("/".join(p[2:]) or "healthy")
+            if n > 1:
+                location = "/redirect/" + str(n - 1) + target
+            else:
+                location = target
+            self.wfile.write(("HTTP/1.0 302 Found\r\nLocation: " + location + "\r\n\r\n").encode("latin-1"))
+        elif p[0] == "token":
+            target = "/" + ("/".join(p[2:]) or "healthy")
+            self.wfile.write(("HTTP/1.0 302 Found\r\nLocation: " + target + "?token=1\r\n"
+                              "Cache-Control: max-age=" + p[1] + "\r\n\r\n").encode("latin-1"))
+        elif p[0] == "m3u":
+            self.head("200 OK", "audio/x-mpegurl")
+            self.wfile.write(("#EXTM3U\n#EXTINF:-1,fake\n" + server.url(rest) + "\n").encode("latin-1"))
+        elif p[0] == "pls":
+            self.head("200 OK", "audio/x-scpls")
+            self.wfile.write(("[playlist]\nNumberOfEntries=1\nFile1=" + server.url(rest) +
+                              "\nTitle1=fake\nVersion=2\n").encode("latin-1"))
+        elif p[0] == "icy":
+            metaint = int(p[1]) if len(p) > 1 and p[1].isdigit() else 8192
+            title = p[2].replace("_", " ") if len(p) > 2 else None
+            if self.headers.get("icy-metadata") == "1":
+                self.icyAudio(metaint, title)
+            else:
+                self.audio()
+        elif p[0] == "slow":
+            time.sleep(float(p[1]) if len(p) > 1 else 1.0)
+            self.audio()
+        else:
+            self.audio()
+
+    def head(self, status, contentType):
+        self.wfile.write(("HTTP/1.0 " + status + "\r\nContent-Type: " + contentType + "\r\n\r\n").encode("latin-1"))
+
+    # not cached, like the audio of icecast
+    def audio(self, chunk=audioChunk, contentType="audio/mpeg", first=b""):
+        self.wfile.write(("HTTP/1.0 200 OK\r\nContent-Type: " + contentType + "\r\n"
+                          "Cache-Control: no-cache, no-store\r\n\r\n").encode("latin-1"))
+        server = self.server.fake
+        self.wfile.write(first)
+        for i in range(server.streamChunks):
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            if server.stopping.is_set():
+                break
+
+
+    def icyAudio(self, metaint, fixedTitle=None):
+        server = self.server.fake
+        self.wfile.write(("HTTP/1.0 200 OK\r\nContent-Type: audio/mpeg\r\nicy-name: fake\r\n"
+                          "icy-br: 128\r\nicy-metaint: " + str(metaint) + "\r\n\r\n").encode("latin-1"))
+        audio = (audioChunk * (metaint // len(audioChunk) + 1))[:metaint]
+        sent = None
+        for i in range(server.streamChunks):
+            title = fixedTitle or server.title
+            if title != sent:
+                meta = ("StreamTitle='" + title + "';StreamUrl='';").encode("utf-8")
+                meta += b"\x00" * (-len(meta) % 16)
+                sent = title
+            else:
+                meta = b""
+            self.wfile.write(audio + bytes([len(meta) // 16]) + meta)
+            self.wfile.flush()
+            if server.stopping.is_set():
+                break
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+
+class FakeStreamServer:
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.requests = 0
+        self.hangSeconds = 60.0
+        # chunks sent before a healthy stream ends, the checker only
+        # needs the first few
+        self.streamChunks = 64
+        self.delay = 0.0
+        # the StreamTitle of /icy
+        self.title = "Fake Artist - Fake Song"
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.server = ThreadingTCPServer((self.host, self.port), FakeStreamHandler)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def url(self, path):
+        return "http://" + self.host + ":" + str(self.port) + "/" + path.lstrip("/")
+
+
+# A url that refuses connections
+def deadUrl(path="/stream"):
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return "http://127.0.0.1:" + str(port) + path
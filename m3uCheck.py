@@ -52,10 +52,16 @@
 #    unchecked or no colon and no state
 #    good - the file format is valid and the stream works
 #    bad - the stream does not work
+#    no audio - the stream answers, but with an html page or nothing
+#       instead of audio
+#    slow - the stream works, but took much longer to answer than the
+#       other streams of its host (or of all hosts)
 #    use - the stream works, and I like it and want it to use it
 #    shelf - the stream works, but does not suit my tastes
 #
-# Once a file has been checked, it doesn't need to be checked again
+# A checked file is checked again when it is due (see checkHistory.py):
+# a week after it was found good, a day after it failed, two days after
+# it failed twice and so on, up to a month
 #
 # I add the state to the first line, using the format:
 #
@@ -124,7 +130,52 @@
 #          man mpc
 #
 # Start the script running using:
-#    python3 iRadioPlayer.py
+#    python3 m3uCheck.py [directory] [--concurrency n] [--per-host n] [--timeout s]
+#                        [--trip-after n] [--confirm] [--all]
+#                        [--budget-seconds s] [--budget-mb n] [--resume]
+#                        [--fixed-timeout] [--workers n] [--rescan]
+#                        [--stats-file file.prom]
+#
+# The streams are checked at the same time (see checkEngine.py). One slow
+# or dead host no longer holds up the rest of the run. A stream is only
+# good when audio frames (MP3, AAC, Ogg) or an HLS playlist come back,
+# its codec, bitrate and time to the first byte are logged
+#
+# After --trip-after streams of one site (a domain, like
+# akamaistream.net) in a row refused the connection or timed out, the
+# rest of that site's streams are not probed. A host name that is not
+# found only counts against that host. They are logged as unreachable but left
+# unchecked in their files, so the next run tries them again. --confirm
+# probes one more of them first, if it answers the site is checked as
+# usual. --trip-after 0 probes every stream
+#
+# Only the files that are due are checked, never checked ones first. The
+# history is kept in m3uCheck.history in the directory. --budget-seconds
+# stops starting probes after that many seconds and --budget-mb limits
+# the data the probes read, the files left over are checked next run.
+# --all checks every file. The use and shelf states are left in the file,
+# their checks are only kept in the history
+#
+# Every result is appended to m3uCheck.journal as it comes in, and the m3u
+# files are replaced in one step (written to a temporary file and
+# renamed). When a run is killed, the next run first takes the results of
+# the journal, so nothing that was checked is checked again. --resume
+# goes on with the files the killed run still had to check
+#
+# --timeout is the most a probe may take. A probe is first given a
+# deadline from the connect and first byte times seen so far, for its
+# host and for all hosts (see checkEngine.LatencyTracker), so hung hosts
+# do not hold up the run. The streams that miss it are probed again with
+# the whole timeout at the end, they are slow if they answer then and
+# unreachable if not. --fixed-timeout gives every probe the whole timeout
+#
+# The m3u files are read by m3uIngest.py. A file is only parsed (and
+# repaired) again when its size, time or inode changed since the last
+# run, m3uCheck.index keeps what the others hold. Many changed files are
+# parsed by --workers processes at once. --rescan parses every file
+#
+# Counts and timings of the probes and file access are logged at the end
+# and, with --stats-file, written for the node_exporter textfile collector
 #
 # This command helps count number of files that are good:
 #    cat *.m3u | grep "#EXTM3U: good" | wc -l
@@ -139,18 +190,28 @@
 #########################
 
 import time
-import datetime
 import os
 import sys
 import subprocess
-import urllib.request
+import argparse
+
+import checkEngine
+import checkHistory
+import m3uIngest
+import streamLog
+import streamStats
 
 #########################
 # Global Variables
 
-fileLog = open('/home/pi/Stations/m3uCheck.log', 'w+')
+# the log is appended to and rotated, see streamLog.py
+log = streamLog.Logger('/home/pi/Stations/m3uCheck.log')
 currentStationConfig = '/home/pi/Stations/m3uCheck.conf'
 
+# counts and timings of the probes and the m3u file reads and writes,
+# logged at the end and written to --stats-file if it is given
+stats = streamStats.Stats("m3ucheck")
+
 directoryStations = "/home/pi/Stations"
 
 defaultVolume = 60
@@ -181,15 +242,10 @@ limitMPCoutput = " | grep \"[-,'[']\""
 
 
 #########################
-# Log messages should be time stamped
-def timeStamp():
-    t = time.time()
-    s = datetime.datetime.fromtimestamp(t).strftime('%Y/%m/%d %H:%M:%S - ')
-    return s
-
-# Write messages in a standard format
-def printMsg(s):
-    fileLog.write(timeStamp() + s + "\n")
+# Write messages in a standard format, time stamped by the log writer.
+# fields are written as key=value after the message
+def printMsg(s, **fields):
+    log.msg(s, **fields)
 
 def lastStation():
     f = tempStationFile
@@ -316,6 +372,41 @@ def removePlaylist(p):
         initPlaylist(defaultPlaylist)
 
 
+# states I give a station myself, a check does not replace them
+userStates = ("use", "shelf")
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="check streaming radio m3u files")
+    parser.add_argument("directory", nargs="?", default=directoryStations,
+                        help="directory containing the m3u files")
+    parser.add_argument("-c", "--concurrency", type=int, default=checkEngine.defaultConcurrency,
+                        help="maximum number of streams checked at once")
+    parser.add_argument("-H", "--per-host", dest="perHost", type=int, default=checkEngine.defaultPerHost,
+                        help="maximum number of streams checked at once on one host name")
+    parser.add_argument("-t", "--timeout", type=float, default=checkEngine.defaultTimeout,
+                        help="seconds before a stream is marked unreachable")
+    parser.add_argument("--trip-after", dest="tripAfter", type=int, default=checkEngine.defaultTripAfter,
+                        help="stop probing a site after this many unreachable streams in a row, 0 never stops")
+    parser.add_argument("--confirm", action="store_true",
+                        help="probe one more stream of a site before giving up on it")
+    parser.add_argument("--all", action="store_true",
+                        help="check every file, not only the ones that are due")
+    parser.add_argument("--budget-seconds", dest="budgetSeconds", type=float, default=0,
+                        help="start no probe after this many seconds, 0 is no limit")
+    parser.add_argument("--budget-mb", dest="budgetMb", type=float, default=0,
+                        help="megabytes the probes may read, 0 is no limit")
+    parser.add_argument("--fixed-timeout", dest="fixedTimeout", action="store_true",
+                        help="give every probe the whole timeout instead of a deadline from the probe times")
+    parser.add_argument("--resume", action="store_true",
+                        help="check the files a run that was killed did not get to")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="processes parsing the changed m3u files")
+    parser.add_argument("--rescan", action="store_true",
+                        help="parse every m3u file, not only the ones changed since the last run")
+    parser.add_argument("--stats-file", dest="statsFile", default=None,
+                        help="write counters and timings in the Prometheus text format to this file")
+    return parser.parse_args()
+
 def printMenu():
     print (" ")
     print ("Song Commands:")
@@ -382,276 +473,127 @@ try:
     # this works, but how to know it works programmatically ?
     # cvlc http://av.rasset.ie/av/live/radio/radio1.m3u
 
+    args = parseArgs()
+
+    history = checkHistory.CheckHistory(checkHistory.historyFileName(args.directory))
+    history.load()
+
     print("Checking m3u files ...")
-    fileCount = 0
-    for file in os.listdir(directoryStations):
-        if file.endswith(".m3u"):
-            fileName = os.path.join(directoryStations, file)
-            lines = []
-            i = 0
-            w = True
-            f = open(fileName, 'r')
-            fileCount += 1
-            print(str(fileCount) + ": " + fileName)
-            for line in f:
-                line = line.strip()
-                if not line:
-                    # skip blank lines
-                    print("    skip blank lines")
-                    continue
-                elif line.startswith('#'):
-                    if line.startswith('#EXTM3U:'):
-                        # skip files that have already been checked
-                        print("    skip files that have already been checked")
-                        w = False
-                        continue
-                    elif line.startswith('#EXTM3U'):
-                        if i == 0:
-                            lines.append(line)
-                            print("   " + line)
-                            i += 1
-                        else:
-                            print("file does not start with #EXTM3U: " + line)
-                            continue
-                    elif line.startswith('#EXTINF:'):
-                        if i == 1:
-                            lines.append(line)
-                            print("   " + line)
-                            i += 1
-                        else:
-                            print("second line is not #EXTINF: " + line)
-                            continue
-                    else:
-                        # skip other # lines as comments
-                        print("skipping comments: " + line)
-                        continue
-                elif i == 2:
-                    req = urllib.request.Request(line)
-                    try:
-                        response = urllib.request.urlopen(req)
-                    except Exception as e:
-                        print("    in except = " + str(e))
-                        y = getattr(e, "reason", None)
-                        if y is not None:
-                            l = lines.pop(0)
-                            n = l + ": unreachable"
-                            lines.insert(0, n)
-                            lines.append(line)
-                            print("   " + line)
-                            i += 1
-                        else:
-                            y = getattr(e, "code", None)
-                            if y is not None:
-                                l = lines.pop(0)
-                                n = l + ": failed request"
-                                lines.insert(0, n)
-                            else:
-                                l = lines.pop(0)
-                                n = l + ": good"
-                                lines.insert(0, n)
-                            lines.append(line)
-                            print("   " + line)
-                            i += 1
-                    else:
-                        print("too many lines: " + line)
-                        lines.append(line)
-                        print("   " + line)
-                        i += 1
-                        continue
-            f.close()
-
-            if w:
-                f = open(fileName, 'w')
-                for line in lines:
-                    f.write(line + '\n')
-                f.close()
+    # only the files changed since the last run are parsed, see
+    # m3uIngest.py
+    index = m3uIngest.M3uIndex(m3uIngest.indexFileName(args.directory))
+    if not args.rescan:
+        index.load()
+    with stats.timed("m3u_ingest"):
+        files = index.ingest(args.directory, args.workers)
+    printMsg(files.line())
+    for file, error in files.failed:
+        printMsg("cannot read " + file + ": " + error)
+    stats.count("m3u_parsed", files.parsed)
+    stats.count("m3u_repaired", files.repaired)
+    index.save()
+    for i, file in enumerate(files.names):
+        # the history knows the file by its name, the directory can be
+        # given either way
+        if files.states[i] is not None:
+            history.seed(file, files.streams[i], files.states[i], files.mtimes[i])
+
+    # write the state of a check into the first line of its file
+    def applyState(key, result):
+        i = files.at[key]
+        state = files.states[i]
+        if state in userStates or state == result:
+            return
+        try:
+            with stats.timed("m3u_write"):
+                index.setState(args.directory, key, result)
+        except OSError as ex:
+            # removed or made unreadable during the run
+            printMsg("cannot write " + key + ": " + str(ex))
+            return
+        files.states[i] = result
+
+    # the results of a run that was killed, written into the files that
+    # still have the stream checked
+    def applyRecovered(key, stream, result):
+        if key in files.at and files.streams[files.at[key]] == stream:
+            applyState(key, result)
+
+    journal = checkHistory.CheckJournal(checkHistory.journalFileName(args.directory))
+    header, recovered = journal.recover(history, applyRecovered)
+    if header is not None:
+        printMsg("took " + str(len(recovered)) + " results from the journal of a run that did not finish")
+
+    candidates = list(zip(files.names, files.streams))
+    counts, due = history.summary(candidates)
+    printMsg("history: " + str(len(candidates)) + " streams, " + str(due) + " due",
+             **dict((k.replace(" ", "_"), v) for k, v in counts.items()))
+    if args.resume and header is not None:
+        keys = checkHistory.unfinished(header, recovered, files.at)
+    elif args.all:
+        keys = [k for k, stream in candidates]
+    else:
+        keys = history.plan(candidates, maxBytes=int(args.budgetMb * 1024 * 1024))
+
+    # from here on the history holds what the old journal had
+    history.save()
+    journal.start(keys)
+
+    # probe the streams at the same time and annotate each file as soon
+    # as its probe finishes
+    printMsg("probing " + str(len(keys)) + " streams")
+
+    def probeDone(i, r):
+        key = keys[i]
+        fileName = os.path.join(args.directory, key)
+        stream = files.streams[files.at[key]]
+        if r.provisional:
+            # the site is down, check the file again next time
+            log.event("probe", file=fileName, result=r.result, reason=r.reason, provisional=True)
+            stats.count("probes_not_probed")
+            return
+        log.event("probe", r.seconds, file=fileName, result=r.result, reason=r.reason,
+                  codec=r.codec, bitrate=r.bitrate, connect="%.3f" % r.connect, firstByte="%.3f" % r.firstByte)
+        stats.observe("probe", r.seconds)
+        if r.result in (checkEngine.resultGood, checkEngine.resultSlow):
+            stats.observe("connect", r.connect)
+            stats.observe("first_byte", r.firstByte)
+            stats.count("codec_" + r.codec)
+        stats.count("probes_" + r.result.replace(" ", "_"))
+        checked = time.time()
+        journal.add(key, stream, r, checked)
+        history.record(key, stream, r, checked)
+        applyState(key, r.result)
+
+    progress = checkEngine.Progress(len(keys))
+    breaker = None
+    if args.tripAfter > 0:
+        breaker = checkEngine.CircuitBreaker(args.tripAfter, args.confirm)
+    deadline = None
+    if args.budgetSeconds > 0:
+        deadline = time.monotonic() + args.budgetSeconds
+    latency = None
+    if not args.fixedTimeout:
+        latency = checkEngine.LatencyTracker()
+    checkEngine.checkUrls([files.streams[files.at[k]] for k in keys], args.concurrency, args.perHost,
+                          args.timeout, probeDone, progress, breaker, None, deadline, latency)
+    history.save()
+    index.save()
+    journal.remove()
 
     print("Should be normal exit")
-    sys_exit()
-
-    ans = True
-    while ans:
-        printMenu()
-
-        # command order was by type, but changed to alphabetic because it
-        # is easier to find the command
-        ans = input(">")
-        if ans != "" and ans[0] == ">":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # play song number n
-                s = ans[2:]
-                print ("play song number " + s)
-                cmd = "mpc play " + s  + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-            else:
-                # play
-                print("play")
-                cmd = "mpc play" + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-        elif ans == "!":
-            # pause
-            print("pause")
-            cmd = "mpc stop " + limitMPCoutput
-            subprocess.call(cmd, shell=True)
-        elif ans == "+":
-            # volume up
-            print ("volume up")
-            currentVolume +=5
-            if currentVolume > 100:
-                currentVolume = 100
-            cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans == "-":
-            # volume down
-            print ("volume down")
-            currentVolume -=5
-            if currentVolume < 0:
-                currentVolume = 0
-            cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans != "" and ans[0] == "a":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                try:
-                    # add song
-                    file = ans[2:]
-                    print ("add song " + file)
-                    dirName = os.path.join(directoryMusic, file)
-                    fileName = "file://" + dirName
-                    # Use add to add to end rather than insert which puts after current
-                    cmd = 'mpc add ' + '"' + fileName + '"'
-                    print(cmd)
-                    subprocess.call(cmd, shell=True)
-                except Exception as ex:
-                    printMsg("ERROR: an unhandled exception occurred: " + str(ex))
-                    print ("Add failed for: " + fileName)
-        elif ans == "C":
-            # Display current playlist
-            print("Current playlist = " + currentPlaylist)
-        elif ans != "" and ans[0] == "d":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # delete song number n
-                s = ans[2:]
-                print ("delete song number " + s)
-                cmd = "mpc del " + s + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-            else:
-                # play
-                print("delete current song")
-                cmd = "mpc del 0 " + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-        elif ans == "D":
-            if currentPlaylist == defaultPlaylist:
-                print("Cannot delete all songs from default playlist")
-            else:
-                # Delete all songs from the playlist
-                cmd = "mpc stop " + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-                cmd = "mpc clear " + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-        elif ans != "" and ans[0] == "f":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # find and play song containing string s
-                print("find and play")
-                s = ans[2:]
-                cmd = "mpc searchplay title " + s
-                subprocess.call(cmd, shell=True)
-            else:
-                print("f requires a string")
-        elif ans != "" and ans[0] == "I":
-            # initialize playlist
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                n = ans[2:]
-            else:
-                n = defaultPlaylist
-            initPlaylist(n)
-            currentPlaylist = n
-        elif ans != "" and ans[0] == "L":
-            # Load playlist
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                n = ans[2:]
-                initPlaylist(n)
-                currentPlaylist = n
-        elif ans == "m":
-            # mute
-            muteVolume = not muteVolume
-            if muteVolume == True:
-                print ("mute")
-                previousVolume = currentVolume
-                currentVolume = 0
-                cmd = "amixer set Digital " + str(currentVolume) + "%"
-            else:
-                print ("unmute")
-                currentVolume = previousVolume
-                cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans == "n":
-            # next
-            print("next")
-            cmd = "mpc next " + limitMPCoutput
-            subprocess.call(cmd, shell=True)
-        elif ans == "o":
-            # shutoff raspberry pi and radio
-            sys.exit()
-        elif ans == "p":
-            # previous
-            print("previous")
-            cmd = "mpc prev " + limitMPCoutput
-            subprocess.call(cmd, shell=True)
-        elif ans == "P":
-            # List all playlists
-            cmd = "mpc lsplaylists"
-            subprocess.call(cmd, shell=True)
-        elif ans != "" and ans[0] == "R":
-            # Remove playlist
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                n = ans[2:]
-                removePlaylist(n)
-            else:
-                removePlaylist(currentPlaylist)
-        elif ans != "" and ans[0] == "s":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # search songs in playlist containing string s
-                print ("find and list songs matching a string (case sensitive)")
-                s = ans[2:]
-                cmd = "mpc playlist | grep -n " + s
-                subprocess.call(cmd, shell=True)
-            else:
-                # list all songs in playlist
-                print ("list all songs in playlist")
-                cmd = "mpc playlist | grep -n '-'"
-                subprocess.call(cmd, shell=True)
-        elif ans != "" and ans[0] == "S":
-            # Save playlist
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # Save playlist as n
-                n = ans[2:]
-                print ("save playlist as " + n)
-                cmd = "mpc save " + n
-                subprocess.call(cmd, shell=True)
-            else:
-                # Save current playlist
-                print ("save current playlist")
-                cmd = "mpc save " + currentPlaylist + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-        elif ans == "x":
-            # exit and leave music playing
-            sys.exit()
-        elif ans == "":
-            # exit and stop music
-            sys.exit()
-        else:
-            print("Unrecognized command: " + ans)
-
-    sys.exit()
+    printMsg(progress.line())
+    if progress.done < len(keys):
+        printMsg("out of time, " + str(len(keys) - progress.done) + " streams left for the next run")
+    if latency is not None:
+        for l in latency.report():
+            printMsg(l)
+    if breaker is not None and breaker.trips:
+        printMsg("sites given up on: " + ", ".join(sorted(breaker.tripped)))
+    for l in stats.report():
+        printMsg(l)
+    if args.statsFile is not None:
+        stats.writePrometheus(args.statsFile)
 
 except KeyboardInterrupt: # trap a CTRL+C keyboard interrupt
     printMsg("keyboard exception occurred")
@@ -660,17 +602,5 @@ except Exception as ex:
     printMsg("ERROR: an unhandled exception occurred: " + str(ex))
 
 finally:
-    printMsg("iRadioPlayer terminated")
-    writeiRadioPlayerTxt()
-    if ans == "x":
-        printMsg("... Song still playing")
-        fileLog.close()
-    elif ans == "o":
-        subprocess.call("mpc stop ", shell=True)
-        printMsg("... Shutting down raspberry pi")
-        fileLog.close()
-        subprocess.call("sudo shutdown -h 0", shell=True)
-    else:
-        subprocess.call("mpc stop ", shell=True)
-        fileLog.close()
-
+    printMsg("m3uCheck terminated")
+    log.close()
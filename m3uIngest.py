@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# m3uIngest.py reads the m3u files of a stations directory for
+# m3uCheck.py, and repairs their format on the way. With tens of
+# thousands of files, reading them one line at a time with a print per
+# line took longer than the checks, so:
+#
+#    the directory is walked once with os.scandir, which gives the
+#    names and file types without a stat per file from python
+#
+#    M3uIndex remembers every file it parsed by its stat signature (size,
+#    modification time in ns, inode), in m3uCheck.index next to the
+#    files. A file with the same signature is not opened again, its
+#    stream and state come from the index
+#
+#    the changed files are parsed in chunks across a process pool,
+#    when there are enough of them to pay for starting the processes
+#
+# Every file is brought into the same form, the form m3uCheck.py
+# describes:
+#
+#    #EXTM3U[: state]
+#    #EXTINF:-1,description
+#    stream
+#
+# A byte order mark at the start is dropped, a missing #EXTM3U line is
+# added and a missing #EXTINF line before the first stream is made from
+# the file name. Blank lines, other comments
+# and repeated #EXTM3U lines are dropped, further #EXTINF lines and
+# streams are kept in their order. A file is only written when this
+# changes it, through a temporary file that is renamed.
+#
+# ingest returns an M3uBatch: the name, stream, state and modification
+# time of every file with a stream, in lists indexed alike and sorted by
+# name. The lines of the files are not kept, setState reads a file
+# again when its state changes.
+#
+#########################
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+
+indexVersion = 1
+# files per task sent to a pool process
+defaultChunk = 256
+# fewer changed files than this are parsed in this process
+poolMinFiles = 2000
+
+# the entries of the index: [size, mtime ns, inode, stream, state]
+sigFields = 3
+
+
+def indexFileName(directory):
+    return os.path.join(directory, "m3uCheck.index")
+
+def signature(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+# The repaired lines, the stream to check (None if there is none) and
+# the state of the last check (None if the file was never checked) of
+# the text of an m3u file. title describes the station when the file
+# has no #EXTINF line
+def parseM3u(text, title):
+    state = None
+    stream = None
+    entries = []
+    info = None
+    # files saved by Windows editors start with a byte order mark
+    if text.startswith("\ufeff"):
+        text = text[1:]
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXTM3U'):
+            # checked before, the state is written again after the next
+            # check
+            if line.startswith('#EXTM3U:') and state is None:
+                state = line[len('#EXTM3U:'):].strip() or None
+        elif line.startswith('#EXTINF:'):
+            if info is not None:
+                entries.append(info)
+            info = line
+        elif line.startswith('#'):
+            # other # lines are comments
+            continue
+        else:
+            if stream is None:
+                stream = line
+                if info is None:
+                    info = "#EXTINF:-1," + title
+            if info is not None:
+                entries.append(info)
+                info = None
+            entries.append(line)
+    if info is not None:
+        entries.append(info)
+    return ['#EXTM3U'] + entries, stream, state
+
+def formatM3u(lines, state):
+    if state:
+        lines = [lines[0] + ": " + state] + lines[1:]
+    return "\n".join(lines) + "\n"
+
+# The text of a file and its stat, read without a text file object: for
+# files this small opening one costs more than the parsing. Bytes that
+# are not utf-8 survive a repair unchanged
+def readText(fileName):
+    fd = os.open(fileName, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        parts = []
+        while True:
+            data = os.read(fd, max(st.st_size, 4096))
+            if not data:
+                break
+            parts.append(data)
+    finally:
+        os.close(fd)
+    return b"".join(parts).decode("utf-8", "surrogateescape"), st
+
+# The file is written under another name and renamed, so a run that is
+# killed never leaves half a file
+def writeM3u(fileName, lines, state=None):
+    tmp = fileName + ".tmp"
+    f = open(tmp, 'wb')
+    f.write(formatM3u(lines, state).encode("utf-8", "surrogateescape"))
+    f.close()
+    os.replace(tmp, fileName)
+
+# Read, repair and stat one file. Returns (name, index entry, repaired,
+# error), the entry is None when the file could not be read
+def ingestFile(directory, name):
+    fileName = os.path.join(directory, name)
+    try:
+        text, st = readText(fileName)
+        lines, stream, state = parseM3u(text, name[:-len(".m3u")])
+        repaired = formatM3u(lines, state) != text
+        if repaired:
+            writeM3u(fileName, lines, state)
+            st = os.stat(fileName)
+    except OSError as ex:
+        return name, None, False, str(ex)
+    return name, signature(st) + [stream, state], repaired, None
+
+def ingestChunk(directory, names):
+    return [ingestFile(directory, name) for name in names]
+
+
+# The files with a stream, parallel lists indexed alike
+class M3uBatch:
+
+    def __init__(self):
+        self.names = []
+        self.streams = []
+        self.states = []
+        self.mtimes = []
+        # name: position in the lists
+        self.at = {}
+        # what ingest did
+        self.files = 0
+        self.unchanged = 0
+        self.parsed = 0
+        self.repaired = 0
+        self.failed = []
+        self.seconds = 0.0
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, stream, state, mtime):
+        self.at[name] = len(self.names)
+        self.names.append(name)
+        self.streams.append(stream)
+        self.states.append(state)
+        self.mtimes.append(mtime)
+
+    def line(self):
+        return ("%d m3u files, %d with a stream: %d unchanged, %d parsed, %d repaired, %d unreadable (%.2fs)" %
+                (self.files, len(self.names), self.unchanged, self.parsed, self.repaired, len(self.failed),
+                 self.seconds))
+
+
+class M3uIndex:
+
+    def __init__(self, fileName=None):
+        self.fileName = fileName
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        if self.fileName is None:
+            return
+        try:
+            f = open(self.fileName, 'r')
+            data = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == indexVersion and isinstance(data.get("files"), dict):
+            for k, v in data["files"].items():
+                if isinstance(v, list) and len(v) == sigFields + 2:
+                    self.entries[k] = v
+
+    def save(self):
+        if self.fileName is None or not self.dirty:
+            return
+        tmp = self.fileName + ".tmp"
+        f = open(tmp, 'w')
+        json.dump({"version": indexVersion, "files": self.entries}, f, separators=(",", ":"))
+        f.close()
+        os.replace(tmp, self.fileName)
+        self.dirty = False
+
+    # Parse the changed .m3u files of directory, workers processes at
+    # most. Returns an M3uBatch
+    def ingest(self, directory, workers=1, chunk=defaultChunk):
+        started = time.monotonic()
+        batch = M3uBatch()
+        kept = {}
+        changed = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                name = entry.name
+                if not name.endswith(".m3u") or not entry.is_file():
+                    continue
+                batch.files += 1
+                e = self.entries.get(name)
+                if e is not None and e[:sigFields] == signature(entry.stat()):
+                    kept[name] = e
+                else:
+                    changed.append(name)
+        batch.unchanged = len(kept)
+        for name, e, repaired, error in self.parse(directory, changed, workers, chunk):
+            if e is None:
+                # left out of the index, so it is read again next run
+                batch.failed.append((name, error))
+                continue
+            kept[name] = e
+            batch.parsed += 1
+            if repaired:
+                batch.repaired += 1
+        if changed or len(kept) != len(self.entries):
+            # files that are gone are forgotten
+            self.dirty = True
+        self.entries = kept
+        for name in sorted(kept):
+            e = kept[name]
+            if e[sigFields] is not None:
+                batch.add(name, e[sigFields], e[sigFields + 1], e[1] / 1e9)
+        batch.seconds = time.monotonic() - started
+        return batch
+
+    def parse(self, directory, names, workers, chunk):
+        # the pool is forked: started any other way, its processes would
+        # run the script that uses this module from the top
+        if workers <= 1 or len(names) < poolMinFiles or "fork" not in multiprocessing.get_all_start_methods():
+            return ingestChunk(directory, names)
+        chunks = [names[i:i + chunk] for i in range(0, len(names), chunk)]
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("fork")) as pool:
+            for part in pool.map(ingestChunk, [directory] * len(chunks), chunks):
+                results.extend(part)
+        return results
+
+    # Write state into the first line of the file name, the file is read
+    # again so a change made during the run is kept
+    def setState(self, directory, name, state):
+        fileName = os.path.join(directory, name)
+        text, st = readText(fileName)
+        lines, stream, old = parseM3u(text, name[:-len(".m3u")])
+        writeM3u(fileName, lines, state)
+        self.entries[name] = signature(os.stat(fileName)) + [stream, state]
+        self.dirty = True
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# mpdClient.py is a small python3 client for the mpd text protocol.
+#
+# streamPlayer.py used to run mpc through the shell for every command,
+# which forks /bin/sh, mpc and often grep. On a Raspberry Pi 3 a station
+# change cost three of those pipelines. This client keeps one connection
+# to mpd open and sends the protocol commands directly.
+#
+# The connection is chosen the same way mpc chooses it:
+#    MPD_HOST   host name, IP address or the path of mpd's unix socket
+#               (a path starts with /)
+#    MPD_PORT   TCP port, 6600 by default
+#
+# If the connection drops (mpd restarted, Pi woke up, ...) the next
+# command reconnects and is sent again once.
+#
+# Details of the protocol can be found here:
+#    https://www.musicpd.org/doc/html/protocol.html
+#
+#########################
+
+import os
+import socket
+import threading
+
+defaultHost = "localhost"
+defaultPort = 6600
+defaultTimeout = 10
+
+
+class MPDError(Exception):
+    # mpd answered a command with ACK
+    pass
+
+
+class MPDConnectionError(MPDError):
+    # mpd could not be reached, or the connection was lost
+    pass
+
+
+# Quote one argument so spaces, quotes and backslashes survive
+def quoteArg(a):
+    s = str(a)
+    s = s.replace('\\', '\\\\').replace('"', '\\"')
+    return '"' + s + '"'
+
+# Build one protocol line from a command and its arguments
+def commandLine(cmd, args):
+    if args:
+        return cmd + " " + " ".join(quoteArg(a) for a in args) + "\n"
+    return cmd + "\n"
+
+# Read host and port the same way mpc does
+def mpdAddress(host=None, port=None):
+    if host is None:
+        host = os.environ.get("MPD_HOST", defaultHost)
+    if port is None:
+        port = int(os.environ.get("MPD_PORT", defaultPort))
+
+    # mpc allows password@host, the password is sent after connecting
+    password = None
+    if "@" in host and not host.startswith("/"):
+        password, host = host.split("@", 1)
+
+    return host, int(port), password
+
+
+class MPDClient:
+
+    def __init__(self, host=None, port=None, timeout=defaultTimeout):
+        self.host, self.port, self.password = mpdAddress(host, port)
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.mpdVersion = ""
+        # the client may be shared by the menu and a background task
+        self.lock = threading.RLock()
+
+    def connect(self):
+        with self.lock:
+            self.disconnect()
+            try:
+                if self.host.startswith("/"):
+                    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    s.settimeout(self.timeout)
+                    s.connect(self.host)
+                else:
+                    s = socket.create_connection((self.host, self.port), self.timeout)
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as ex:
+                raise MPDConnectionError("cannot connect to mpd at " + self.address() + ": " + str(ex))
+
+            self.sock = s
+            self.rfile = s.makefile("rb")
+            hello = self.readLine()
+            if not hello.startswith("OK MPD "):
+                self.disconnect()
+                raise MPDConnectionError("not an mpd server: " + hello)
+            self.mpdVersion = hello[7:]
+
+            if self.password is not None:
+                self.sendAndRead(commandLine("password", [self.password]))
+
+    def disconnect(self):
+        with self.lock:
+            if self.rfile is not None:
+                try:
+                    self.rfile.close()
+                except OSError:
+                    pass
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+            self.sock = None
+            self.rfile = None
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.sendall(b"close\n")
+                except OSError:
+                    pass
+            self.disconnect()
+
+    def address(self):
+        if self.host.startswith("/"):
+            return self.host
+        return self.host + ":" + str(self.port)
+
+    def connected(self):
+        return self.sock is not None
+
+    def readLine(self):
+        l = self.rfile.readline()
+        if not l:
+            raise MPDConnectionError("connection to mpd closed")
+        return l.decode("utf-8", "replace").rstrip("\n")
+
+    # Read key: value pairs up to OK, raise MPDError on ACK
+    def readResponse(self):
+        pairs = []
+        while True:
+            l = self.readLine()
+            if l == "OK":
+                return pairs
+            if l.startswith("ACK "):
+                raise MPDError(l)
+            if l == "list_OK":
+                continue
+            k, sep, v = l.partition(": ")
+            pairs.append((k, v))
+
+    def sendAndRead(self, data):
+        self.sock.sendall(data.encode("utf-8"))
+        return self.readResponse()
+
+    # Send data, reconnecting and resending once if the connection dropped
+    def transact(self, data):
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    return self.sendAndRead(data)
+                except MPDConnectionError:
+                    self.disconnect()
+                    if attempt == 2:
+                        raise
+                except OSError as ex:
+                    self.disconnect()
+                    if attempt == 2:
+                        raise MPDConnectionError(str(ex))
+
+    # Run one command and return its key: value pairs
+    def command(self, cmd, *args):
+        return self.transact(commandLine(cmd, args))
+
+    # Run several commands in one round trip, cmds is a list of tuples
+    # such as [("clear",), ("add", url), ("play",)]
+    def commandList(self, cmds):
+        data = "command_list_begin\n"
+        for c in cmds:
+            data += commandLine(c[0], c[1:])
+        data += "command_list_end\n"
+        return self.transact(data)
+
+    # Same as command but returns the pairs as a dictionary
+    def commandDict(self, cmd, *args):
+        return dict(self.command(cmd, *args))
+
+    def ping(self):
+        self.command("ping")
+
+    def status(self):
+        return self.commandDict("status")
+
+    def currentSong(self):
+        return self.commandDict("currentsong")
+
+    # Stream (file) of the current song, "" when nothing is queued
+    def currentStream(self):
+        return self.currentSong().get("file", "")
+
+    def play(self, pos=None):
+        if pos is None:
+            self.command("play")
+        else:
+            self.command("play", pos)
+
+    def stop(self):
+        self.command("stop")
+
+    # Replace the queue with a single stream and start playing it
+    def playStream(self, stream):
+        self.commandList([("clear",), ("add", stream), ("play",)])
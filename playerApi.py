@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# playerApi.py is the local control socket of streamPlayer.py in daemon
+# mode (python3 streamPlayer.py --daemon), for the alarm clock GUI and
+# scripts. The daemon keeps the stations, the mpd connection and the
+# mixer, so a client costs one socket connection instead of starting
+# python and loading the stations.
+#
+# The socket is a Unix socket (/home/pi/radio/streamPlayer.sock). A
+# request is one line of json, the answer is one line of json:
+#
+#    {"id": 1, "cmd": "play", "station": 12}
+#    {"id": 1, "ok": true, "result": {...}}
+#    {"id": 2, "ok": false, "error": "unknown command: plya"}
+#
+# A line holding a json array is a batch, the commands run in order and
+# the answers come back as one array.
+#
+#    {"cmd": "subscribe", "events": ["nowplaying", "volume"]}
+#
+# sends every later event of those names to the client, as lines like
+# {"event": "volume", "volume": 40, "mute": false}. "unsubscribe" stops
+# them. A client that does not read its events is disconnected once
+# maxBuffer bytes are waiting for it.
+#
+# Used as a script it is a small client:
+#
+#    python3 playerApi.py status
+#    python3 playerApi.py play station=12
+#    python3 playerApi.py --watch nowplaying volume
+#
+#########################
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+
+defaultSocket = "/home/pi/radio/streamPlayer.sock"
+maxLine = 1 << 20
+maxBuffer = 256 * 1024
+
+
+class ApiError(Exception):
+    pass
+
+# what a command raises for a bad request, the other exceptions are
+# passed to onError as well
+badRequest = (ApiError, ValueError, TypeError, KeyError, IndexError)
+
+
+class ApiConnection:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.events = set()
+        self.closed = False
+
+    def send(self, message):
+        if self.closed:
+            return
+        self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+        if self.writer.transport.get_write_buffer_size() > maxBuffer:
+            # not reading, let it go instead of holding memory for it
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+
+
+class ApiServer:
+
+    # commands maps a command name to a function taking the request and
+    # returning the result (or a coroutine giving it). An exception it
+    # raises becomes an error answer, the connection stays open
+    def __init__(self, path, commands):
+        self.path = path
+        self.commands = commands
+        self.server = None
+        self.connections = set()
+        self.requests = 0
+        # called with (request, exception) when a command fails with
+        # anything but a bad request
+        self.onError = None
+
+    async def start(self):
+        try:
+            if os.path.exists(self.path):
+                # left over from a daemon that did not exit cleanly
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self.server = await asyncio.start_unix_server(self.serve, self.path, limit=maxLine)
+        os.chmod(self.path, 0o660)
+        return self
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for c in list(self.connections):
+            c.close()
+        await self.server.wait_closed()
+        self.server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    # Send an event to the clients that subscribed to it
+    def publish(self, event, data):
+        message = None
+        for c in list(self.connections):
+            if event in c.events:
+                if message is None:
+                    message = dict(data)
+                    message["event"] = event
+                c.send(message)
+
+    async def serve(self, reader, writer):
+        c = ApiConnection(reader, writer)
+        self.connections.add(c)
+        try:
+            while not c.closed:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    c.send({"ok": False, "error": "request too long"})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as ex:
+                    c.send({"ok": False, "error": "bad json: " + str(ex)})
+                    continue
+                if isinstance(request, list):
+                    answers = []
+                    for r in request:
+                        answers.append(await self.run(c, r))
+                    c.send(answers)
+                else:
+                    c.send(await self.run(c, request))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.connections.discard(c)
+            c.close()
+
+    async def run(self, c, request):
+        self.requests += 1
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "a request is a json object"}
+        answer = {"ok": True}
+        if "id" in request:
+            answer["id"] = request["id"]
+        cmd = request.get("cmd")
+        try:
+            if cmd == "subscribe":
+                c.events.update(eventNames(request))
+                result = sorted(c.events)
+            elif cmd == "unsubscribe":
+                c.events.difference_update(eventNames(request) or set(c.events))
+                result = sorted(c.events)
+            elif cmd in self.commands:
+                result = self.commands[cmd](request)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            else:
+                raise ApiError("unknown command: " + str(cmd))
+        except Exception as ex:
+            if self.onError is not None and not isinstance(ex, badRequest):
+                self.onError(request, ex)
+            answer["ok"] = False
+            answer["error"] = str(ex) or type(ex).__name__
+            return answer
+        if result is not None:
+            answer["result"] = result
+        return answer
+
+
+def eventNames(request):
+    events = request.get("events", [])
+    if isinstance(events, str):
+        events = [events]
+    return set(str(e) for e in events)
+
+
+#########################
+# client
+
+class ApiClient:
+
+    def __init__(self, path=defaultSocket, timeout=10):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rb")
+        self.nextId = 1
+
+    def send(self, request):
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ApiError("daemon closed the connection")
+        return json.loads(line)
+
+    # Run one command and return its result, events that arrive first
+    # are skipped
+    def call(self, cmd, **args):
+        request = dict(args)
+        request["cmd"] = cmd
+        request["id"] = self.nextId
+        self.nextId += 1
+        self.send(request)
+        while True:
+            answer = self.receive()
+            if isinstance(answer, dict) and "event" in answer:
+                continue
+            if not answer.get("ok"):
+                raise ApiError(answer.get("error", "failed"))
+            return answer.get("result")
+
+    # Run several commands in one round trip, returns the answers
+    def batch(self, requests):
+        self.send(requests)
+        while True:
+            answer = self.receive()
+            if isinstance(answer, list):
+                return answer
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+# key=value arguments, numbers and true/false are converted
+def parseValue(v):
+    if v in ("true", "false"):
+        return v == "true"
+    for t in (int, float):
+        try:
+            return t(v)
+        except ValueError:
+            pass
+    return v
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="talk to streamPlayer.py --daemon")
+    parser.add_argument("--socket", default=defaultSocket, help="control socket of the daemon")
+    parser.add_argument("--watch", action="store_true", help="print the events named instead of running a command")
+    parser.add_argument("cmd", help="command, or event names with --watch")
+    parser.add_argument("args", nargs="*", help="key=value arguments of the command")
+    args = parser.parse_args()
+
+    try:
+        client = ApiClient(args.socket, None if args.watch else 10)
+        if args.watch:
+            client.call("subscribe", events=[args.cmd] + args.args)
+            while True:
+                print(json.dumps(client.receive()))
+        request = {}
+        for a in args.args:
+            k, sep, v = a.partition("=")
+            request[k] = parseValue(v)
+        print(json.dumps(client.call(args.cmd, **request), indent=1))
+        client.close()
+    except (OSError, ApiError) as ex:
+        print("error: " + str(ex))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
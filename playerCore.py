@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# playerCore.py keeps an up to date copy of the mpd state in memory.
+#
+# streamPlayer.py used to ask mpd (through mpc current and a temp file)
+# whenever it needed the current stream, and never found out when some
+# other program changed mpd. The core keeps two connections to mpd:
+#
+#    commands   play, stop, queue changes, ... (AsyncMPDConnection)
+#    idle       waits in the mpd idle command, which answers as soon as
+#               the player, mixer, playlist (queue) or options change
+#
+# When idle reports a change, only the changed part is read again:
+#
+#    player, options   status and currentsong
+#    mixer             status
+#    playlist          status and the queue
+#
+# Reading the state (core.status, core.song, core.queue and the helper
+# methods) costs nothing, no command is sent to mpd. Listeners added with
+# addListener are called with the name of each subsystem that changed.
+#
+# The core runs in an asyncio event loop. startThread runs that loop in
+# a background thread for code that is not asyncio itself.
+#
+#########################
+
+import asyncio
+import threading
+import time
+
+import mpdClient
+
+idleSubsystems = ("player", "mixer", "playlist", "options")
+reconnectDelay = 1.0
+maxReconnectDelay = 30.0
+
+
+class AsyncMPDConnection:
+
+    def __init__(self, host=None, port=None, timeout=mpdClient.defaultTimeout):
+        self.host, self.port, self.password = mpdClient.mpdAddress(host, port)
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.mpdVersion = ""
+        # one command (or command list) on the connection at a time
+        self.lock = asyncio.Lock()
+        # optional streamStats.Stats, round trips are observed as mpd_command
+        self.stats = None
+
+    def address(self):
+        if self.host.startswith("/"):
+            return self.host
+        return self.host + ":" + str(self.port)
+
+    async def connect(self):
+        self.disconnect()
+        try:
+            if self.host.startswith("/"):
+                c = asyncio.open_unix_connection(self.host)
+            else:
+                c = asyncio.open_connection(self.host, self.port)
+            self.reader, self.writer = await asyncio.wait_for(c, self.timeout)
+            hello = await self.readLine()
+        except (OSError, asyncio.TimeoutError) as ex:
+            self.disconnect()
+            raise mpdClient.MPDConnectionError("cannot connect to mpd at " + self.address() + ": " + str(ex))
+        if not hello.startswith("OK MPD "):
+            self.disconnect()
+            raise mpdClient.MPDConnectionError("not an mpd server: " + hello)
+        self.mpdVersion = hello[7:]
+        if self.password is not None:
+            await self.sendAndRead(mpdClient.commandLine("password", [self.password]))
+
+    # Connect now instead of on the first command
+    async def open(self):
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+
+    def disconnect(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+
+    def connected(self):
+        return self.writer is not None
+
+    async def readLine(self):
+        l = await self.reader.readline()
+        if not l:
+            raise mpdClient.MPDConnectionError("connection to mpd closed")
+        return l.decode("utf-8", "replace").rstrip("\n")
+
+    async def readResponse(self):
+        pairs = []
+        while True:
+            l = await self.readLine()
+            if l == "OK":
+                return pairs
+            if l.startswith("ACK "):
+                raise mpdClient.MPDError(l)
+            if l == "list_OK":
+                continue
+            k, sep, v = l.partition(": ")
+            pairs.append((k, v))
+
+    async def sendAndRead(self, data):
+        self.writer.write(data.encode("utf-8"))
+        await self.writer.drain()
+        return await self.readResponse()
+
+    # Send data, reconnecting and resending once if the connection dropped.
+    # A command cancelled while waiting for its answer leaves that answer
+    # on the connection, so the connection is dropped and the next command
+    # opens a new one
+    async def transact(self, data):
+        async with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.writer is None:
+                        await self.connect()
+                    if self.stats is None:
+                        return await self.sendAndRead(data)
+                    start = time.perf_counter()
+                    r = await self.sendAndRead(data)
+                    self.stats.observe("mpd_command", time.perf_counter() - start)
+                    return r
+                except asyncio.CancelledError:
+                    self.disconnect()
+                    raise
+                except (mpdClient.MPDConnectionError, OSError) as ex:
+                    self.disconnect()
+                    if self.stats is not None:
+                        self.stats.count("mpd_connection_errors")
+                    if attempt == 2:
+                        if isinstance(ex, mpdClient.MPDError):
+                            raise
+                        raise mpdClient.MPDConnectionError(str(ex))
+
+    async def command(self, cmd, *args):
+        return await self.transact(mpdClient.commandLine(cmd, args))
+
+    async def commandList(self, cmds):
+        data = "command_list_begin\n"
+        for c in cmds:
+            data += mpdClient.commandLine(c[0], c[1:])
+        data += "command_list_end\n"
+        return await self.transact(data)
+
+    async def commandDict(self, cmd, *args):
+        return dict(await self.command(cmd, *args))
+
+    async def play(self, pos=None):
+        if pos is None:
+            await self.command("play")
+        else:
+            await self.command("play", pos)
+
+    async def stop(self):
+        await self.command("stop")
+
+    async def playStream(self, stream):
+        await self.commandList([("clear",), ("add", stream), ("play",)])
+
+    # Wait for changes, returns the names of the changed subsystems
+    async def idle(self, subsystems):
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+            try:
+                pairs = await self.sendAndRead(mpdClient.commandLine("idle", subsystems))
+            except asyncio.CancelledError:
+                self.disconnect()
+                raise
+        return [v for k, v in pairs if k == "changed"]
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.write(b"close\n")
+            except Exception:
+                pass
+        self.disconnect()
+
+
+class PlayerCore:
+
+    def __init__(self, host=None, port=None):
+        self.mpd = AsyncMPDConnection(host, port)
+        self.idleConnection = AsyncMPDConnection(host, port)
+        self.loop = None
+        self.thread = None
+        self.idleTask = None
+        self.listeners = []
+        self.running = False
+
+        # the mirror of the mpd state
+        self.status = {}
+        self.song = {}
+        self.queue = []
+        self.connected = False
+
+    def addListener(self, f):
+        self.listeners.append(f)
+
+    def removeListener(self, f):
+        if f in self.listeners:
+            self.listeners.remove(f)
+
+    def changed(self, subsystem):
+        for f in list(self.listeners):
+            try:
+                f(subsystem)
+            except Exception:
+                pass
+
+    # reading the mirror
+
+    def currentStream(self):
+        return self.song.get("file", "")
+
+    def state(self):
+        return self.status.get("state", "stop")
+
+    def volume(self):
+        try:
+            return int(self.status.get("volume", "-1"))
+        except ValueError:
+            return -1
+
+    def songPosition(self):
+        try:
+            return int(self.status.get("song", "-1"))
+        except ValueError:
+            return -1
+
+    # True once mpd reports audio for the current stream
+    def audioStarted(self):
+        return self.state() == "play" and "bitrate" in self.status
+
+    # refreshing the mirror
+
+    async def refreshStatus(self):
+        self.status = await self.mpd.commandDict("status")
+
+    async def refreshSong(self):
+        self.song = await self.mpd.commandDict("currentsong")
+
+    async def refreshQueue(self):
+        pairs = await self.mpd.command("playlistinfo")
+        self.queue = [v for k, v in pairs if k == "file"]
+
+    async def refresh(self, subsystems=idleSubsystems):
+        if "playlist" in subsystems:
+            await self.refreshQueue()
+        await self.refreshStatus()
+        if "player" in subsystems or "options" in subsystems or "playlist" in subsystems:
+            await self.refreshSong()
+
+    # Both connections are opened at once. If mpd cannot be reached yet,
+    # the idle loop keeps trying
+    async def start(self):
+        self.running = True
+        try:
+            for r in await asyncio.gather(self.idleConnection.connect(), self.mpd.open(),
+                                          return_exceptions=True):
+                if isinstance(r, Exception):
+                    raise r
+            await self.refresh()
+            self.connected = True
+        except mpdClient.MPDError:
+            self.connected = False
+            self.idleConnection.disconnect()
+        self.idleTask = asyncio.ensure_future(self.idleLoop())
+
+    async def idleLoop(self):
+        delay = reconnectDelay
+        while self.running:
+            try:
+                changed = await self.idleConnection.idle(idleSubsystems)
+                delay = reconnectDelay
+                if changed:
+                    await self.refresh(changed)
+                    for c in changed:
+                        self.changed(c)
+            except asyncio.CancelledError:
+                raise
+            except mpdClient.MPDError:
+                # mpd went away, keep the last known state and try again
+                self.connected = False
+                self.idleConnection.disconnect()
+                self.changed("connection")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, maxReconnectDelay)
+                try:
+                    await self.idleConnection.connect()
+                    await self.refresh()
+                    self.connected = True
+                    self.changed("connection")
+                except mpdClient.MPDError:
+                    pass
+
+    async def stop(self):
+        self.running = False
+        if self.idleTask is not None:
+            self.idleTask.cancel()
+            try:
+                await self.idleTask
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.idleTask = None
+        self.idleConnection.close()
+        self.mpd.close()
+
+    # running the core in a background thread
+
+    def startThread(self, timeout=mpdClient.defaultTimeout):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self.start())
+            except Exception as ex:
+                errors.append(ex)
+                started.set()
+                return
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(timeout)
+        if errors:
+            raise errors[0]
+        return self
+
+    # Run a coroutine on the core's loop from another thread and wait for it
+    def call(self, coroutine, timeout=mpdClient.defaultTimeout):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stopThread(self):
+        if self.loop is None:
+            return
+        try:
+            self.call(self.stop())
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(mpdClient.defaultTimeout)
+        self.loop = None
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# playerState.py remembers what streamPlayer.py was doing (station,
+# volume, mute, playlist), so that after a restart or a power cut it
+# starts the same station without asking mpd.
+#
+# streamPlayer.conf used to be three lines (stream, volume, playlist)
+# rewritten in place on exit, after asking mpd for the current stream.
+# A power cut lost the station, and a cut during the write lost the
+# file. Now the state is a small json file:
+#
+#    {"station": 12, "stream": "http://...", "volume": 60,
+#     "mute": false, "playlist": "all_stations"}
+#
+# It is written to a temporary file, flushed to disk and renamed over
+# the old one, so the file is always either the old or the new state.
+# update does not write at once. The first change starts a timer and
+# every change made before it runs is saved with it, so holding + or
+# zapping through stations writes the file once per debounce seconds at
+# most. flush writes right away (on exit).
+#
+# A streamPlayer.conf in the old three line format is still read.
+#
+#########################
+
+import asyncio
+import json
+import os
+
+defaultDebounce = 1.0
+
+
+# The old streamPlayer.conf: stream, volume and playlist on three lines
+def legacyState(text):
+    lines = text.split("\n")
+    state = {}
+    if lines and lines[0].strip():
+        state["stream"] = lines[0].strip()
+    if len(lines) > 1:
+        try:
+            state["volume"] = int(lines[1].strip())
+        except ValueError:
+            pass
+    if len(lines) > 2 and lines[2].strip():
+        state["playlist"] = lines[2].strip()
+    return state
+
+# Replace fileName with text, never leaving a half written file
+def writeAtomic(fileName, text):
+    tmp = fileName + ".tmp"
+    f = open(tmp, 'w')
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(tmp, fileName)
+    # the rename itself reaches the disk with the directory
+    try:
+        d = os.open(os.path.dirname(os.path.abspath(fileName)), os.O_RDONLY)
+        try:
+            os.fsync(d)
+        finally:
+            os.close(d)
+    except OSError:
+        pass
+
+
+class StateStore:
+
+    def __init__(self, fileName, debounce=defaultDebounce):
+        self.fileName = fileName
+        self.debounce = debounce
+        self.state = {}
+        self.dirty = False
+        self.timer = None
+        self.saves = 0
+        # called with the exception when the state cannot be written
+        self.onError = None
+
+    # Read the saved state, keys missing from the file keep their defaults
+    def load(self, defaults):
+        state = dict(defaults)
+        try:
+            f = open(self.fileName, 'r')
+            text = f.read()
+            f.close()
+        except OSError:
+            self.state = state
+            return state
+
+        try:
+            saved = json.loads(text)
+            if not isinstance(saved, dict):
+                raise ValueError("state is not an object")
+        except ValueError:
+            saved = legacyState(text)
+        for k, v in saved.items():
+            if k in defaults:
+                state[k] = v
+        self.state = state
+        return state
+
+    def get(self, k, default=None):
+        return self.state.get(k, default)
+
+    def update(self, **changes):
+        changed = False
+        for k, v in changes.items():
+            if self.state.get(k) != v:
+                self.state[k] = v
+                changed = True
+        if not changed:
+            return
+        self.dirty = True
+        if self.timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.debounce <= 0:
+            self.save()
+        else:
+            self.timer = loop.call_later(self.debounce, self.save)
+
+    def save(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        try:
+            writeAtomic(self.fileName, json.dumps(self.state, sort_keys=True) + "\n")
+        except OSError as ex:
+            if self.onError is not None:
+                self.onError(ex)
+            return
+        self.dirty = False
+        self.saves += 1
+
+    def flush(self):
+        if self.dirty:
+            self.save()
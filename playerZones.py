@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# playerZones.py drives the mpd of every room (a zone) from one
+# streamPlayer.py, instead of running a copy of streamPlayer.py on each
+# Raspberry Pi with nothing keeping them together.
+#
+# A zone is a name and an mpd address, written name=host[:port] or
+# name=/path/to/mpd/socket:
+#
+#    kitchen=pi-kitchen:6600
+#    den=192.168.1.23
+#
+# The zones are listed one per line in zonesFile (/home/pi/radio/zones.conf
+# for streamPlayer.py). Lines starting with # are skipped.
+#
+# Every zone has a small pool of mpd connections (ConnectionPool), opened
+# when first needed and kept open, so a command to a zone never waits
+# for a connect once the zone has been used, and two commands to the
+# same zone do not wait for each other. All zones are driven from one
+# asyncio event loop, there is no thread per zone.
+#
+# ZoneController sends group commands to all zones (or the ones named)
+# at the same time. A zone that does not answer within timeout seconds
+# is reported as failed and does not hold up the others:
+#
+#    play      the same stream everywhere
+#    syncPlay  loads the stream into every zone first, then sends play to
+#              all zones at the same moment over connections that are
+#              already open, so the rooms start together
+#    stop      stop everywhere
+#    setVolume the volume of one zone, through mpd's setvol, quick
+#              changes are combined (see volumeControl.py)
+#    refresh   the status and current stream of every zone
+#
+# Group commands return {zone name: None or the error}.
+#
+# Used as a script:
+#
+#    python3 playerZones.py --zone kitchen=pi-kitchen --zone den=pi-den play http://...
+#    python3 playerZones.py --zones zones.conf --sync play http://...
+#    python3 playerZones.py --zones zones.conf volume 40 kitchen
+#    python3 playerZones.py --zones zones.conf status
+#
+#########################
+
+import argparse
+import asyncio
+import sys
+
+import mpdClient
+import playerCore
+import volumeControl
+
+defaultPoolSize = 2
+zoneTimeout = 5.0
+
+
+# name=host[:port] or name=/socket, returns (name, host, port)
+def parseZone(s):
+    name, sep, address = s.strip().partition("=")
+    if not sep or not name or not address:
+        raise ValueError("a zone is name=host[:port]: " + s)
+    if address.startswith("/"):
+        return name, address, None
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return name, host, int(port)
+    return name, address, None
+
+def readZones(fileName):
+    zones = []
+    f = open(fileName, 'r')
+    for line in f:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        zones.append(parseZone(line))
+    f.close()
+    return zones
+
+
+class ConnectionPool:
+
+    # Has the command methods of playerCore.AsyncMPDConnection, each one
+    # runs on a free connection of the pool
+    def __init__(self, host=None, port=None, size=defaultPoolSize, timeout=mpdClient.defaultTimeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        self.free = []
+        self.opened = 0
+
+    async def acquire(self):
+        await self.slots.acquire()
+        if self.free:
+            return self.free.pop()
+        self.opened += 1
+        return playerCore.AsyncMPDConnection(self.host, self.port, self.timeout)
+
+    # A connection that was dropped is not kept
+    def release(self, c):
+        if c.connected():
+            self.free.append(c)
+        self.slots.release()
+
+    async def run(self, f, *args):
+        c = await self.acquire()
+        try:
+            return await f(c, *args)
+        finally:
+            self.release(c)
+
+    async def command(self, cmd, *args):
+        return await self.run(lambda c: c.command(cmd, *args))
+
+    async def commandList(self, cmds):
+        return await self.run(lambda c: c.commandList(cmds))
+
+    async def commandDict(self, cmd, *args):
+        return dict(await self.command(cmd, *args))
+
+    def close(self):
+        for c in self.free:
+            c.close()
+        self.free = []
+
+
+class Zone:
+
+    def __init__(self, name, host=None, port=None, poolSize=defaultPoolSize):
+        self.name = name
+        self.pool = ConnectionPool(host, port, poolSize)
+        self.volume = volumeControl.VolumeControl(volumeControl.MPDMixer(self.pool))
+        self.volume.onError = self.volumeFailed
+        # the last status and current stream read by refresh
+        self.status = {}
+        self.stream = ""
+        self.error = None
+
+    def address(self):
+        if self.pool.host is None:
+            return "default"
+        if self.pool.port is None:
+            return self.pool.host
+        return self.pool.host + ":" + str(self.pool.port)
+
+    def volumeFailed(self, ex):
+        self.error = str(ex)
+
+    async def refresh(self):
+        self.status = await self.pool.commandDict("status")
+        self.stream = (await self.pool.commandDict("currentsong")).get("file", "")
+
+    def info(self):
+        return {"zone": self.name, "address": self.address(), "state": self.status.get("state", ""),
+                "volume": self.status.get("volume", ""), "stream": self.stream, "error": self.error}
+
+    async def close(self):
+        await self.volume.close()
+        self.pool.close()
+
+
+class ZoneController:
+
+    # zones is a list of (name, host, port)
+    def __init__(self, zones, timeout=zoneTimeout, poolSize=defaultPoolSize):
+        self.timeout = timeout
+        self.zones = [Zone(name, host, port, poolSize) for name, host, port in zones]
+        self.byName = dict((z.name, z) for z in self.zones)
+
+    # The zones named, all zones for None
+    def select(self, names=None):
+        if names is None:
+            return list(self.zones)
+        zones = []
+        for n in names:
+            if n not in self.byName:
+                raise ValueError("no zone " + str(n))
+            zones.append(self.byName[n])
+        return zones
+
+    # Run f(zone) on every zone at once, returns {name: None or the error}
+    async def each(self, zones, f):
+        async def one(z):
+            try:
+                await asyncio.wait_for(f(z), self.timeout)
+                z.error = None
+            except asyncio.TimeoutError:
+                z.error = "no answer in " + str(self.timeout) + " s"
+            except (mpdClient.MPDError, OSError) as ex:
+                z.error = str(ex)
+            return z.name, z.error
+        return dict(await asyncio.gather(*[one(z) for z in zones]))
+
+    async def play(self, url, names=None):
+        return await self.each(self.select(names),
+                               lambda z: z.pool.commandList([("clear",), ("add", url), ("play",)]))
+
+    # Load url everywhere, then start all zones together
+    async def syncPlay(self, url, names=None):
+        zones = self.select(names)
+        errors = await self.each(zones, lambda z: z.pool.commandList([("clear",), ("add", url)]))
+        ready = [z for z in zones if errors[z.name] is None]
+
+        # one open connection per zone, so play is the only thing sent
+        held = {}
+        async def hold(z):
+            c = await z.pool.acquire()
+            held[z.name] = c
+            await c.open()
+        opened = await self.each(ready, hold)
+        try:
+            errors.update(await self.each([z for z in ready if opened[z.name] is None],
+                                          lambda z: held[z.name].command("play")))
+        finally:
+            for z in ready:
+                if z.name in held:
+                    z.pool.release(held[z.name])
+        for name, error in opened.items():
+            if error is not None:
+                errors[name] = error
+        return errors
+
+    async def stop(self, names=None):
+        return await self.each(self.select(names), lambda z: z.pool.command("stop"))
+
+    # The volume of each zone named, quick changes are combined
+    def setVolume(self, level, names=None):
+        for z in self.select(names):
+            z.volume.set(max(0, min(100, int(level))))
+
+    async def refresh(self, names=None):
+        zones = self.select(names)
+        await self.each(zones, lambda z: z.refresh())
+        return [z.info() for z in zones]
+
+    # Wait for the volume changes still pending
+    async def wait(self):
+        await asyncio.gather(*[z.volume.wait() for z in self.zones])
+
+    async def close(self):
+        for z in self.zones:
+            await z.close()
+
+
+#########################
+
+async def runCommand(args):
+    zones = [parseZone(z) for z in args.zone]
+    if args.zones:
+        zones += readZones(args.zones)
+    if not zones:
+        print("no zones, use --zone name=host[:port] or --zones file")
+        return 1
+    controller = ZoneController(zones)
+    names = args.names or None
+    failed = {}
+    try:
+        if args.cmd == "play":
+            if args.sync:
+                failed = await controller.syncPlay(args.value, names)
+            else:
+                failed = await controller.play(args.value, names)
+        elif args.cmd == "stop":
+            failed = await controller.stop(names)
+        elif args.cmd == "volume":
+            controller.setVolume(int(args.value), names)
+            await controller.wait()
+            failed = dict((z.name, z.error) for z in controller.select(names))
+        elif args.cmd == "status":
+            for info in await controller.refresh(names):
+                print("%-12s %-22s %-6s volume=%-4s %s" % (info["zone"], info["address"], info["state"],
+                                                       info["volume"], info["error"] or info["stream"]))
+        else:
+            print("Unknown command: " + args.cmd)
+            return 1
+    finally:
+        await controller.close()
+    for name, error in failed.items():
+        print(name + ": " + (error or "ok"))
+    return 1 if any(failed.values()) else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="send commands to the mpd of several rooms")
+    parser.add_argument("--zone", action="append", default=[], help="name=host[:port], may be repeated")
+    parser.add_argument("--zones", help="file with one name=host[:port] per line")
+    parser.add_argument("--sync", action="store_true", help="play: start all zones together")
+    parser.add_argument("cmd", help="play url, stop, volume level or status")
+    parser.add_argument("value", nargs="?", default="", help="the url or the volume")
+    parser.add_argument("names", nargs="*", help="zones to send to, all by default")
+    args = parser.parse_args()
+    if args.cmd == "stop" or args.cmd == "status":
+        # there is no value, the first name landed there
+        if args.value:
+            args.names.insert(0, args.value)
+    try:
+        sys.exit(asyncio.run(runCommand(args)))
+    except (OSError, ValueError) as ex:
+        print("error: " + str(ex))
+        sys.exit(1)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# stationCatalog.py compiles all_stations.m3u into a binary catalog that
+# streamPlayer.py can open without parsing the text file.
+#
+# all_stations.m3u has one station per line:
+#
+#    call letters,brief description,long description,stream
+#
+# The long description may contain commas, the stream is the last field.
+#
+# The catalog is stored next to the station file (all_stations.m3u.cat)
+# and is rebuilt when the station file changes. The size and mtime of the
+# station file are checked first. If they changed, the sha1 of the file
+# decides whether the catalog has to be rebuilt or only needs the new
+# mtime.
+#
+# Stations are stored in columns instead of one tuple of four strings per
+# station. Every distinct value is stored once in a value table, so a
+# brief description such as "Rock" or a stream host such as
+# http://ieig-fl.akacast.akamaistream.net is shared by all the stations
+# using it. A station is five value numbers:
+#
+#    call letters, brief, long, stream host, rest of the stream
+#
+# Catalog layout, all integers in native byte order:
+#
+#    header    magic, version, station count, value count, mtime, size, sha1
+#    columns   5 * station count unsigned 32 bit value numbers
+#    offsets   value count + 1 unsigned 32 bit offsets into the values
+#    values    utf-8 values, value k is values[offsets[k]:offsets[k+1]]
+#
+# The file is memory mapped, so opening it costs the same for 44 or
+# 100,000 stations and a station is only decoded when it is used. When
+# the catalog cannot be written, StationStore keeps the same columns in
+# memory.
+#
+#########################
+
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+catalogMagic = b"SPCAT\x00\x00\x00"
+catalogVersion = 2
+# magic, version, byte order, station count, value count, mtime ns, size, sha1
+headerFormat = "=8sHHIIqq20s"
+headerSize = struct.calcsize(headerFormat)
+byteOrderMark = 0x0102
+
+columnCount = 5
+
+
+# Split one line of all_stations.m3u into its four fields
+def parseStationLine(line):
+    l = line.split(',')
+    if len(l) < 4:
+        return None
+    return (l[0], l[1], ",".join(l[2:-1]), l[-1])
+
+def readStationLines(fileName):
+    f = open(fileName, 'r')
+    for line in f:
+        line = line.strip()
+        if line:
+            # line is not blank
+            d = parseStationLine(line)
+            if d is not None:
+                yield d
+    f.close()
+
+def readStationFile(fileName):
+    return list(readStationLines(fileName))
+
+# Split a stream into its host part, which many stations share, and the rest
+def splitStream(stream):
+    i = stream.find("://")
+    if i < 0:
+        return "", stream
+    j = stream.find("/", i + 3)
+    if j < 0:
+        return stream, ""
+    return stream[:j], stream[j:]
+
+def fileHash(fileName):
+    h = hashlib.sha1()
+    f = open(fileName, 'rb')
+    while True:
+        b = f.read(1 << 20)
+        if not b:
+            break
+        h.update(b)
+    f.close()
+    return h.digest()
+
+def catalogFileName(stationFile):
+    return stationFile + ".cat"
+
+
+class StationStore:
+
+    # columns and offsets are arrays of unsigned 32 bit numbers (or casts
+    # of a memory map), values is the buffer the offsets point into
+    def __init__(self, count, columns, offsets, values):
+        self.count = count
+        self.columns = columns
+        self.offsets = offsets
+        self.values = values
+        self.sha1 = None
+
+    def __len__(self):
+        return self.count
+
+    def value(self, k):
+        return str(self.values[self.offsets[k]:self.offsets[k + 1]], "utf-8")
+
+    # field j of station i, 0 call letters, 1 brief, 2 long, 3 stream
+    def field(self, i, j):
+        c = columnCount * i
+        if j == 3:
+            return self.value(self.columns[c + 3]) + self.value(self.columns[c + 4])
+        return self.value(self.columns[c + j])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("station index out of range")
+        c = columnCount * i
+        cols = self.columns
+        v = self.value
+        return (v(cols[c]), v(cols[c + 1]), v(cols[c + 2]),
+                v(cols[c + 3]) + v(cols[c + 4]))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def close(self):
+        pass
+
+
+# Build the columns for stations, storing each distinct value once
+def buildColumns(stations):
+    ids = {}
+    offsets = array.array('I', [0])
+    values = bytearray()
+    columns = array.array('I')
+    count = 0
+
+    def intern(s):
+        k = ids.get(s)
+        if k is None:
+            k = ids[s] = len(offsets) - 1
+            values.extend(s.encode("utf-8"))
+            offsets.append(len(values))
+        return k
+
+    for s in stations:
+        host, rest = splitStream(s[3])
+        columns.extend((intern(s[0]), intern(s[1]), intern(s[2]), intern(host), intern(rest)))
+        count += 1
+    return count, columns, offsets, bytes(values)
+
+def storeStations(stations):
+    return StationStore(*buildColumns(stations))
+
+
+class Catalog(StationStore):
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        f = open(fileName, 'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if len(self.mm) < headerSize:
+            self.mm.close()
+            raise ValueError("catalog too short")
+        h = struct.unpack_from(headerFormat, self.mm, 0)
+        magic, version, bom, count, nValues, self.mtime, self.size, sha1 = h
+        if magic != catalogMagic or version != catalogVersion or bom != byteOrderMark:
+            self.mm.close()
+            raise ValueError("not a station catalog or wrong version")
+
+        a = headerSize
+        b = a + 4 * columnCount * count
+        c = b + 4 * (nValues + 1)
+        if len(self.mm) < c:
+            self.mm.close()
+            raise ValueError("catalog truncated")
+        self.view = memoryview(self.mm)
+        StationStore.__init__(self, count, self.view[a:b].cast('I'),
+                              self.view[b:c].cast('I'), self.view[c:])
+        self.sha1 = sha1
+
+    def close(self):
+        self.columns.release()
+        self.offsets.release()
+        self.values.release()
+        self.view.release()
+        self.mm.close()
+
+
+# Write the catalog for stations to fileName, through a temporary file
+# so a half written catalog is never opened
+def writeCatalog(fileName, stations, mtime, size, sha1):
+    count, columns, offsets, values = buildColumns(stations)
+
+    tmp = fileName + ".tmp"
+    f = open(tmp, 'wb')
+    f.write(struct.pack(headerFormat, catalogMagic, catalogVersion, byteOrderMark,
+                        count, len(offsets) - 1, mtime, size, sha1))
+    f.write(columns.tobytes())
+    f.write(offsets.tobytes())
+    f.write(values)
+    f.close()
+    os.replace(tmp, fileName)
+
+def buildCatalog(stationFile, catalogFile=None):
+    if catalogFile is None:
+        catalogFile = catalogFileName(stationFile)
+    st = os.stat(stationFile)
+    writeCatalog(catalogFile, readStationLines(stationFile), st.st_mtime_ns, st.st_size, fileHash(stationFile))
+    return catalogFile
+
+# Only the mtime changed (file copied or touched), record the new one
+def touchCatalog(catalogFile, mtime):
+    f = open(catalogFile, 'r+b')
+    h = struct.unpack(headerFormat, f.read(headerSize))
+    h = h[:5] + (mtime,) + h[6:]
+    f.seek(0)
+    f.write(struct.pack(headerFormat, *h))
+    f.close()
+
+# Open the catalog for stationFile, compiling it first if it is missing
+# or out of date
+def openCatalog(stationFile, catalogFile=None):
+    if catalogFile is None:
+        catalogFile = catalogFileName(stationFile)
+    st = os.stat(stationFile)
+
+    try:
+        c = Catalog(catalogFile)
+    except (OSError, ValueError):
+        c = None
+
+    if c is not None:
+        if c.mtime == st.st_mtime_ns and c.size == st.st_size:
+            return c
+        if c.size == st.st_size and c.sha1 == fileHash(stationFile):
+            c.close()
+            touchCatalog(catalogFile, st.st_mtime_ns)
+            return Catalog(catalogFile)
+        c.close()
+
+    buildCatalog(stationFile, catalogFile)
+    return Catalog(catalogFile)
+
+# Station list for streamPlayer.py. Falls back to keeping the columns in
+# memory when the catalog cannot be written (read only file system, ...)
+def loadStations(stationFile, catalogFile=None):
+    try:
+        return openCatalog(stationFile, catalogFile)
+    except OSError:
+        return storeStations(readStationLines(stationFile))
+
+
+#########################
+
+if __name__ == "__main__":
+    # python3 stationCatalog.py all_stations.m3u
+    for name in sys.argv[1:]:
+        c = openCatalog(name)
+        print(catalogFileName(name) + ": " + str(len(c)) + " stations")
+        c.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# stationQueue.py loads the stations into the mpd queue once, so that
+# changing stations is a single "play n" instead of clear, add and play.
+#
+# The queue holds all stations, or a window of stations around the
+# current one for very large station lists. When all_stations.m3u
+# changes, the queue is brought up to date by comparing it with the
+# stations and sending only the deletes and adds that are needed.
+#
+# sync and play use a blocking mpd connection (mpdClient.MPDClient),
+# syncAsync and playAsync the asyncio one (playerCore.AsyncMPDConnection).
+#
+# resolve, if given, turns the stream of a station into the url put in
+# the queue (see streamResolver.py).
+#
+# Another mpd client may change the queue, and "play n" would then play
+# whatever is at n without an error. A sync or update ends with status,
+# so the queue knows the mpd playlist version its own commands left. playAsync
+# is given the mirror of the mpd state (playerCore.PlayerCore): when the
+# mirror shows a newer version, the song at n is compared with the
+# station first, which costs no round trip. play has no mirror, it asks
+# for the current song in the same round trip as play. When the song is
+# not the station, the queue is synced again and the station played.
+#
+# A sync never takes away the song playing: playing, if given, is the
+# station playing and the url it plays, which stays in the queue even
+# when the resolver has a newer one for it. update replaces only the
+# entries of streams whose url changed, one delete and addid each, and
+# leaves the song playing for a later update.
+#
+#########################
+
+import difflib
+
+import mpdClient
+
+commandsPerList = 1000
+
+
+# The deletes and adds that turn the queue queued into wanted
+def syncCommands(queued, wanted):
+    cmds = []
+    ops = difflib.SequenceMatcher(None, queued, wanted, autojunk=False).get_opcodes()
+    # from the end, so the positions of earlier songs do not move
+    for tag, i1, i2, j1, j2 in reversed(ops):
+        if tag == "equal":
+            continue
+        if tag in ("delete", "replace"):
+            cmds.append(("delete", str(i1) + ":" + str(i2)))
+        if tag in ("insert", "replace"):
+            for j in range(j2 - 1, j1 - 1, -1):
+                cmds.append(("addid", wanted[j], i1))
+    return cmds
+
+# mpd limits the size of a command list (2 MB by default). The last list
+# ends with status, for the playlist version
+def commandLists(cmds):
+    cmds = cmds + [("status",)]
+    for k in range(0, len(cmds), commandsPerList):
+        yield cmds[k:k + commandsPerList]
+
+def playlistVersion(pairs):
+    for k, v in reversed(pairs):
+        if k == "playlist":
+            return int(v)
+    return None
+
+
+class StationQueue:
+
+    # window is the number of stations kept in the queue, 0 for all
+    def __init__(self, mpd, window=0, resolve=None):
+        self.mpd = mpd
+        self.window = window
+        self.resolve = resolve
+        self.first = 0
+        self.count = 0
+        # the mpd playlist version after the last sync or update, None
+    # before the first sync
+        self.version = None
+
+    # Queue position of station i, or None if it is not in the queue
+    def position(self, i):
+        if self.first <= i < self.first + self.count:
+            return i - self.first
+        return None
+
+    # The url of station i in the queue
+    def url(self, stations, i):
+        if self.resolve is None:
+            return stations[i][3]
+        return self.resolve(stations[i][3])
+
+    # True when the mirror shows that the queue was changed after the
+    # last sync, and the song at pos is not station i
+    def moved(self, mirror, stations, i, pos):
+        try:
+            version = int(mirror.status.get("playlist", ""))
+        except ValueError:
+            return False
+        if self.version is not None and version <= self.version:
+            return False
+        return pos >= len(mirror.queue) or mirror.queue[pos] != self.url(stations, i)
+
+    def wanted(self, stations, first, last, playing=None):
+        if self.resolve is None:
+            wanted = [stations[i][3] for i in range(first, last)]
+        else:
+            wanted = [self.resolve(stations[i][3]) for i in range(first, last)]
+        if playing is not None and first <= playing[0] < last:
+            wanted[playing[0] - first] = playing[1]
+        return wanted
+
+    # The commands that replace the queue entries of the streams in
+    # changed ({stream: (url before, url now)}), and the changes they
+    # take. queued is the queue, keep the position of a song not to
+    # delete (the one playing)
+    def updateCommands(self, stations, queued, changed, keep=None):
+        cmds = []
+        done = {}
+        n = min(len(queued), self.count)
+        for stream, c in changed.items():
+            pos = 0
+            while True:
+                try:
+                    pos = queued.index(c[0], pos, n)
+                except ValueError:
+                    break
+                if stations[self.first + pos][3] == stream:
+                    break
+                pos += 1
+            if pos >= n or queued[pos] != c[0]:
+                # not in the queue, or already replaced
+                done[stream] = c
+            elif pos != keep:
+                cmds += [("delete", str(pos) + ":" + str(pos + 1)), ("addid", c[1], pos)]
+                done[stream] = c
+        return cmds, done
+
+    def windowFor(self, stations, center):
+        n = len(stations)
+        if self.window <= 0 or self.window >= n:
+            return 0, n
+        first = max(0, center - self.window // 2)
+        first = min(first, n - self.window)
+        return first, first + self.window
+
+    # Make the mpd queue match the stations (around center), with as few
+    # commands as possible. queued is the list of streams in the queue if
+    # it is already known, playing (station, url) the song playing.
+    # Returns the number of commands sent
+    def sync(self, stations, center=0, queued=None, playing=None):
+        first, last = self.windowFor(stations, center)
+        wanted = self.wanted(stations, first, last, playing)
+
+        if queued is None:
+            queued = [v for k, v in self.mpd.command("playlistinfo") if k == "file"]
+
+        cmds = syncCommands(queued, wanted)
+        for l in commandLists(cmds):
+            pairs = self.mpd.commandList(l)
+        self.version = playlistVersion(pairs)
+        self.first = first
+        self.count = last - first
+        return len(cmds)
+
+    # Play station i, moving the window first if i is outside it
+    def play(self, stations, i):
+        pos = self.position(i)
+        if pos is None:
+            self.sync(stations, i)
+            pos = self.position(i)
+        song = dict(self.mpd.commandList([("play", pos), ("currentsong",)]))
+        if song.get("file") != self.url(stations, i):
+            # another client changed the queue
+            self.sync(stations, i)
+            self.mpd.play(self.position(i))
+
+    # Replace the entries of the streams in changed, returns the changes
+    # taken
+    def update(self, stations, queued, changed, keep=None):
+        cmds, done = self.updateCommands(stations, queued, changed, keep)
+        if cmds:
+            for l in commandLists(cmds):
+                pairs = self.mpd.commandList(l)
+            self.version = playlistVersion(pairs)
+        return done
+
+    async def syncAsync(self, stations, center=0, queued=None, playing=None):
+        first, last = self.windowFor(stations, center)
+        wanted = self.wanted(stations, first, last, playing)
+
+        if queued is None:
+            queued = [v for k, v in await self.mpd.command("playlistinfo") if k == "file"]
+
+        cmds = syncCommands(queued, wanted)
+        for l in commandLists(cmds):
+            pairs = await self.mpd.commandList(l)
+        self.version = playlistVersion(pairs)
+        self.first = first
+        self.count = last - first
+        return len(cmds)
+
+    async def updateAsync(self, stations, queued, changed, keep=None):
+        cmds, done = self.updateCommands(stations, queued, changed, keep)
+        if cmds:
+            for l in commandLists(cmds):
+                pairs = await self.mpd.commandList(l)
+            self.version = playlistVersion(pairs)
+        return done
+
+    # mirror, if given, is checked for changes made by another client
+    async def playAsync(self, stations, i, mirror=None):
+        pos = self.position(i)
+        if pos is None or (mirror is not None and self.moved(mirror, stations, i, pos)):
+            await self.syncAsync(stations, i)
+            pos = self.position(i)
+        await self.mpd.play(pos)
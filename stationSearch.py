@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# stationSearch.py is the search index behind the s= and f= commands of
+# streamPlayer.py.
+#
+# The call letters, brief and long descriptions of every station are
+# split into lower case words (tokens). The index keeps:
+#
+#    postings   for each token and field, the stations it appears in
+#    forward    for each station, the tokens it contains
+#    sorted     all tokens in order, for prefix matches
+#    trigrams   for each three letter piece, the tokens containing it,
+#               for substring matches and typos
+#
+# A word of the query matches a token exactly, as a prefix, as a
+# substring or, when nothing else matches, with one typo (two for long
+# words). Every word of the query has to match. Stations are ranked by
+# how well the words matched and in which field.
+#
+# The index is saved next to the station catalog (all_stations.m3u.idx)
+# and rebuilt when the catalog changes.
+#
+#########################
+
+import array
+import bisect
+import heapq
+import marshal
+import os
+import re
+
+indexVersion = 2
+
+# a match in the call letters counts more than one in the long description
+fieldWeights = (4.0, 3.0, 1.0)
+
+weightExact = 1.0
+weightPrefix = 0.7
+weightContains = 0.5
+weightTypo = 0.4
+
+# prefix and substring matches are limited to this many tokens
+maxTokenMatches = 64
+# stations scored for each result wanted from a query of several words
+candidatesPerResult = 4
+
+tokenPattern = re.compile(r"[0-9a-z]+")
+
+
+def tokenize(s):
+    return tokenPattern.findall(s.lower())
+
+def trigrams(t):
+    p = "$" + t + "$"
+    return {p[i:i + 3] for i in range(len(p) - 2)}
+
+# Damerau-Levenshtein distance of a and b, or limit + 1 if larger
+def editDistance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        best = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, prev2[j - 2] + 1)
+            cur[j] = d
+            if d < best:
+                best = d
+        if best > limit:
+            return limit + 1
+        prev2 = prev
+        prev = cur
+    return prev[len(b)]
+
+def typoLimit(t):
+    if len(t) < 4:
+        return 0
+    if len(t) < 7:
+        return 1
+    return 2
+
+def indexFileName(stationFile):
+    return stationFile + ".idx"
+
+
+class SearchIndex:
+
+    def __init__(self, data):
+        self.count = data["count"]
+        self.tokens = data["tokens"]
+        self.tokenIds = {t: i for i, t in enumerate(self.tokens)}
+        self.sortedTokens = data["sortedTokens"]
+        self.sortedIds = toArray(data["sortedIds"])
+        self.postings = toArray(data["postings"])
+        self.postingsStart = toArray(data["postingsStart"])
+        self.forward = toArray(data["forward"])
+        self.forwardStart = toArray(data["forwardStart"])
+        self.trigrams = data["trigrams"]
+        self.sha1 = data.get("sha1", b"")
+
+    # the stations of token tid in field f are
+    # postings[postingsStart[3*tid+f]:postingsStart[3*tid+f+1]]
+    def postingsCount(self, tid):
+        return self.postingsStart[3 * tid + 3] - self.postingsStart[3 * tid]
+
+    # (score, start, end) postings segments of the matched tokens, best first
+    def segments(self, matches):
+        segs = []
+        for t, wt in matches.items():
+            for f in range(3):
+                a = self.postingsStart[3 * t + f]
+                b = self.postingsStart[3 * t + f + 1]
+                if a < b:
+                    segs.append((wt * fieldWeights[f], a, b))
+        segs.sort(key=lambda x: (-x[0], x[1]))
+        return segs
+
+    def stations(self, segs):
+        s = set()
+        for sc, a, b in segs:
+            s.update(self.postings[a:b])
+        return s
+
+    # Sum of the best score of each word on station s, using the tokens of
+    # the station itself. 0 if a word does not match
+    def scoreStation(self, s, words):
+        fw = self.forward
+        best = [0.0] * len(words)
+        for k in range(self.forwardStart[s], self.forwardStart[s + 1]):
+            e = fw[k]
+            t = e >> 2
+            f = fieldWeights[e & 3]
+            for i, m in enumerate(words):
+                wt = m.get(t)
+                if wt is not None and wt * f > best[i]:
+                    best[i] = wt * f
+        if all(best):
+            return sum(best)
+        return 0.0
+
+    def trigramTokens(self, tri):
+        b = self.trigrams.get(tri)
+        if b is None:
+            return ()
+        return memoryview(b).cast('I')
+
+    # Tokens matching the query word w, as a {token id: weight} dictionary
+    def matchWord(self, w):
+        matches = {}
+        tid = self.tokenIds.get(w)
+        if tid is not None:
+            matches[tid] = weightExact
+
+        i = bisect.bisect_left(self.sortedTokens, w)
+        n = 0
+        while i < len(self.sortedTokens) and n < maxTokenMatches and self.sortedTokens[i].startswith(w):
+            t = self.sortedIds[i]
+            if t not in matches:
+                matches[t] = weightPrefix
+            i += 1
+            n += 1
+
+        if len(w) >= 3:
+            # tokens containing every trigram of w (without the $ padding)
+            tris = [w[k:k + 3] for k in range(len(w) - 2)]
+            lists = sorted((self.trigramTokens(x) for x in tris), key=len)
+            if lists and len(lists[0]):
+                cand = set(lists[0])
+                for l in lists[1:]:
+                    cand.intersection_update(l)
+                    if not cand:
+                        break
+                n = 0
+                for t in sorted(cand):
+                    if n >= maxTokenMatches:
+                        break
+                    if t not in matches and w in self.tokens[t]:
+                        matches[t] = weightContains
+                        n += 1
+
+        limit = typoLimit(w)
+        if not matches and limit:
+            tris = trigrams(w)
+            shared = {}
+            for x in tris:
+                for t in self.trigramTokens(x):
+                    shared[t] = shared.get(t, 0) + 1
+            need = max(1, len(tris) - 3 * limit)
+            for t, c in shared.items():
+                if c >= need and editDistance(w, self.tokens[t], limit) <= limit:
+                    matches[t] = weightTypo
+        return matches
+
+    # Ranked list of (station index, score), best first
+    def search(self, query, limit=20):
+        words = []
+        for w in tokenize(query):
+            if w not in words:
+                words.append(w)
+        if not words:
+            return []
+
+        matched = []
+        for w in words:
+            m = self.matchWord(w)
+            if not m:
+                # every word has to match
+                return []
+            matched.append((sum(self.postingsCount(t) for t in m), m))
+        matched.sort(key=lambda x: x[0])
+
+        if len(matched) == 1:
+            # a station first seen in the best first segments has its best
+            # score, so the first limit stations are the answer
+            result = []
+            seen = set()
+            for sc, a, b in self.segments(matched[0][1]):
+                for s in self.postings[a:b]:
+                    if s not in seen:
+                        seen.add(s)
+                        result.append((s, sc))
+                        if len(result) >= limit:
+                            return result
+            return result
+
+        # stations matching every word, rarest word first
+        words = [m for n, m in matched]
+        cand = self.stations(self.segments(words[0]))
+        for m in words[1:]:
+            keep = set()
+            for sc, a, b in self.segments(m):
+                keep.update(cand.intersection(self.postings[a:b]))
+            cand = keep
+            if not cand:
+                return []
+
+        # too many to score them all, take the best of the rarest word
+        maxCandidates = max(limit * candidatesPerResult, 64)
+        if len(cand) > maxCandidates:
+            picked = []
+            seen = set()
+            for sc, a, b in self.segments(words[0]):
+                for s in self.postings[a:b]:
+                    if s in cand and s not in seen:
+                        seen.add(s)
+                        picked.append(s)
+                        if len(picked) >= maxCandidates:
+                            break
+                if len(picked) >= maxCandidates:
+                    break
+            cand = picked
+
+        total = [(s, self.scoreStation(s, words)) for s in cand]
+        return heapq.nsmallest(limit, total, key=lambda x: (-x[1], x[0]))
+
+
+def toArray(b):
+    a = array.array('I')
+    a.frombytes(b)
+    return a
+
+# Build the index data for a list (or catalog) of station tuples
+def buildIndexData(stations, sha1=b""):
+    tokenIds = {}
+    tokens = []
+    perToken = []
+    forward = array.array('I')
+    forwardStart = array.array('I', [0])
+
+    count = 0
+    for s, station in enumerate(stations):
+        count += 1
+        entries = set()
+        for field in range(3):
+            for t in tokenize(station[field]):
+                tid = tokenIds.get(t)
+                if tid is None:
+                    tid = tokenIds[t] = len(tokens)
+                    tokens.append(t)
+                    perToken.append(([], [], []))
+                e = tid * 4 + field
+                if e not in entries:
+                    entries.add(e)
+                    perToken[tid][field].append(s)
+        forward.extend(sorted(entries))
+        forwardStart.append(len(forward))
+
+    # call letters first, then brief, then long, by station within
+    postings = array.array('I')
+    postingsStart = array.array('I', [0])
+    for p in perToken:
+        for field in range(3):
+            postings.extend(p[field])
+            postingsStart.append(len(postings))
+
+    tri = {}
+    for tid, t in enumerate(tokens):
+        for x in trigrams(t):
+            tri.setdefault(x, array.array('I')).append(tid)
+
+    order = sorted(range(len(tokens)), key=lambda i: tokens[i])
+    return {"version": indexVersion,
+            "count": count,
+            "sha1": sha1,
+            "tokens": tokens,
+            "sortedTokens": [tokens[i] for i in order],
+            "sortedIds": array.array('I', order).tobytes(),
+            "postings": postings.tobytes(),
+            "postingsStart": postingsStart.tobytes(),
+            "forward": forward.tobytes(),
+            "forwardStart": forwardStart.tobytes(),
+            "trigrams": {k: v.tobytes() for k, v in tri.items()}}
+
+def buildIndex(stations, sha1=b""):
+    return SearchIndex(buildIndexData(stations, sha1))
+
+def writeIndex(fileName, data):
+    tmp = fileName + ".tmp"
+    f = open(tmp, 'wb')
+    marshal.dump(data, f)
+    f.close()
+    os.replace(tmp, fileName)
+
+def readIndex(fileName):
+    f = open(fileName, 'rb')
+    try:
+        data = marshal.load(f)
+    finally:
+        f.close()
+    if not isinstance(data, dict) or data.get("version") != indexVersion:
+        raise ValueError("not a station index or wrong version")
+    return data
+
+# Index for the stations of stationFile. A compiled catalog carries the
+# sha1 of the station file, which decides if the saved index is current
+def loadIndex(stationFile, stations):
+    sha1 = getattr(stations, "sha1", None)
+    if sha1 is None:
+        return buildIndex(stations)
+
+    fileName = indexFileName(stationFile)
+    try:
+        data = readIndex(fileName)
+        if data["sha1"] == sha1 and data["count"] == len(stations):
+            return SearchIndex(data)
+    except (OSError, ValueError, EOFError, KeyError, TypeError):
+        pass
+
+    data = buildIndexData(stations, sha1)
+    try:
+        writeIndex(fileName, data)
+    except OSError:
+        pass
+    return SearchIndex(data)
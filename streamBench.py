@@ -0,0 +1,1943 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# streamBench.py measures how long streamPlayer.py operations take. It
+# runs against fakeMpd.py, so no Raspberry Pi, mpd or speaker is needed.
+#
+# Start the script running using:
+#    python3 streamBench.py [benchmark ...]
+#
+# With no arguments every benchmark is run. Some benchmarks also check
+# what they measured (check lines), the script exits with 1 when a check
+# failed. Benchmarks:
+#    zap    station change: mpc through the shell versus mpdClient.py
+#    check  m3uCheck.py: one urlopen at a time versus checkEngine.py
+#    audio  streams that answer 200 without audio (html pages, empty
+#           bodies): good by status versus the frames checkEngine.py
+#           looks for, the bytes read and the cost of sniffAudio
+#    breaker  a catalog where most sites are down: every stream probed
+#             versus grouped by site with checkEngine.CircuitBreaker
+#    schedule 30 nightly runs over 5000 m3u files: a full sweep every
+#             night versus the due files only (checkHistory.py)
+#    resume   a check run killed at 90%: starting over versus going on
+#             from its journal (checkHistory.CheckJournal), and the files
+#             a resumed run probes and the states it writes
+#    deadline near and far stations and hung hosts: a strict and a loose
+#             fixed timeout versus deadlines from the probe times
+#             (checkEngine.LatencyTracker)
+#    ingest   reading 100k m3u files: listdir and a print per line versus
+#             m3uIngest.py, parsing in 1 to 4 processes and skipping the
+#             unchanged files, and the file each repair writes
+#    startup  loading the station list: text file versus stationCatalog.py
+#    search   s= and f=: linear scan versus stationSearch.py
+#    memory   memory used by the station list: tuples versus StationStore
+#    queue    next/prev: clear, add and play versus play n (stationQueue.py),
+#             and the queue left by a sync, an update and another client
+#    latency  play, next, prev, find and volume as streamPlayer.py does them,
+#             with and without per command latency injected in fakeMpd.py
+#    state    reading the current stream: asking mpd versus playerCore.py
+#    volume   50 quick volume presses: amixer per press versus one mixer
+#             channel (volumeControl.py), against a stub amixer
+#    log      cost of one log message: printMsg with strftime and write
+#             versus streamLog.py
+#    resolve  time to the first audio byte through redirects and
+#             playlists, walking the chain every time versus the final
+#             url from streamResolver.py
+#    boot     streamPlayer.py start up, time until the menu and until
+#             audio: every step after the other versus the steps at the
+#             same time with the saved station played first, and that the
+#             station started first keeps playing through the queue sync
+#    zones    the same station in 2, 10 and 50 rooms (playerZones.py):
+#             one mpd after the other versus all at once, and how far
+#             apart the rooms start
+#    meta     CPU time to read the song titles of a stream (streamMeta.py):
+#             a parser that copies the audio versus memoryview, and the
+#             first title from a local ICY server
+#    titles   reading the title of 200 stations (streamMeta.TitleScanner)
+#             with 1, 16 and 64 sockets, and with the byte rate limited
+#    api      a command through the streamPlayer.py --daemon socket
+#             (playerApi.py): a new python process per command, one
+#             client, batches and many clients at once
+#
+#########################
+
+import ast
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import checkEngine
+import checkHistory
+import fakeMpd
+import fakeStream
+import m3uIngest
+import mpdClient
+import playerApi
+import playerCore
+import playerZones
+import stationCatalog
+import stationQueue
+import stationSearch
+import streamLog
+import streamMeta
+import streamResolver
+import volumeControl
+
+benchmarks = {}
+
+testStream = "http://ieig-fl.akacast.akamaistream.net/7/234/114511/v1/auth.akacast.akamaistream.net/ieig-fl"
+
+
+#########################
+# helpers
+
+def percentile(samples, p):
+    s = sorted(samples)
+    if not s:
+        return 0.0
+    i = int(round((p / 100.0) * (len(s) - 1)))
+    return s[i]
+
+# Print one line of results, times are in milliseconds
+def report(name, samples):
+    ms = [x * 1000.0 for x in samples]
+    print("   %-34s n=%-5d mean=%8.3f  p50=%8.3f  p95=%8.3f  p99=%8.3f ms" %
+          (name, len(ms), sum(ms) / max(len(ms), 1),
+           percentile(ms, 50), percentile(ms, 95), percentile(ms, 99)))
+
+# Write a station file with n stations made from all_stations.m3u
+def makeStationFile(fileName, n):
+    here = os.path.dirname(os.path.abspath(__file__))
+    base = stationCatalog.readStationFile(os.path.join(here, "all_stations.m3u"))
+    f = open(fileName, 'w')
+    for i in range(n):
+        s = base[i % len(base)]
+        k = str(i // len(base))
+        f.write(s[0] + k + "," + s[1] + "," + s[2] + " " + k + "," + s[3] + k + "\n")
+    f.close()
+
+# the checks that failed, streamBench.py exits with 1 if there are any
+failedChecks = []
+
+# Some benchmarks also check that what they timed did the right thing
+def check(name, ok, detail=""):
+    if not ok:
+        failedChecks.append(name)
+    print("   check %-52s %s" % (name, "ok" if ok else "FAILED " + str(detail)))
+
+def timeIt(f, n):
+    samples = []
+    for i in range(n):
+        t = time.perf_counter()
+        f(i)
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+#########################
+# zap: one station change
+
+def benchZap():
+    print("zap: clear + add + play")
+    fake = fakeMpd.FakeMPD().start()
+    env = dict(os.environ)
+    env["MPD_HOST"] = "127.0.0.1"
+    env["MPD_PORT"] = str(fake.port)
+
+    # before: what switchStation used to run
+    limitMPCoutput = " | grep \"[-,'[']\""
+    if shutil.which("mpc"):
+        mpc = "mpc"
+        name = "mpc through the shell"
+    else:
+        # mpc is not installed, so only the cost of forking the shell
+        # pipelines is measured. The real cost is higher
+        mpc = "true"
+        name = "shell pipelines (mpc not found)"
+
+    def before(i):
+        subprocess.call(mpc + " clear", shell=True, env=env, stdout=subprocess.DEVNULL)
+        subprocess.call(mpc + ' insert "' + testStream + '"' + limitMPCoutput, shell=True, env=env, stdout=subprocess.DEVNULL)
+        subprocess.call(mpc + " play " + limitMPCoutput, shell=True, env=env, stdout=subprocess.DEVNULL)
+
+    report(name, timeIt(before, 30))
+
+    # after: one command list over a persistent connection
+    client = mpdClient.MPDClient("127.0.0.1", fake.port)
+    client.connect()
+
+    def after(i):
+        client.playStream(testStream)
+
+    report("mpdClient command list", timeIt(after, 300))
+    client.close()
+    fake.stop()
+
+benchmarks["zap"] = benchZap
+
+
+#########################
+# check: a directory of healthy, slow, failing, hung and dead streams
+
+def checkUrls(server, n):
+    urls = []
+    for i in range(n):
+        k = i % 10
+        if k < 6:
+            urls.append(server.url("/healthy"))
+        elif k < 8:
+            urls.append(server.url("/slow/0.3"))
+        elif k == 8:
+            urls.append(server.url("/error"))
+        elif i % 20 == 9:
+            urls.append(server.url("/hang"))
+        else:
+            urls.append(fakeStream.deadUrl())
+    return urls
+
+def benchCheck():
+    n = 200
+    timeout = 2.0
+    server = fakeStream.FakeStreamServer().start()
+    urls = checkUrls(server, n)
+    print("check: " + str(n) + " streams, 2% hung, 5% dead, 10% errors, 20% slow, timeout " + str(timeout) + "s")
+
+    # before: the old loop, with a timeout added so a hung host cannot
+    # stall it forever. Only the first 40 streams, the rest would take
+    # minutes
+    def before(i):
+        try:
+            urllib.request.urlopen(urls[i], timeout=timeout).close()
+        except Exception:
+            pass
+
+    samples = timeIt(before, 40)
+    print("   one urlopen at a time: %.2fs for 40 streams, about %.0fs for %d" %
+          (sum(samples), sum(samples) * n / 40, n))
+
+    # after: all at once, the fake server is a single host so the
+    # per host limit is raised to the global limit
+    for concurrency in (8, 32, 128):
+        t = time.perf_counter()
+        results = checkEngine.checkUrls(urls, concurrency, concurrency, timeout)
+        elapsed = time.perf_counter() - t
+        counts = {}
+        for r in results:
+            counts[r.result] = counts.get(r.result, 0) + 1
+        print("   checkEngine concurrency %-4d %.2fs for %d streams %s" % (concurrency, elapsed, n, counts))
+
+    server.stop()
+
+benchmarks["check"] = benchCheck
+
+
+#########################
+# audio: what is counted as good, by status or by the audio frames
+
+audioPaths = (("mp3", "healthy", True), ("aac", "aac", True), ("ogg vorbis", "ogg", True),
+              ("hls", "hls", True), ("pls to mp3", "pls/healthy", True),
+              ("html page", "html", False), ("empty body", "empty", False),
+              ("m3u to html", "m3u/html", False), ("404", "error", False))
+
+# what the checker used to do: good when the status is 2xx
+async def statusOnly(url):
+    reader, writer = await checkEngine.openStream(url)
+    try:
+        status, headers, reader = await checkEngine.readHead(reader)
+    finally:
+        checkEngine.closeWriter(writer)
+    return 200 <= status < 300
+
+def benchAudio():
+    print("audio: streams answering 200 with and without audio")
+    server = fakeStream.FakeStreamServer().start()
+
+    async def run():
+        falseGood = 0
+        missed = 0
+        for name, path, audio in audioPaths:
+            url = server.url(path)
+            good = await statusOnly(url)
+            r = await checkEngine.probe(url, 5.0)
+            byFrames = r.result == checkEngine.resultGood
+            if byFrames != audio:
+                missed += 1
+            if good and not audio:
+                falseGood += 1
+            print("   %-12s status %-5s frames %-14s %-7s %4d kbit/s %6d bytes, first byte %.1f ms" %
+                  (name, "good" if good else "bad", r.result, r.codec, r.bitrate, r.bytesRead,
+                   r.firstByte * 1000))
+        print("   good by status without audio: %d, wrong by frames: %d" % (falseGood, missed))
+
+    asyncio.run(run())
+    server.stop()
+
+    # the scan over 16 KB, the most a probe reads
+    html = (fakeStream.htmlPage * 20)[:checkEngine.probeBytes]
+    junk = os.urandom(checkEngine.probeBytes)
+    lateMp3 = junk[:8000] + fakeStream.audioChunk * 20
+    for name, data in (("mp3", fakeStream.audioChunk * 40), ("aac", fakeStream.aacChunk * 44),
+                       ("mp3 after 8 KB of junk", lateMp3), ("html, no audio", html),
+                       ("random bytes", junk)):
+        report("sniffAudio " + name, timeIt(lambda i: checkEngine.sniffAudio(data), 200))
+
+benchmarks["audio"] = benchAudio
+
+
+#########################
+# breaker: many streams on a few sites, most of the sites down
+
+# every host name is the fake server
+class LocalDNS:
+
+    def __init__(self):
+        self.lookups = 0
+
+    async def lookup(self, host, port):
+        self.lookups += 1
+        return "127.0.0.1"
+
+# host names starting with gone are not found
+class GoneDNS(LocalDNS):
+
+    async def lookup(self, host, port):
+        if host.startswith("gone"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return await LocalDNS.lookup(self, host, port)
+
+def siteUrls(server, sites, perSite, dead):
+    urls = []
+    for i in range(sites * perSite):
+        site = i % sites
+        path = "hang" if site < dead else "healthy"
+        urls.append("http://s%d.akacast.site%d.net:%d/%s" % (i, site, server.port, path))
+    return urls
+
+def benchBreaker():
+    sites, perSite, dead = 20, 20, 15
+    timeout = 1.0
+    server = fakeStream.FakeStreamServer().start()
+    server.hangSeconds = 5.0
+    urls = siteUrls(server, sites, perSite, dead)
+    print("breaker: %d streams on %d sites, %d sites hang, timeout %.0fs, 4 per host, 32 at once" %
+          (len(urls), sites, dead, timeout))
+
+    for name, breaker in (("every stream probed", None),
+                          ("breaker after 3", checkEngine.CircuitBreaker(3)),
+                          ("breaker after 3, confirm", checkEngine.CircuitBreaker(3, True))):
+        before = server.requests
+        t = time.perf_counter()
+        results = checkEngine.checkUrls(urls, 32, 4, timeout, breaker=breaker, dns=LocalDNS())
+        elapsed = time.perf_counter() - t
+        good = sum(1 for r in results if r.result == checkEngine.resultGood)
+        skipped = sum(1 for r in results if r.provisional)
+        print("   %-26s %6.2fs, %4d probes sent, %d good, %d not probed" %
+              (name, elapsed, server.requests - before, good, skipped))
+
+    # one dead CDN, probing every stream takes a timeout per round
+    urls = siteUrls(server, 1, 1000, 1)
+    t = time.perf_counter()
+    checkEngine.checkUrls(urls, 32, 4, timeout, breaker=checkEngine.CircuitBreaker(3), dns=LocalDNS())
+    print("   1000 streams on one dead site: about %.0fs probing each, %.2fs with the breaker" %
+          (len(urls) / 4 * timeout, time.perf_counter() - t))
+    checkDeadHost(server, timeout)
+    server.stop()
+
+# One host of a site that is gone or hangs must not cut off the other
+# hosts of the site, their streams come after it in the list
+def checkDeadHost(server, timeout):
+    healthy = ["http://h%d.akacast.site.net:%d/healthy" % (i % 4, server.port) for i in range(20)]
+    gone = ["http://gone%d.akacast.site.net:%d/healthy" % (i % 3, server.port) for i in range(15)]
+    breaker = checkEngine.CircuitBreaker(3)
+    results = checkEngine.checkUrls(gone + healthy, 32, 4, timeout, breaker=breaker, dns=GoneDNS())
+    good = sum(1 for r in results[len(gone):] if r.result == checkEngine.resultGood)
+    check("3 host names not found, siblings still probed", good == len(healthy) and not breaker.trips,
+          "%d of %d good, %d trips" % (good, len(healthy), breaker.trips))
+
+    hung = ["http://hung.akacast.site.net:%d/hang" % server.port] * 20
+    finished = []
+    started = time.monotonic()
+
+    def done(i, r):
+        if i >= len(hung):
+            finished.append(time.monotonic() - started)
+
+    results = checkEngine.checkUrls(hung + healthy, 32, 4, timeout, done, dns=LocalDNS())
+    good = sum(1 for r in results[len(hung):] if r.result == checkEngine.resultGood)
+    last = max(finished or [0.0])
+    check("hung host, siblings not waiting for its probes", good == len(healthy) and last < timeout,
+          "%d of %d good, last after %.2fs" % (good, len(healthy), last))
+
+benchmarks["breaker"] = benchBreaker
+
+
+#########################
+# schedule: nightly runs with a check history
+
+# good, dead or flaky (answers every other night) stations
+def nightResult(kind, night):
+    if kind == "good" or (kind == "flaky" and night % 2 == 0):
+        r = checkEngine.ProbeResult("", checkEngine.resultGood, "", 200, 0.3)
+        r.bytesRead = 4096
+    else:
+        r = checkEngine.ProbeResult("", checkEngine.resultUnreachable, "timed out", 0, 15.0)
+    return r
+
+def benchSchedule():
+    n, nights = 5000, 30
+    kinds = ["good"] * 60 + ["dead"] * 30 + ["flaky"] * 10
+    files = [("s%d.m3u" % i, "http://s%d.example.net/stream" % i) for i in range(n)]
+    kind = dict((k, kinds[i % len(kinds)]) for i, (k, u) in enumerate(files))
+    print("schedule: %d m3u files, 60%% good, 30%% dead, 10%% flaky, %d nights" % (n, nights))
+
+    start = time.time()
+    history = checkHistory.CheckHistory()
+    probes = 0
+    busy = 0.0
+    planTimes = []
+    for night in range(nights):
+        now = start + night * 86400.0
+        t = time.perf_counter()
+        keys = history.plan(files, now)
+        planTimes.append(time.perf_counter() - t)
+        probes += len(keys)
+        streams = dict(files)
+        for k in keys:
+            r = nightResult(kind[k], night)
+            busy += r.seconds
+            history.record(k, streams[k], r, now)
+    oldest = max(now - e["checked"] for e in history.entries.values() if e["result"] == "good")
+    full = sum(nightResult(kind[k], night).seconds for night in range(nights) for k, u in files)
+    print("   full sweep every night        %7d probes, %6.0f probe hours" % (n * nights, full / 3600))
+    print("   due files only                %7d probes, %6.0f probe hours (%.0f%%), oldest good check %.1f days" %
+          (probes, busy / 3600, 100.0 * probes / (n * nights), oldest / 86400))
+    report("plan " + str(n) + " files", planTimes)
+
+benchmarks["schedule"] = benchSchedule
+
+
+#########################
+# resume: a run killed near its end
+
+def benchResume():
+    n = 2000
+    server = fakeStream.FakeStreamServer().start()
+    urls = [server.url("/slow/0.2") for i in range(n)]
+    keys = ["s%d.m3u" % i for i in range(n)]
+    d = tempfile.mkdtemp()
+    journal = checkHistory.CheckJournal(checkHistory.journalFileName(d))
+    print("resume: %d streams taking 0.2 s each, 64 at once, the run is killed at 90%%" % n)
+
+    async def killedRun():
+        killed = asyncio.Event()
+        journal.start(keys)
+
+        def done(i, r):
+            journal.add(keys[i], urls[i], r, time.time())
+            if journal.records >= n * 9 // 10:
+                killed.set()
+
+        task = asyncio.ensure_future(checkEngine.checkAll(urls, 64, 64, 5.0, done))
+        await killed.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # what a kill leaves: the lines written so far, never synced
+        journal.f.close()
+        journal.f = None
+
+    t = time.perf_counter()
+    asyncio.run(killedRun())
+    print("   killed run                    %6.2fs, %d results in the journal" % (time.perf_counter() - t, journal.records))
+
+    t = time.perf_counter()
+    checkEngine.checkUrls(urls, 64, 64, 5.0)
+    print("   starting over                 %6.2fs" % (time.perf_counter() - t))
+
+    t = time.perf_counter()
+    header, results = checkHistory.CheckJournal(journal.fileName).read()
+    left = [urls[keys.index(k)] for k in checkHistory.unfinished(header, results, keys)]
+    checkEngine.checkUrls(left, 64, 64, 5.0)
+    print("   going on from the journal     %6.2fs, %d streams checked" % (time.perf_counter() - t, len(left)))
+
+    # the cost of one result, flushed every time and synced once a second
+    r = checkEngine.ProbeResult(urls[0], checkEngine.resultGood, "HTTP 200", 200, 0.2)
+    journal.start(keys)
+    report("journal add", timeIt(lambda i: journal.add(keys[i % n], urls[0], r, time.time()), 5000))
+    journal.remove()
+    shutil.rmtree(d)
+    for cut in ("killed", "torn last line", "last lines lost"):
+        checkResume(server, cut)
+    server.stop()
+
+def fileState(directory, name):
+    text, st = m3uIngest.readText(os.path.join(directory, name))
+    return m3uIngest.parseM3u(text, name)[2]
+
+# A run over m3u files killed after two thirds of them, the files of its
+# last three results not written yet, then resumed as m3uCheck.py
+# --resume does it. cut is what the kill did to the journal
+def checkResume(server, cut):
+    n = 60
+    d = tempfile.mkdtemp()
+    expected = {}
+    for i in range(n):
+        name = "s%03d.m3u" % i
+        failed = i % 5 == 0
+        expected[name] = checkEngine.resultFailed if failed else checkEngine.resultGood
+        f = open(os.path.join(d, name), 'w')
+        f.write(server.url("error" if failed else "slow/0.05") + "\n")
+        f.close()
+    index = m3uIngest.M3uIndex()
+    files = index.ingest(d)
+    keys = list(files.names)
+    journal = checkHistory.CheckJournal(checkHistory.journalFileName(d))
+    journaled = []
+
+    async def killedRun():
+        killed = asyncio.Event()
+        # never saved, the run dies first
+        history = checkHistory.CheckHistory(checkHistory.historyFileName(d))
+        journal.start(keys)
+
+        def done(i, r):
+            if killed.is_set():
+                return
+            journal.add(keys[i], files.streams[i], r, time.time())
+            history.record(keys[i], files.streams[i], r)
+            journaled.append(keys[i])
+            if len(journaled) <= n * 2 // 3 - 3:
+                index.setState(d, keys[i], r.result)
+            if len(journaled) >= n * 2 // 3:
+                killed.set()
+
+        task = asyncio.ensure_future(checkEngine.checkAll(files.streams, 8, 8, 5.0, done))
+        await killed.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        journal.f.close()
+        journal.f = None
+
+    asyncio.run(killedRun())
+    f = open(journal.fileName, 'rb')
+    lines = f.read().split(b"\n")[:-1]
+    f.close()
+    finished = list(journaled)
+    if cut == "torn last line":
+        data = b"\n".join(lines[:-1]) + b"\n" + lines[-1][:len(lines[-1]) // 2]
+        finished = journaled[:-1]
+    elif cut == "last lines lost":
+        data = b"\n".join(lines[:-5]) + b"\n"
+        finished = journaled[:-5]
+    else:
+        data = b"\n".join(lines) + b"\n"
+    f = open(journal.fileName, 'wb')
+    f.write(data)
+    f.close()
+
+    # the next run
+    history = checkHistory.CheckHistory(checkHistory.historyFileName(d))
+    history.load()
+    index = m3uIngest.M3uIndex()
+    files = index.ingest(d)
+
+    def apply(key, stream, result):
+        i = files.at.get(key)
+        if i is not None and files.streams[i] == stream and files.states[i] != result:
+            index.setState(d, key, result)
+
+    header, recovered = journal.recover(history, apply)
+    left = checkHistory.unfinished(header, recovered, files.at)
+    got = dict((k, e["result"]) for k, e in history.entries.items())
+    check("resume, %s: the journal in the history" % cut, got == dict((k, expected[k]) for k in finished),
+          "%d of %d" % (len(got), len(finished)))
+    wrong = [k for k in finished if fileState(d, k) != expected[k]]
+    check("resume, %s: their states in the files" % cut, not wrong, wrong[:3])
+
+    probed = []
+
+    def done(i, r):
+        probed.append(left[i])
+        index.setState(d, left[i], r.result)
+
+    checkEngine.checkUrls([files.streams[files.at[k]] for k in left], 8, 8, 5.0, done)
+    check("resume, %s: only the files not finished probed" % cut,
+          sorted(probed) == sorted(set(keys) - set(finished)), "%d probed, %d not finished" %
+          (len(probed), n - len(finished)))
+    wrong = [k for k in keys if fileState(d, k) != expected[k]]
+    check("resume, %s: every file has its state" % cut, not wrong, wrong[:3])
+    shutil.rmtree(d)
+
+benchmarks["resume"] = benchResume
+
+
+#########################
+# deadline: fixed timeouts versus deadlines from the probe times
+
+def deadlineUrls(server):
+    urls = []
+    kinds = []
+    for kind, path, sites, perSite in (("near", "healthy", 20, 20), ("far", "slow/2.5", 4, 10),
+                                       ("hung", "hang", 4, 10)):
+        for i in range(sites * perSite):
+            urls.append("http://s%d.%s%d.net:%d/%s" % (i, kind, i % sites, server.port, path))
+            kinds.append(kind)
+    return urls, kinds
+
+def benchDeadline():
+    timeout = 5.0
+    server = fakeStream.FakeStreamServer().start()
+    server.hangSeconds = 10.0
+    urls, kinds = deadlineUrls(server)
+    print("deadline: 400 near streams, 40 far ones answering after 2.5s and 40 hung ones, 32 at once")
+
+    for name, fixed, latency in (("fixed 2s", 2.0, None), ("fixed 5s", timeout, None),
+                                 ("deadlines, at most 5s", timeout, checkEngine.LatencyTracker())):
+        finished = {}
+        t = time.perf_counter()
+
+        def done(i, r):
+            finished[i] = time.perf_counter() - t
+
+        results = checkEngine.checkUrls(urls, 32, 4, fixed, done, dns=LocalDNS(), latency=latency)
+        elapsed = time.perf_counter() - t
+        near = max(finished[i] for i, k in enumerate(kinds) if k == "near")
+        far = collections.Counter(r.result for r, k in zip(results, kinds) if k == "far")
+        hung = collections.Counter(r.result for r, k in zip(results, kinds) if k == "hung")
+        print("   %-22s %5.1fs, near ones done after %4.1fs, far: %s, hung: %s" %
+              (name, elapsed, near, dict(far), dict(hung)))
+    checkDeadlines(server)
+    server.stop()
+
+# A probe that ran out of the whole timeout is not probed again, and the
+# time it waited counts in the percentiles
+def checkDeadlines(server):
+    timeout = 2.0
+    latency = checkEngine.LatencyTracker()
+    host = "hung.example.net"
+    for i in range(checkEngine.minSamples):
+        # connected at once, audio after a second: a connect deadline
+        # below timeout, the whole probe deadline is timeout
+        r = checkEngine.ProbeResult("", checkEngine.resultGood)
+        r.connect = 0.01
+        r.firstByte = 1.0
+        latency.observe(host, r)
+    connect, whole = latency.deadlines(host, timeout)
+    url = "http://%s:%d/hang" % (host, server.port)
+    t = time.perf_counter()
+    results = checkEngine.checkUrls([url], 32, 4, timeout, dns=LocalDNS(), latency=latency)
+    elapsed = time.perf_counter() - t
+    check("timed out at timeout, not probed again", results[0].timedOut and latency.retried == 0 and
+          elapsed < 1.5 * timeout, "deadlines %.1fs and %.1fs, %d retried, %.1fs" %
+          (connect, whole, latency.retried, elapsed))
+
+    latency = checkEngine.LatencyTracker()
+    checkEngine.checkUrls([url] * 4, 32, 4, 0.5, dns=LocalDNS(), latency=latency)
+    h = latency.hosts.get(host)
+    check("timed out probes counted at the time waited", h is not None and len(h.firstByte) == 4 and
+          h.p95()[1] >= 0.5, None if h is None else h.p95())
+
+benchmarks["deadline"] = benchDeadline
+
+
+#########################
+# ingest: reading a directory of 100k m3u files
+
+# what m3uCheck.py used to do for every file, a print per line
+def readM3uLines(fileName):
+    lines = []
+    stream = None
+    state = None
+    i = 0
+    f = open(fileName, 'r')
+    for line in f:
+        line = line.strip()
+        if not line:
+            # skip blank lines
+            print("    skip blank lines")
+            continue
+        elif line.startswith('#'):
+            if line.startswith('#EXTM3U'):
+                if line.startswith('#EXTM3U:'):
+                    # checked before, the state is written again after
+                    # the next check
+                    state = line[len('#EXTM3U:'):].strip()
+                    line = '#EXTM3U'
+                if i == 0:
+                    lines.append(line)
+                    print("   " + line)
+                    i += 1
+                else:
+                    print("file does not start with #EXTM3U: " + line)
+                    continue
+            elif line.startswith('#EXTINF:'):
+                if i == 1:
+                    lines.append(line)
+                    print("   " + line)
+                    i += 1
+                else:
+                    print("second line is not #EXTINF: " + line)
+                    continue
+            else:
+                # skip other # lines as comments
+                print("skipping comments: " + line)
+                continue
+        elif i == 2:
+            stream = line
+            lines.append(line)
+            print("   " + line)
+            i += 1
+        else:
+            print("too many lines: " + line)
+            lines.append(line)
+            print("   " + line)
+            i += 1
+            continue
+    f.close()
+
+    return lines, stream, state
+
+# n m3u files as they come from the internet: a quarter in the m3u form,
+# the others without #EXTM3U, without #EXTINF or with blank lines and
+# comments
+def makeM3uTree(directory, n):
+    for i in range(n):
+        url = "http://s%d.example%d.net:8000/stream" % (i, i % 500)
+        k = i % 4
+        if k == 0:
+            text = "#EXTM3U\n#EXTINF:-1,Station %d\n%s\n" % (i, url)
+        elif k == 1:
+            text = url + "\n"
+        elif k == 2:
+            text = "#EXTM3U: good\n\n%s\n" % url
+        else:
+            text = "#EXTM3U\n# from a directory\n\n#EXTINF:-1,Station %d\n\n%s\n\n" % (i, url)
+        f = open(os.path.join(directory, "station%06d.m3u" % i), 'w')
+        f.write(text)
+        f.close()
+
+# (file name, text, the file after ingest, stream, state) for every
+# repair m3uIngest.py makes
+m3uRepairs = (
+    ("form", "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "http://a", None),
+    ("bom", "\ufeff#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "http://a", None),
+    ("bomcrlf", "\ufeff#EXTM3U: good\r\n#EXTINF:-1,X\r\nhttp://a\r\n", "#EXTM3U: good\n#EXTINF:-1,X\nhttp://a\n",
+     "http://a", "good"),
+    ("bare", "http://a\n", "#EXTM3U\n#EXTINF:-1,bare\nhttp://a\n", "http://a", None),
+    ("noinf", "#EXTM3U\nhttp://a\n", "#EXTM3U\n#EXTINF:-1,noinf\nhttp://a\n", "http://a", None),
+    ("extra", "#EXTM3U\n# from a directory\n\n#EXTINF:-1,X\n\n  http://a  \n\n#EXTM3U\n",
+     "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "http://a", None),
+    ("more", "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n#EXTINF:-1,Y\nhttp://b\n",
+     "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n#EXTINF:-1,Y\nhttp://b\n", "http://a", None),
+    ("state", "#EXTM3U: no audio\nhttp://a\n", "#EXTM3U: no audio\n#EXTINF:-1,state\nhttp://a\n", "http://a",
+     "no audio"),
+    ("nospace", "#EXTM3U:unreachable\n#EXTINF:-1,X\nhttp://a\n", "#EXTM3U: unreachable\n#EXTINF:-1,X\nhttp://a\n",
+     "http://a", "unreachable"),
+    ("emptystate", "#EXTM3U:\n#EXTINF:-1,X\nhttp://a\n", "#EXTM3U\n#EXTINF:-1,X\nhttp://a\n", "http://a", None),
+    ("twostates", "#EXTM3U: good\n#EXTM3U: slow\n#EXTINF:-1,X\nhttp://a\n",
+     "#EXTM3U: good\n#EXTINF:-1,X\nhttp://a\n", "http://a", "good"),
+    ("nostream", "#EXTM3U\n# nothing here\n", "#EXTM3U\n", None, None),
+)
+
+def checkRepairs():
+    d = tempfile.mkdtemp()
+    for name, text, fixed, stream, state in m3uRepairs:
+        f = open(os.path.join(d, name + ".m3u"), 'wb')
+        f.write(text.encode("utf-8"))
+        f.close()
+    batch = m3uIngest.M3uIndex().ingest(d, 1)
+    for name, text, fixed, stream, state in m3uRepairs:
+        f = open(os.path.join(d, name + ".m3u"), 'rb')
+        written = f.read().decode("utf-8")
+        f.close()
+        i = batch.at.get(name + ".m3u")
+        got = (written, None if i is None else batch.streams[i], None if i is None else batch.states[i])
+        check("m3u repair " + name, got == (fixed, stream, state), repr(got))
+    repaired = sum(1 for r in m3uRepairs if r[1] != r[2])
+    check("m3u repairs written", batch.repaired == repaired, "%d of %d" % (batch.repaired, repaired))
+    shutil.rmtree(d)
+
+def benchIngest():
+    n = 100000
+    d = tempfile.mkdtemp()
+    t = time.perf_counter()
+    makeM3uTree(d, n)
+    print("ingest: %d m3u files (written in %.1fs), %d cpus" % (n, time.perf_counter() - t, os.cpu_count() or 1))
+
+    def rate(name, seconds, extra=""):
+        print("   %-34s %6.2fs %8.0f files/s%s" % (name, seconds, n / seconds, extra))
+
+    # the prints go nowhere, on a terminal they cost more
+    t = time.perf_counter()
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for file in sorted(os.listdir(d)):
+            if file.endswith(".m3u"):
+                print(file)
+                readM3uLines(os.path.join(d, file))
+    rate("listdir, line by line, print", time.perf_counter() - t)
+
+    fileName = m3uIngest.indexFileName(d)
+    index = m3uIngest.M3uIndex(fileName)
+    batch = index.ingest(d, 1)
+    rate("first run: parse and repair", batch.seconds, ", %d repaired" % batch.repaired)
+    index.save()
+
+    for workers in sorted(set((1, 2, 4, os.cpu_count() or 1))):
+        batch = m3uIngest.M3uIndex().ingest(d, workers)
+        rate("parse, %d process%s" % (workers, "es" if workers > 1 else ""), batch.seconds)
+
+    t = time.perf_counter()
+    index = m3uIngest.M3uIndex(fileName)
+    index.load()
+    load = time.perf_counter() - t
+    batch = index.ingest(d, 1)
+    rate("unchanged: index and scandir", load + batch.seconds,
+         " (index %.0f KB, load %.2fs)" % (os.path.getsize(fileName) / 1024.0, load))
+
+    # a night where 1% of the files changed
+    for i in range(0, n, 100):
+        f = open(os.path.join(d, "station%06d.m3u" % i), 'a')
+        f.write("\n")
+        f.close()
+    batch = index.ingest(d, 1)
+    rate("1% changed", load + batch.seconds, ", %d parsed" % batch.parsed)
+    print("   %d streams go to the prober" % len(batch))
+    shutil.rmtree(d)
+    checkRepairs()
+
+benchmarks["ingest"] = benchIngest
+
+
+#########################
+# startup: load the station list and show the first station
+
+# what init() used to do
+def readStationsText(fileName):
+    stationList = list()
+    f = open(fileName, 'r')
+    for line in f:
+        line = line.strip()
+        if line:
+            l = line.split(',')
+            d = (l[0],l[1],l[2],l[3])
+            stationList.append(d)
+    f.close()
+    return stationList
+
+def benchStartup():
+    print("startup: load stations and read station 0")
+    d = tempfile.mkdtemp()
+    for n in (44, 1000, 10000, 100000):
+        fileName = os.path.join(d, "stations" + str(n) + ".m3u")
+        makeStationFile(fileName, n)
+
+        text = timeIt(lambda i: readStationsText(fileName)[0], 5)
+
+        t = time.perf_counter()
+        stationCatalog.buildCatalog(fileName)
+        build = time.perf_counter() - t
+
+        def cached(i):
+            c = stationCatalog.openCatalog(fileName)
+            c[0]
+            c.close()
+
+        warm = timeIt(cached, 50)
+        print("   %6d stations: text %8.2f ms, catalog %6.3f ms (compile once %7.2f ms)" %
+              (n, percentile(text, 50) * 1000, percentile(warm, 50) * 1000, build * 1000))
+        os.remove(fileName)
+        os.remove(stationCatalog.catalogFileName(fileName))
+    os.rmdir(d)
+
+benchmarks["startup"] = benchStartup
+
+
+#########################
+# search: queries on a 100k station catalog
+
+def benchSearch():
+    n = 100000
+    print("search: " + str(n) + " stations")
+    d = tempfile.mkdtemp()
+    fileName = os.path.join(d, "stations.m3u")
+    makeStationFile(fileName, n)
+    stations = stationCatalog.openCatalog(fileName)
+
+    t = time.perf_counter()
+    stationSearch.loadIndex(fileName, stations)
+    print("   build and save index %.0f ms" % ((time.perf_counter() - t) * 1000))
+    t = time.perf_counter()
+    index = stationSearch.loadIndex(fileName, stations)
+    print("   load saved index     %.0f ms" % ((time.perf_counter() - t) * 1000))
+
+    # what s= used to do
+    def linear(i):
+        return [k for k, s in enumerate(stations) if "Detroit" in s[1]]
+
+    report("linear scan 'Detroit'", timeIt(linear, 3))
+
+    for q in ("imot-fl1234", "detroit", "Detroit 1234", "kbco live", "alternativ",
+              "detriot", "altrenative", "80s", "rock", "classic rock oldies"):
+        r = index.search(q, 20)
+        report("index %-20s %3d hits" % ("'" + q + "'", len(r)), timeIt(lambda i: index.search(q, 20), 200))
+
+    stations.close()
+    for f in os.listdir(d):
+        os.remove(os.path.join(d, f))
+    os.rmdir(d)
+
+benchmarks["search"] = benchSearch
+
+
+#########################
+# memory: python memory held by the station list
+
+def heldBy(load):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    stations = load()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return stations, held
+
+def benchMemory():
+    print("memory: python memory held by the station list")
+    d = tempfile.mkdtemp()
+    for n in (10000, 100000):
+        fileName = os.path.join(d, "stations" + str(n) + ".m3u")
+        makeStationFile(fileName, n)
+        stationCatalog.buildCatalog(fileName)
+
+        tuples, a = heldBy(lambda: readStationsText(fileName))
+        store, b = heldBy(lambda: stationCatalog.storeStations(stationCatalog.readStationLines(fileName)))
+        catalog, c = heldBy(lambda: stationCatalog.openCatalog(fileName))
+        assert tuples[n // 2] == store[n // 2] == catalog[n // 2]
+
+        size = os.path.getsize(fileName)
+        catSize = os.path.getsize(stationCatalog.catalogFileName(fileName))
+        print("   %6d stations (%5.1f MB file): tuples %6.1f MB, StationStore %5.1f MB, catalog %5.3f MB + %4.1f MB mapped" %
+              (n, size / 1e6, a / 1e6, b / 1e6, c / 1e6, catSize / 1e6))
+        catalog.close()
+        os.remove(fileName)
+        os.remove(stationCatalog.catalogFileName(fileName))
+    os.rmdir(d)
+
+benchmarks["memory"] = benchMemory
+
+
+#########################
+# queue: next and previous with the stations loaded in the mpd queue
+
+def benchQueue():
+    print("queue: next/prev over 1000 stations")
+    fake = fakeMpd.FakeMPD().start()
+    client = mpdClient.MPDClient("127.0.0.1", fake.port)
+    d = tempfile.mkdtemp()
+    fileName = os.path.join(d, "stations.m3u")
+    makeStationFile(fileName, 1000)
+    stations = stationCatalog.storeStations(stationCatalog.readStationLines(fileName))
+
+    report("clear + add + play", timeIt(lambda i: client.playStream(stations[i % 1000][3]), 500))
+
+    q = stationQueue.StationQueue(client)
+    t = time.perf_counter()
+    n = q.sync(stations)
+    print("   first sync: %d commands, %.1f ms" % (n, (time.perf_counter() - t) * 1000))
+    report("play n", timeIt(lambda i: q.play(stations, i % 1000), 500))
+
+    # a few stations added, removed and changed
+    changed = list(stations)
+    del changed[100:105]
+    changed.insert(500, ("NEW", "new", "new station", "http://new.example.com/stream"))
+    changed[900] = ("CHG", "changed", "changed stream", "http://changed.example.com/stream")
+    t = time.perf_counter()
+    n = q.sync(changed)
+    print("   re-sync after 7 edits: %d commands, %.1f ms" % (n, (time.perf_counter() - t) * 1000))
+
+    w = stationQueue.StationQueue(client, 100)
+    w.sync(stations, 0)
+    report("play n, window of 100", timeIt(lambda i: w.play(stations, (i * 7) % 1000), 200))
+
+    client.close()
+    fake.stop()
+    os.remove(fileName)
+    os.rmdir(d)
+    checkQueue()
+
+# The fakeMpd queue and the song playing after a sync, an update of the
+# urls the resolver changed and an edit by another client, with play and
+# with playAsync
+def checkQueue():
+    stations = [("S%d" % i, "s%d" % i, "station %d" % i, "http://s%d.example.net/stream" % i) for i in range(50)]
+    urls = {}
+
+    def resolve(stream):
+        return urls.get(stream, stream)
+
+    def wanted():
+        return [resolve(s[3]) for s in stations]
+
+    def fakeState(fake):
+        with fake.lock:
+            queue = [e["file"] for e in fake.queue]
+            song = queue[fake.song] if fake.state == "play" and 0 <= fake.song < len(queue) else None
+            return queue, song, fake.playlistVersion
+
+    # the resolver gives a new url for stations 10 and 20, 10 is playing
+    def newUrls():
+        changed = {}
+        for i in (10, 20):
+            stream = stations[i][3]
+            urls[stream] = stream + "?token=" + str(len(urls))
+            changed[stream] = (stream, urls[stream])
+        return changed
+
+    def checkSync(how, fake, q):
+        queue, song, version = fakeState(fake)
+        check(how + ": fresh sync, queue", queue == wanted() and q.version == version,
+              "%d entries, version %s of %s" % (len(queue), q.version, version))
+
+    def checkUpdate(how, fake, q, done, before):
+        queue, song, version = fakeState(fake)
+        expect = wanted()
+        expect[10] = before
+        check(how + ": update, queue and song", queue == expect and song == before and list(done) == [stations[20][3]],
+              "song %s, %d of %d entries right" % (song, sum(1 for a, b in zip(queue, expect) if a == b), len(expect)))
+        check(how + ": update, playlist version", q.version == version, "%s of %s" % (q.version, version))
+
+    def checkOther(how, fake):
+        queue, song, version = fakeState(fake)
+        check(how + ": queue edited by another client", queue == wanted() and song == resolve(stations[30][3]),
+              "song %s" % song)
+
+    def edit(fake):
+        other = mpdClient.MPDClient("127.0.0.1", fake.port)
+        other.command("delete", "0:3")
+        other.command("addid", "http://other.example.net/stream", "5")
+        other.close()
+
+    urls.clear()
+    fake = fakeMpd.FakeMPD().start()
+    client = mpdClient.MPDClient("127.0.0.1", fake.port)
+    client.command("add", "http://left.example.net/stream")
+    q = stationQueue.StationQueue(client, resolve=resolve)
+    q.sync(stations)
+    checkSync("play", fake, q)
+    q.play(stations, 10)
+    before = fakeState(fake)[1]
+    queued = fakeState(fake)[0]
+    done = q.update(stations, queued, newUrls(), 10)
+    checkUpdate("play", fake, q, done, before)
+    edit(fake)
+    q.play(stations, 30)
+    checkOther("play", fake)
+    client.close()
+    fake.stop()
+
+    async def run():
+        urls.clear()
+        fake = fakeMpd.FakeMPD().start()
+        core = playerCore.PlayerCore("127.0.0.1", fake.port)
+        await core.mpd.open()
+        await core.mpd.command("add", "http://left.example.net/stream")
+        q = stationQueue.StationQueue(core.mpd, resolve=resolve)
+        await q.syncAsync(stations)
+        checkSync("playAsync", fake, q)
+        await core.refresh()
+        await q.playAsync(stations, 10, core)
+        before = fakeState(fake)[1]
+        await core.refresh()
+        done = await q.updateAsync(stations, core.queue, newUrls(), 10)
+        checkUpdate("playAsync", fake, q, done, before)
+        edit(fake)
+        # the mirror as the idle loop leaves it
+        await core.refresh()
+        await q.playAsync(stations, 30, core)
+        checkOther("playAsync", fake)
+        core.mpd.close()
+        fake.stop()
+
+    asyncio.run(run())
+
+benchmarks["queue"] = benchQueue
+
+
+#########################
+# latency: the menu commands of streamPlayer.py
+
+def playerOps(client, stations, index):
+    q = stationQueue.StationQueue(client)
+    q.sync(stations)
+    n = len(stations)
+    current = [0]
+
+    def play(i):
+        client.play()
+
+    def nextStation(i):
+        current[0] = (current[0] + 1) % n
+        q.play(stations, current[0])
+
+    def prevStation(i):
+        current[0] = (current[0] - 1) % n
+        q.play(stations, current[0])
+
+    queries = ("detroit", "rock oldies", "kbco", "altrenative", "80s")
+
+    def find(i):
+        r = index.search(queries[i % len(queries)], 1)
+        q.play(stations, r[0][0])
+
+    if shutil.which("amixer"):
+        amixer = "amixer"
+    else:
+        amixer = "true"
+
+    def volume(i):
+        subprocess.call(amixer + " set Digital " + str(40 + i % 20) + "% > /dev/null", shell=True)
+
+    return [("play", play), ("next", nextStation), ("prev", prevStation), ("find", find), ("volume (amixer)", volume)]
+
+def benchLatency():
+    stations = stationCatalog.storeStations(stationCatalog.readStationFile(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "all_stations.m3u")))
+    index = stationSearch.buildIndex(stations)
+
+    for name, latency in (("no injected latency", 0.0), ("1 ms per mpd command", 0.001)):
+        print("latency: " + name)
+        fake = fakeMpd.FakeMPD().start()
+        fake.defaultLatency = latency
+        client = mpdClient.MPDClient("127.0.0.1", fake.port)
+        for op, f in playerOps(client, stations, index):
+            report(op, timeIt(f, 200))
+        client.close()
+        fake.stop()
+
+benchmarks["latency"] = benchLatency
+
+
+#########################
+# state: the current stream, as lastStation reads it
+
+def benchState():
+    print("state: current stream with 1 ms per mpd command")
+    fake = fakeMpd.FakeMPD().start()
+    fake.defaultLatency = 0.001
+    client = mpdClient.MPDClient("127.0.0.1", fake.port)
+    client.playStream(testStream)
+
+    if shutil.which("mpc"):
+        env = dict(os.environ)
+        env["MPD_HOST"] = "127.0.0.1"
+        env["MPD_PORT"] = str(fake.port)
+        report("mpc current", timeIt(lambda i: subprocess.check_output("mpc current", shell=True, env=env), 20))
+    report("currentsong round trip", timeIt(lambda i: client.currentStream(), 200))
+
+    core = playerCore.PlayerCore("127.0.0.1", fake.port).startThread()
+    report("playerCore mirror", timeIt(lambda i: core.currentStream(), 10000))
+
+    # how long until the mirror follows a change made by another client
+    def follow(i):
+        stream = testStream + str(i)
+        client.playStream(stream)
+        while core.currentStream() != stream:
+            time.sleep(0.0001)
+
+    report("change seen by mirror", timeIt(follow, 50))
+    core.stopThread()
+    client.close()
+    fake.stop()
+
+benchmarks["state"] = benchState
+
+
+#########################
+# volume: + pressed 50 times
+
+# Stands in for amixer: every command takes delay seconds and is written
+# to the log, one command from the arguments or one per line with -s
+stubAmixer = """
+import sys, time
+delay = float(sys.argv[1])
+log = open(sys.argv[2], "a")
+def run(args):
+    time.sleep(delay)
+    log.write(" ".join(args) + "\\n")
+    log.flush()
+if sys.argv[3:] == ["-s"]:
+    for line in sys.stdin:
+        run(line.split())
+else:
+    run(sys.argv[3:])
+"""
+
+def mixerLog(fileName):
+    try:
+        f = open(fileName)
+    except OSError:
+        return []
+    lines = f.read().splitlines()
+    f.close()
+    return lines
+
+def benchVolume():
+    presses = 50
+    delay = 0.005
+    print("volume: " + str(presses) + " presses, time until the last level is set, stub amixer takes " +
+          str(delay * 1000) + " ms per command")
+    d = tempfile.mkdtemp()
+    stub = os.path.join(d, "amixer.py")
+    f = open(stub, "w")
+    f.write(stubAmixer)
+    f.close()
+    log = os.path.join(d, "mixer.log")
+    levels = [min(100, 5 * (i + 1)) for i in range(presses)]
+
+    # what streamPlayer.py did, one amixer through the shell per press
+    def perPress(i):
+        for v in levels:
+            subprocess.call(sys.executable + " " + stub + " " + str(delay) + " " + log +
+                            " set Digital " + str(v) + "%", shell=True)
+
+    # the presses wait for each other, the last one is set after all
+    open(log, "w").close()
+    report("amixer per press", timeIt(perPress, 3))
+    print("   mixer commands per burst: " + str(len(mixerLog(log)) // 3))
+
+    # press every gap seconds, then wait until the stub has the last
+    # level. Returns the seconds from the last press
+    async def burst(mixer, gap, applied):
+        volume = volumeControl.VolumeControl(mixer)
+        for v in levels:
+            volume.set(v)
+            start = time.time()
+            await asyncio.sleep(gap)
+        await volume.wait()
+        while not applied():
+            await asyncio.sleep(0.0005)
+        t = time.time() - start
+        await volume.close()
+        return t
+
+    def lastIs(v):
+        return lambda: mixerLog(log)[-1:] == ["sset Digital " + str(v) + "%"]
+
+    command = (sys.executable, stub, str(delay), log, "-s")
+    for name, gap in (("all at once", 0.0), ("key repeat, 30 ms", 0.03)):
+        open(log, "w").close()
+        samples = []
+        for i in range(3):
+            mixer = volumeControl.AmixerMixer("Digital", command)
+            samples.append(asyncio.run(burst(mixer, gap, lastIs(levels[-1]))))
+        report("amixer -s, " + name, samples)
+        print("   mixer commands per burst: " + str(len(mixerLog(log)) // 3))
+
+    fake = fakeMpd.FakeMPD().start()
+    fake.defaultLatency = 0.001
+    for name, gap in (("all at once", 0.0), ("key repeat, 30 ms", 0.03)):
+        samples = []
+        commands = 0
+        for i in range(3):
+            async def run():
+                connection = playerCore.AsyncMPDConnection("127.0.0.1", fake.port)
+                mixer = volumeControl.MPDMixer(connection)
+                t = await burst(mixer, gap, lambda: True)
+                connection.close()
+                return t, mixer.commands
+            t, n = asyncio.run(run())
+            samples.append(t)
+            commands += n
+        report("mpd setvol, " + name, samples)
+        print("   mixer commands per burst: " + str(commands // 3))
+    fake.stop()
+    shutil.rmtree(d)
+
+benchmarks["volume"] = benchVolume
+
+
+#########################
+# log: one message, as switchStation and the checker loop log them
+
+def benchLog():
+    print("log: one message")
+    d = tempfile.mkdtemp()
+    n = 20000
+
+    # what printMsg did
+    f = open(os.path.join(d, "old.log"), 'w+')
+
+    def oldMsg(i):
+        s = datetime.datetime.fromtimestamp(time.time()).strftime('%Y/%m/%d %H:%M:%S - ')
+        f.write(s + "switch " + str(i) + "\n")
+
+    report("strftime and write", timeIt(oldMsg, n))
+    f.close()
+
+    log = streamLog.Logger(os.path.join(d, "new.log"), maxRecords=n + 1)
+    report("streamLog msg", timeIt(lambda i: log.msg("switch", station=i), n))
+    log.flush()
+    report("streamLog event", timeIt(lambda i: log.event("switch", 0.0123, station=i), n))
+    log.flush()
+
+    def timed(i):
+        with log.timed("switch", station=i):
+            pass
+
+    report("streamLog timed", timeIt(timed, n))
+    log.close()
+    shutil.rmtree(d)
+
+benchmarks["log"] = benchLog
+
+
+#########################
+# resolve: time to first byte of a station behind redirects and playlists
+
+async def firstByte(url, dns=None):
+    reader, writer = await checkEngine.openStream(url, dns)
+    try:
+        status, headers, reader = await checkEngine.readHead(reader)
+        if not await reader.read(1):
+            raise checkEngine.ProbeError("no audio from " + url)
+    finally:
+        checkEngine.closeWriter(writer)
+
+def benchResolve():
+    delay = 0.02
+    print("resolve: time to first audio byte, every answer of the server takes " + str(delay * 1000) + " ms")
+    server = fakeStream.FakeStreamServer(host="localhost").start()
+    server.delay = delay
+    chains = (("direct", "healthy"),
+              ("3 redirects", "redirect/3"),
+              ("2 redirects, pls, m3u", "redirect/2/pls/m3u/healthy"))
+
+    async def run():
+        cache = streamResolver.ResolverCache()
+        for name, path in chains:
+            url = server.url(path)
+
+            # what mpd does on every station change
+            samples = []
+            for i in range(10):
+                t = time.perf_counter()
+                await streamResolver.resolveChain(url, None, True)
+                samples.append(time.perf_counter() - t)
+            report("chain, " + name, samples)
+
+            await cache.refresh(url)
+            samples = []
+            for i in range(10):
+                t = time.perf_counter()
+                await firstByte(cache.lookup(url), cache.dns)
+                samples.append(time.perf_counter() - t)
+            report("cached, " + name, samples)
+
+    asyncio.run(run())
+    checkResolverTtl(server)
+    server.stop()
+
+# How long the resolver keeps a final url: ttl, or what a redirect says,
+# never what the audio says. Entries that ran out are not loaded
+def checkResolverTtl(server):
+    cache = streamResolver.ResolverCache()
+    for name, path, ttl in (("redirect, audio not cached", "redirect/1", cache.ttl),
+                            ("max-age=120", "token/120/healthy", 120.0),
+                            ("max-age=0", "token/0/healthy", streamResolver.minTtl),
+                            ("max-age above ttl", "token/86400/healthy", cache.ttl)):
+        url = server.url(path)
+        asyncio.run(cache.refresh(url))
+        kept = cache.entries[url][1] - time.time()
+        check("resolver keeps the url, " + name, ttl - 5 < kept <= ttl, "%.0fs" % kept)
+
+    d = tempfile.mkdtemp()
+    fileName = os.path.join(d, "stations.m3u.resolved")
+    now = time.time()
+    f = open(fileName, 'w')
+    json.dump({"http://a/": ["http://a/?token=1", now - 10, True],
+               "http://b/": ["http://b/?token=2", now + 600, True],
+               "http://c/": ["http://c/?token=3", now + 6 * 3600, True]}, f)
+    f.close()
+    cache = streamResolver.ResolverCache(fileName)
+    cache.load()
+    left = dict((k, round(e[1] - now)) for k, e in cache.entries.items())
+    check("resolver load, run out left, long ones cut", set(left) == set(("http://b/", "http://c/")) and
+          left["http://c/"] <= cache.ttl, left)
+    shutil.rmtree(d)
+
+benchmarks["resolve"] = benchResolve
+
+
+#########################
+# api: commands through the control socket, served in a thread like
+# streamPlayer.py --daemon does in its event loop
+
+def apiCommands(stations):
+    current = [0]
+
+    def status(request):
+        s = stations[current[0]]
+        return {"station": current[0], "call": s[0], "brief": s[1], "stream": s[3], "volume": 60}
+
+    def nextStation(request):
+        current[0] = (current[0] + 1) % len(stations)
+        return status(request)
+
+    # a command that fails the way an mpd command can
+    def broken(request):
+        raise mpdClient.MPDError("connection to mpd closed")
+
+    return {"status": status, "next": nextStation, "broken": broken}
+
+def benchApi():
+    print("api: commands through the control socket")
+    d = tempfile.mkdtemp()
+    fileName = os.path.join(d, "stations.m3u")
+    makeStationFile(fileName, 1000)
+    stationCatalog.buildCatalog(fileName)
+    stations = stationCatalog.openCatalog(fileName)
+    path = os.path.join(d, "api.sock")
+
+    loop = asyncio.new_event_loop()
+    server = playerApi.ApiServer(path, apiCommands(stations))
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    # what a script without the daemon pays: start python and open the stations
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = "import stationCatalog; stationCatalog.openCatalog(%r)[0]" % fileName
+    report("new process, open stations", timeIt(lambda i: subprocess.call([sys.executable, "-c", script], cwd=here), 10))
+    report("new process, playerApi.py status", timeIt(lambda i: subprocess.call(
+        [sys.executable, os.path.join(here, "playerApi.py"), "--socket", path, "status"],
+        stdout=subprocess.DEVNULL), 10))
+
+    client = playerApi.ApiClient(path)
+    report("connected client, status", timeIt(lambda i: client.call("status"), 2000))
+    report("10 commands, one at a time", timeIt(lambda i: [client.call("next") for k in range(10)], 200))
+    report("10 commands, one batch", timeIt(lambda i: client.batch([{"cmd": "next"}] * 10), 200))
+    failed = []
+    server.onError = lambda request, ex: failed.append(request.get("cmd"))
+    answers = client.batch([{"cmd": "broken"}, {"cmd": "status"}])
+    check("failing command answered, connection kept", not answers[0]["ok"] and answers[1]["ok"] and
+          failed == ["broken"], answers[0])
+
+    # many clients at once, every one subscribed to events
+    for n in (10, 50):
+        clients = [playerApi.ApiClient(path) for k in range(n)]
+        for c in clients:
+            c.call("subscribe", events=["nowplaying"])
+        samples = []
+        lock = threading.Lock()
+
+        def run(c):
+            mine = timeIt(lambda i: c.call("status"), 100)
+            with lock:
+                samples.extend(mine)
+
+        t = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(c,)) for c in clients]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        wall = time.perf_counter() - t
+        report("%d clients, status" % n, samples)
+        print("   %d clients: %.0f commands/s" % (n, len(samples) / wall))
+        for c in clients:
+            c.close()
+
+    # one event to 50 subscribers
+    clients = [playerApi.ApiClient(path) for k in range(50)]
+    for c in clients:
+        c.call("subscribe", events=["nowplaying"])
+
+    def publish(i):
+        loop.call_soon_threadsafe(server.publish, "nowplaying", {"station": i})
+        for c in clients:
+            c.receive()
+
+    report("event to 50 subscribers", timeIt(publish, 200))
+    for c in clients:
+        c.close()
+
+    client.close()
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    stations.close()
+    shutil.rmtree(d)
+
+benchmarks["api"] = benchApi
+
+
+#########################
+# boot: start up of streamPlayer.py, from the saved state to the menu
+# and to the first audio
+
+# gives up after timeout seconds, so a stream that was stopped does not
+# hang the benchmark
+async def waitAudio(core, url, timeout=15.0):
+    end = time.monotonic() + timeout
+    while not (core.audioStarted() and core.currentStream() == url) and time.monotonic() < end:
+        await asyncio.sleep(0.005)
+        await core.refreshStatus()
+
+# One step after the other: mpd, the stations, the queue, the mixer, play
+async def sequentialBoot(fake, fileName, mixerCommand, stream, problems):
+    t = time.perf_counter()
+    core = playerCore.PlayerCore("127.0.0.1", fake.port)
+    await core.start()
+    stations = stationCatalog.loadStations(fileName)
+    q = stationQueue.StationQueue(core.mpd)
+    await q.syncAsync(stations, 0, core.queue)
+    mixer = volumeControl.AmixerMixer("Digital", mixerCommand)
+    await mixer.set(60)
+    i = [s[3] for s in stations].index(stream)
+    await q.playAsync(stations, i)
+    menu = time.perf_counter() - t
+    await waitAudio(core, stream)
+    audio = time.perf_counter() - t
+    await mixer.close()
+    await core.stop()
+    stations.close()
+    return menu, audio
+
+# streamPlayer.py starts the player when it is loaded, so it cannot be
+# imported. The functions named are compiled from its source into
+# namespace, which stands in for the globals of the script
+def playerFunctions(namespace, names):
+    fileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamPlayer.py")
+    f = open(fileName, 'r')
+    tree = ast.parse(f.read(), fileName)
+    f.close()
+    defs = [d for d in tree.body if isinstance(d, (ast.FunctionDef, ast.AsyncFunctionDef)) and d.name in names]
+    exec(compile(ast.Module(defs, []), fileName, "exec"), namespace)
+    return namespace
+
+startupFunctions = ("resumeEarly", "finishStartup", "syncStationQueue", "playingStation", "syncQueue",
+                    "updateQueue", "startTask", "logFailure", "waitForAudio")
+
+# the log and the stats of the player, the benchmark keeps neither
+class Discard:
+
+    def __getattr__(self, name):
+        return lambda *args, **fields: None
+
+def fakeSong(fake):
+    with fake.lock:
+        if fake.state != "play" or not 0 <= fake.song < len(fake.queue):
+            return None
+        return fake.queue[fake.song]["id"], fake.queue[fake.song]["file"]
+
+# As streamPlayer.py init does it, with its resumeEarly and finishStartup:
+# the stations, mpd and the mixer at once, the saved stream played as
+# soon as mpd answers, the queue synced after the audio started. The
+# resolver finds a newer url for the saved stream meanwhile, the song
+# started early must neither stop nor be replaced by it
+async def parallelBoot(fake, fileName, mixerCommand, stream, problems):
+    t = time.perf_counter()
+    volume = volumeControl.VolumeControl(volumeControl.AmixerMixer("Digital", mixerCommand))
+    volume.set(60)
+    loading = asyncio.get_running_loop().run_in_executor(None, stationCatalog.loadStations, fileName)
+    core = playerCore.PlayerCore("127.0.0.1", fake.port)
+    resolver = streamResolver.ResolverCache()
+    resolver.store(stream, stream, time.time() + 3600, True)
+    player = playerFunctions({
+        "asyncio": asyncio, "time": time, "mpdClient": mpdClient, "core": core, "resolver": resolver,
+        "mpdQueue": stationQueue.StationQueue(core.mpd, 0, resolver.cached), "stationList": None,
+        "state": {"stream": stream}, "resolveStreams": True, "queueMode": True, "cStation": 0,
+        "queuedVersion": 0, "pendingTasks": set(), "audioTask": None, "audioTimeout": 15, "audioPoll": 0.005,
+        "printMsg": Discard().msg, "log": Discard(), "stats": Discard(), "publishNowPlaying": Discard().publish,
+        "requestSwitch": problems.append}, startupFunctions)
+    await core.start()
+    url, replaced = await player["resumeEarly"]()
+    early = fakeSong(fake)
+    traced = len(fake.trace)
+    resolver.store(stream, stream + "?token=new", time.time() + 3600, True)
+    stations = await loading
+    player["stationList"] = stations
+    i = player["cStation"] = [s[3] for s in stations].index(stream)
+    menu = time.perf_counter() - t
+    startup = asyncio.ensure_future(player["finishStartup"](i, url, replaced, time.time()))
+    await waitAudio(core, url, 5.0)
+    audio = time.perf_counter() - t
+    await startup
+    sent = [l.split()[0] for when, client, l, seconds in fake.trace[traced:]]
+    stopped = [c for c in sent if c in ("stop", "clear", "play", "playid")]
+    if url != stream or early is None or fakeSong(fake) != early or stopped:
+        problems.append("played %s, then %s, sent %s" % (early, fakeSong(fake), stopped))
+    await volume.close()
+    await core.stop()
+    stations.close()
+    return menu, audio
+
+def benchBoot():
+    latency = 0.002
+    startDelay = 0.2
+    print("boot: time to menu and to audio, %.0f ms per mpd command, audio %.0f ms after play, stub amixer" %
+          (latency * 1000, startDelay * 1000))
+    d = tempfile.mkdtemp()
+    stub = os.path.join(d, "amixer.py")
+    f = open(stub, "w")
+    f.write(stubAmixer)
+    f.close()
+    mixerCommand = (sys.executable, stub, "0.005", os.path.join(d, "mixer.log"), "-s")
+
+    for n in (44, 1000):
+        fileName = os.path.join(d, "stations" + str(n) + ".m3u")
+        makeStationFile(fileName, n)
+        stationCatalog.buildCatalog(fileName)
+        stations = stationCatalog.openCatalog(fileName)
+        stream = stations[n // 2][3]
+        stations.close()
+
+        for mpdState in ("empty mpd", "queue loaded"):
+            for name, boot in (("in turn", sequentialBoot), ("parallel", parallelBoot)):
+                menu = []
+                audio = []
+                problems = []
+                for i in range(5):
+                    fake = fakeMpd.FakeMPD().start()
+                    fake.defaultLatency = latency
+                    fake.streamStartDelay = startDelay
+                    if mpdState == "queue loaded":
+                        # mpd kept the queue of the last run, stopped
+                        asyncio.run(sequentialBoot(fake, fileName, mixerCommand, stream, problems))
+                        client = mpdClient.MPDClient("127.0.0.1", fake.port)
+                        client.stop()
+                        client.close()
+                    # the commands sent show whether the song was stopped
+                    fake.tracing = True
+                    m, a = asyncio.run(boot(fake, fileName, mixerCommand, stream, problems))
+                    menu.append(m)
+                    audio.append(a)
+                    fake.stop()
+                report("%d %s, %s, menu" % (n, mpdState, name), menu)
+                report("%d %s, %s, audio" % (n, mpdState, name), audio)
+                if boot is parallelBoot:
+                    check("%d %s, station started first kept playing" % (n, mpdState), not problems,
+                          problems[:1])
+    shutil.rmtree(d)
+
+benchmarks["boot"] = benchBoot
+
+
+#########################
+# zones: one station in many rooms, each room a fakeMpd
+
+def startSkew(fakes):
+    started = [f.songStarted for f in fakes]
+    return max(started) - min(started)
+
+# True when every fake plays url, alone in its queue
+def allPlaying(fakes, url):
+    return all(f.state == "play" and [s["file"] for s in f.queue] == [url] and f.song == 0 for f in fakes)
+
+# A room whose mpd does not answer is reported, the others are not held
+# up by it
+async def checkHungZone():
+    timeout = 0.5
+    fakes = [fakeMpd.FakeMPD().start() for i in range(4)]
+    fakes[-1].defaultLatency = 5.0
+    zones = playerZones.ZoneController([("room" + str(i), "127.0.0.1", f.port) for i, f in enumerate(fakes)],
+                                       timeout)
+    for name, play in (("play", zones.play), ("syncPlay", zones.syncPlay)):
+        t = time.perf_counter()
+        failed = await play(testStream)
+        took = time.perf_counter() - t
+        check("hung room, %s: the others play" % name, allPlaying(fakes[:-1], testStream))
+        check("hung room, %s: only it failed" % name,
+              [n for n, e in failed.items() if e] == ["room3"] and "no answer" in failed["room3"], failed)
+        check("hung room, %s: done within the timeout" % name, took < 2 * timeout + 0.2, "%.2fs" % took)
+    # the hung room's connections are left waiting on it
+    for f in fakes:
+        f.stop()
+
+def benchZones():
+    latency = 0.002
+    print("zones: play in every room, %.0f ms per mpd command" % (latency * 1000))
+    for n in (2, 10, 50):
+        fakes = []
+        for i in range(n):
+            fake = fakeMpd.FakeMPD().start()
+            fake.defaultLatency = latency
+            fakes.append(fake)
+
+        # what a loop over the rooms with streamPlayer.py's client would do
+        clients = [mpdClient.MPDClient("127.0.0.1", f.port) for f in fakes]
+        skews = []
+
+        def inTurn(i):
+            for c in clients:
+                c.playStream(testStream)
+            skews.append(startSkew(fakes))
+
+        report("%d rooms, one after the other" % n, timeIt(inTurn, 10))
+        print("   start skew p50 %.1f ms" % (percentile(skews, 50) * 1000))
+        for c in clients:
+            c.close()
+
+        async def run():
+            zones = playerZones.ZoneController([("room" + str(i), "127.0.0.1", f.port)
+                                                for i, f in enumerate(fakes)])
+            for name, play in (("play", zones.play), ("syncPlay", zones.syncPlay)):
+                samples = []
+                skews = []
+                for i in range(10):
+                    t = time.perf_counter()
+                    failed = await play(testStream)
+                    samples.append(time.perf_counter() - t)
+                    skews.append(startSkew(fakes))
+                    if any(failed.values()):
+                        print("   failed: " + str(failed))
+                report("%d rooms, %s" % (n, name), samples)
+                print("   start skew p50 %.1f ms" % (percentile(skews, 50) * 1000))
+                check("%d rooms, %s: every room plays the stream" % (n, name), allPlaying(fakes, testStream))
+                check("%d rooms, %s: no room failed" % (n, name), not any(failed.values()), failed)
+
+            failed = await zones.stop()
+            check("%d rooms, stop: every room stopped" % n,
+                  all(f.state == "stop" for f in fakes) and not any(failed.values()), failed)
+
+            samples = []
+            for i in range(10):
+                t = time.perf_counter()
+                zones.setVolume(40 + i)
+                await zones.wait()
+                samples.append(time.perf_counter() - t)
+            report("%d rooms, volume" % n, samples)
+            check("%d rooms, volume: every room at 49" % n, all(f.volume == 49 for f in fakes),
+                  [f.volume for f in fakes])
+            info = await zones.refresh()
+            check("%d rooms, refresh: state and volume of every room" % n,
+                  all(z["state"] == "stop" and z["volume"] == "49" and z["error"] is None for z in info))
+            await zones.close()
+
+        asyncio.run(run())
+        for f in fakes:
+            f.stop()
+    asyncio.run(checkHungZone())
+
+benchmarks["zones"] = benchZones
+
+
+#########################
+# meta: ICY metadata in a stream
+
+# The parser written the usual way: the stream is appended to a buffer
+# and the audio cut off its front
+class CopyingIcyParser:
+
+    def __init__(self, metaint):
+        self.metaint = metaint
+        self.buffer = b""
+
+    def feed(self, data):
+        found = []
+        self.buffer += data
+        while len(self.buffer) > self.metaint:
+            n = self.buffer[self.metaint] * 16
+            if len(self.buffer) < self.metaint + 1 + n:
+                break
+            meta = self.buffer[self.metaint + 1:self.metaint + 1 + n]
+            self.buffer = self.buffer[self.metaint + 1 + n:]
+            if n:
+                found.append(streamMeta.parseMetadata(meta))
+        return found
+
+def icyStream(metaint, blocks):
+    meta = b"StreamTitle='Fake Artist - Fake Song';StreamUrl='';"
+    meta += b"\x00" * (-len(meta) % 16)
+    audio = (fakeStream.audioChunk * (metaint // len(fakeStream.audioChunk) + 1))[:metaint]
+    out = []
+    for i in range(blocks):
+        if i % 10 == 0:
+            out.append(audio + bytes([len(meta) // 16]) + meta)
+        else:
+            out.append(audio + b"\x00")
+    return b"".join(out)
+
+# A short stream whose length bytes and metadata blocks fall anywhere in
+# the chunks it is cut into: the titles found and the audio bytes
+def splitStream(metaint):
+    titles = ["First - One", "", "Second \u00e9 - Two;x='y'", "Third - Three"]
+    out = []
+    for t in titles:
+        meta = b""
+        if t:
+            meta = ("StreamTitle='" + t + "';StreamUrl='';").encode("utf-8")
+            meta += b"\x00" * (-len(meta) % 16)
+        out.append(b"a" * metaint + bytes([len(meta) // 16]) + meta)
+    out.append(b"a" * (metaint // 2))
+    return b"".join(out), [t for t in titles if t], metaint * len(titles) + metaint // 2
+
+def parsedTitles(metaint, chunks):
+    p = streamMeta.IcyParser(metaint)
+    titles = []
+    for c in chunks:
+        titles += [m.get("StreamTitle") for m in p.feed(c)]
+    return titles, p.audioBytes
+
+def checkIcyParser():
+    metaint = 16
+    data, titles, audio = splitStream(metaint)
+    cuts = []
+    # in two at every byte, in chunks of every size up to a block, and
+    # a byte at a time
+    for k in range(len(data) + 1):
+        cuts.append((data[:k], data[k:]))
+    for size in range(1, 3 * metaint):
+        cuts.append([data[k:k + size] for k in range(0, len(data), size)])
+    bad = [len(c) for c in cuts if parsedTitles(metaint, c) != (titles, audio)]
+    check("IcyParser, %d ways of cutting the stream" % len(cuts), not bad, "%d wrong" % len(bad))
+
+def benchMeta():
+    metaint = 16000
+    data = icyStream(metaint, 2000)
+    print("meta: %.0f MB stream, metadata every %d bytes" % (len(data) / 1e6, metaint))
+    checkIcyParser()
+    for chunk in (4096, 16384, 65536):
+        chunks = [data[k:k + chunk] for k in range(0, len(data), chunk)]
+        for name, parserClass in (("copying", CopyingIcyParser), ("memoryview", streamMeta.IcyParser)):
+            def parse(i):
+                p = parserClass(metaint)
+                n = 0
+                for c in chunks:
+                    n += len(p.feed(c))
+                return n
+
+            t = time.process_time()
+            samples = timeIt(parse, 3)
+            cpu = (time.process_time() - t) / 3
+            report("%s, %d byte reads" % (name, chunk), samples)
+            print("   CPU %.2f ms per MB, %.1f us per read" %
+                  (cpu * 1000 / (len(data) / 1e6), cpu * 1e6 / len(chunks)))
+
+    server = fakeStream.FakeStreamServer().start()
+    server.streamChunks = 100
+    for path in ("icy/8192", "icy/16000", "redirect/1/icy/16000"):
+        bytesRead = []
+        metas = []
+        samples = timeIt(lambda i: metas.append(asyncio.run(
+            streamMeta.firstMetadata(server.url(path), bytesRead=bytesRead))), 20)
+        report("first title, " + path, samples)
+        print("   %d bytes read" % (sum(bytesRead) // len(bytesRead)))
+        check("first title, %s: the server's title" % path,
+              all(m is not None and m.get("StreamTitle") == server.title for m in metas), metas[0])
+    for path, title in (("icy/100/Artist_One_-_Song_One", "Artist One - Song One"),
+                        ("icy/16000/Artist_Two_-_Song_Two", "Artist Two - Song Two"),
+                        ("redirect/2/icy/8192/Artist_Three_-_Song", "Artist Three - Song"),
+                        ("healthy", None)):
+        meta = asyncio.run(streamMeta.firstMetadata(server.url(path)))
+        check("first title, " + path, (meta and meta.get("StreamTitle")) == title, meta)
+    checkTitleSource(server)
+    server.stop()
+
+# streamPlayer.py followTitle: a stream mpd reports a Title for is not
+# opened a second time, one without is read for its ICY title after
+# titleWait
+def checkTitleSource(server):
+    async def run():
+        fake = fakeMpd.FakeMPD().start()
+        core = playerCore.PlayerCore("127.0.0.1", fake.port)
+        await core.start()
+        titles = streamMeta.MetaWatcher()
+        player = playerFunctions({"core": core, "titles": titles, "watchTitles": True, "titleWait": 0.2},
+                                 ("followTitle", "songTitle"))
+        for path, mpdTitle in (("icy/100/Told_By_Mpd", "Told By Mpd"), ("icy/100/Only_In_The_Stream", None)):
+            url = server.url(path)
+            if mpdTitle is not None:
+                fake.titles[url] = mpdTitle
+            before = server.requests
+            await core.mpd.playStream(url)
+            await core.refresh()
+            player["followTitle"]("player")
+            await asyncio.sleep(0.5)
+            opened = server.requests - before
+            if mpdTitle is not None:
+                check("title from mpd, no second connection", opened == 0 and player["songTitle"]() == mpdTitle,
+                      "%d opened, %s" % (opened, player["songTitle"]()))
+            else:
+                check("no title from mpd, the stream is read", opened == 1 and
+                      player["songTitle"]() == "Only In The Stream", "%d opened, %s" % (opened, player["songTitle"]()))
+        titles.stop()
+        await core.stop()
+        fake.stop()
+
+    asyncio.run(run())
+
+benchmarks["meta"] = benchMeta
+
+
+#########################
+# titles: the current title of many stations
+
+def benchTitles():
+    n = 200
+    delay = 0.02
+    print("titles: %d stations, every answer of the server takes %.0f ms" % (n, delay * 1000))
+    server = fakeStream.FakeStreamServer().start()
+    server.delay = delay
+    server.streamChunks = 1000
+    stations = [(i, server.url("icy/16000/Artist_%d_-_Song" % i)) for i in range(n)]
+
+    for concurrency, rate in ((1, 0), (16, 0), (64, 0), (64, 1024 * 1024)):
+        scanner = streamMeta.TitleScanner(concurrency=concurrency, rate=rate)
+        t = time.perf_counter()
+        asyncio.run(scanner.scan(stations))
+        wall = time.perf_counter() - t
+        print("   %2d sockets, %-9s %6.0f ms, %d titles, %4.0f KB read, %d sockets at most" %
+              (concurrency, "%d KB/s" % (rate // 1024) if rate else "no limit", wall * 1000,
+               scanner.found, scanner.bytesRead / 1024.0, scanner.peakOpen))
+        name = "%d sockets%s" % (concurrency, ", rate" if rate else "")
+        wrong = [i for i, url in stations if scanner.titles.get(i, ("",))[0] != "Artist %d - Song" % i]
+        check(name + ": the title of every station", scanner.found == n and not wrong,
+              "%d found, wrong: %s" % (scanner.found, wrong[:3]))
+        check(name + ": sockets open at once", 0 < scanner.peakOpen <= concurrency, scanner.peakOpen)
+
+    # the title comes after 16000 bytes, more than a station may read
+    maxBytes = 8192
+    scanner = streamMeta.TitleScanner(concurrency=16, maxBytes=maxBytes, rate=0)
+    asyncio.run(scanner.scan(stations[:20]))
+    check("%d bytes at most per station" % maxBytes, scanner.found == 0 and scanner.noMetadata == 20 and
+          scanner.bytesRead <= 20 * maxBytes, "%d found, %d bytes read" % (scanner.found, scanner.bytesRead))
+    server.stop()
+
+benchmarks["titles"] = benchTitles
+
+
+#########################
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    if not names:
+        names = list(benchmarks)
+    for n in names:
+        if n not in benchmarks:
+            print("Unknown benchmark: " + n + ", choose from: " + ", ".join(benchmarks))
+            sys.exit(1)
+    for n in names:
+        benchmarks[n]()
+    if failedChecks:
+        print("%d checks failed: %s" % (len(failedChecks), ", ".join(failedChecks)))
+        sys.exit(1)
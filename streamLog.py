@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# streamLog.py is the log of streamPlayer.py and m3uCheck.py.
+#
+# printMsg used to write each message with a fresh strftime to a log
+# file opened with 'w+', so every start emptied the log and nothing was
+# flushed before exit. Here:
+#
+#    the caller only appends (time, message, fields) to a buffer, a
+#    background thread formats and writes the buffer every flushInterval
+#    seconds and flushes the file, so a crash loses at most that much
+#
+#    the buffer holds at most maxRecords records, when the writer falls
+#    behind new records are dropped and counted
+#
+#    the log is appended to and rotated when it grows past maxBytes:
+#    streamPlayer.log becomes streamPlayer.log.1, .1 becomes .2, ...
+#
+#    the date and time are formatted once per second, only the
+#    milliseconds change between records of the same second
+#
+# A record is a message and optional fields, written as key=value after
+# the message. event records the duration of an operation as ms=, timed
+# measures it:
+#
+#    2026/10/16 23:49:36.123 - switch station=4 ms=12.345
+#
+#########################
+
+import atexit
+import collections
+import os
+import threading
+import time
+
+defaultMaxBytes = 1 << 20
+defaultBackups = 3
+defaultMaxRecords = 10000
+flushInterval = 0.2
+
+
+def formatValue(v):
+    s = str(v)
+    if s == "" or " " in s or '"' in s:
+        return '"' + s.replace('"', '\\"') + '"'
+    return s
+
+
+class Logger:
+
+    def __init__(self, fileName, maxBytes=defaultMaxBytes, backups=defaultBackups,
+                 maxRecords=defaultMaxRecords):
+        self.fileName = fileName
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.maxRecords = maxRecords
+        self.records = collections.deque()
+        self.dropped = 0
+        self.stampSecond = None
+        self.stampPrefix = ""
+        self.file = open(fileName, 'a')
+        self.size = self.file.tell()
+        self.wake = threading.Event()
+        self.written = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # the hot path, no formatting and no file access
+    def msg(self, s, **fields):
+        self.event(s, None, **fields)
+
+    def event(self, name, seconds=None, **fields):
+        if len(self.records) >= self.maxRecords:
+            self.dropped += 1
+            return
+        self.records.append((time.time(), name, seconds, fields))
+
+    def timed(self, name, **fields):
+        return Timer(self, name, fields)
+
+    def timeStamp(self, t):
+        s = int(t)
+        if s != self.stampSecond:
+            self.stampSecond = s
+            self.stampPrefix = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(s))
+        return self.stampPrefix + ".%03d - " % int((t - s) * 1000)
+
+    def formatRecord(self, r):
+        t, s, seconds, fields = r
+        line = self.timeStamp(t) + s
+        for k, v in fields.items():
+            line += " " + k + "=" + formatValue(v)
+        if seconds is not None:
+            line += " ms=%.3f" % (seconds * 1000.0)
+        return line + "\n"
+
+    def run(self):
+        while True:
+            self.wake.wait(flushInterval)
+            self.wake.clear()
+            self.writeRecords()
+            if self.closing and not self.records:
+                return
+
+    def writeRecords(self):
+        out = []
+        records = self.records
+        while records:
+            out.append(self.formatRecord(records.popleft()))
+        if self.dropped:
+            n = self.dropped
+            self.dropped = 0
+            out.append(self.formatRecord((time.time(), "log buffer full", None, {"dropped": n})))
+        if out:
+            try:
+                for line in out:
+                    self.file.write(line)
+                    self.size += len(line)
+                    if self.size >= self.maxBytes:
+                        self.rotate()
+                self.file.flush()
+            except (OSError, ValueError):
+                pass
+        with self.written:
+            self.written.notify_all()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            old = self.fileName + "." + str(i)
+            if os.path.exists(old):
+                os.replace(old, self.fileName + "." + str(i + 1))
+        if self.backups > 0:
+            os.replace(self.fileName, self.fileName + ".1")
+        self.file = open(self.fileName, 'w')
+        self.size = 0
+
+    # Wait until everything logged so far is in the file
+    def flush(self, timeout=2.0):
+        if not self.thread.is_alive():
+            return
+        end = time.time() + timeout
+        with self.written:
+            while time.time() < end:
+                self.wake.set()
+                self.written.wait(end - time.time())
+                if not self.records:
+                    return
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.wake.set()
+        self.thread.join(5.0)
+        if self.records:
+            # the writer did not finish, write what is left here
+            self.writeRecords()
+        self.file.close()
+
+
+class Timer:
+
+    def __init__(self, log, name, fields):
+        self.log = log
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is not None:
+            self.fields["error"] = excType.__name__
+        self.log.event(self.name, time.perf_counter() - self.start, **self.fields)
+        return False
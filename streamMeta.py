@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# streamMeta.py reads the song title that shoutcast and icecast stations
+# put in their stream (ICY metadata), for the now playing line of the C
+# command.
+#
+# A request with "Icy-MetaData: 1" is answered with an icy-metaint
+# header. After every metaint bytes of audio the stream holds one length
+# byte (times 16) and that many bytes of metadata, usually
+#
+#    StreamTitle='Artist - Song';StreamUrl='';
+#
+# padded with zero bytes. Most blocks are empty (length 0), the title is
+# sent again when it changes.
+#
+# IcyParser is fed the stream as it arrives, in chunks of any size. The
+# audio is never copied: the parser looks at each chunk through a
+# memoryview and only counts the audio bytes it steps over. Only the
+# metadata bytes (a few hundred a minute) are copied out. Reading a
+# 128 kbit/s station costs a few microseconds of CPU per chunk.
+#
+# MetaWatcher keeps reading the stream of the station playing and calls
+# onTitle(url, title) when the title changes. That is a second connection
+# to the station next to the one mpd plays, so it can be told to wait
+# before opening it (mpd usually reports the title itself). A station
+# that sends no
+# metadata is left alone, one that drops the connection is read again
+# after reconnectDelay seconds (doubling up to maxReconnectDelay).
+#
+# firstMetadata reads a stream only until its first metadata block.
+#
+# TitleScanner finds what many stations are playing right now, for the
+# t= command: it reads every station only until its first title and
+# then hangs up. What it uses is bounded and counted:
+#
+#    concurrency   sockets open at once
+#    maxBytes      bytes read from one station before giving up on it
+#    rate          bytes per second read by the whole scan
+#    timeout       seconds one station may take
+#
+# The titles are kept in memory for ttl seconds, search finds the ones
+# matching some words.
+#
+#########################
+
+import asyncio
+import re
+import time
+import urllib.parse
+
+import checkEngine
+
+readSize = 16384
+metaTimeout = 15.0
+scanConcurrency = 16
+scanTimeout = 10.0
+scanMaxBytes = 128 * 1024
+scanRate = 1024 * 1024
+titleTtl = 300.0
+reconnectDelay = 5.0
+maxReconnectDelay = 300.0
+maxRedirects = 5
+
+metaField = re.compile(r"(\w+)='(.*?)';(?=\w+='|\s*$)", re.S)
+
+
+class IcyParser:
+
+    def __init__(self, metaint):
+        self.metaint = metaint
+        # audio bytes left before the next length byte
+        self.audioLeft = metaint
+        # metadata bytes left of the block being read
+        self.metaLeft = 0
+        self.meta = bytearray()
+        self.audioBytes = 0
+        self.blocks = 0
+
+    # Feed the next part of the stream, returns the metadata blocks that
+    # were completed in it, each as a dict
+    def feed(self, data):
+        found = []
+        view = memoryview(data)
+        n = len(view)
+        pos = 0
+        while pos < n:
+            if self.audioLeft:
+                step = min(self.audioLeft, n - pos)
+                self.audioLeft -= step
+                self.audioBytes += step
+                pos += step
+            elif self.metaLeft:
+                step = min(self.metaLeft, n - pos)
+                self.meta += view[pos:pos + step]
+                self.metaLeft -= step
+                pos += step
+                if not self.metaLeft:
+                    found.append(parseMetadata(self.meta))
+                    self.meta = bytearray()
+                    self.audioLeft = self.metaint
+            else:
+                # the length byte
+                self.metaLeft = view[pos] * 16
+                pos += 1
+                self.blocks += 1
+                if not self.metaLeft:
+                    self.audioLeft = self.metaint
+        view.release()
+        return found
+
+
+# StreamTitle='...';StreamUrl='...'; as a dict
+def parseMetadata(data):
+    data = bytes(data).rstrip(b"\x00")
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("latin-1")
+    return dict(metaField.findall(text.strip()))
+
+
+# GET url asking for metadata, following redirects. Returns reader,
+# writer and the metadata interval (0 when the station sends none)
+async def openIcy(url, dns=None):
+    for hop in range(maxRedirects + 1):
+        reader, writer = await checkEngine.openStream(url, dns, icyMeta=True)
+        try:
+            status, headers, reader = await checkEngine.readHead(reader)
+        except BaseException:
+            checkEngine.closeWriter(writer)
+            raise
+        if status in (301, 302, 303, 307, 308) and "location" in headers:
+            checkEngine.closeWriter(writer)
+            url = urllib.parse.urljoin(url, headers["location"])
+            continue
+        if not 200 <= status < 300:
+            checkEngine.closeWriter(writer)
+            raise checkEngine.ProbeError("HTTP " + str(status))
+        try:
+            metaint = int(headers.get("icy-metaint", "0"))
+        except ValueError:
+            metaint = 0
+        return reader, writer, metaint
+    raise checkEngine.ProbeError("too many redirects")
+
+
+# The first metadata block of url with a title, None if the station sends
+# no metadata. Gives up after maxBlocks blocks. The connection is closed
+# as soon as the block is read. bytesRead, if given, is a list that gets
+# the number of bytes read appended
+async def firstMetadata(url, dns=None, maxBlocks=4, bytesRead=None):
+    reader, writer, metaint = await openIcy(url, dns)
+    n = 0
+    try:
+        if metaint <= 0:
+            return None
+        parser = IcyParser(metaint)
+        while parser.blocks < maxBlocks:
+            data = await reader.read(readSize)
+            if not data:
+                break
+            n += len(data)
+            for meta in parser.feed(data):
+                if meta.get("StreamTitle"):
+                    return meta
+        return None
+    finally:
+        checkEngine.closeWriter(writer)
+        if bytesRead is not None:
+            bytesRead.append(n)
+
+
+class MetaWatcher:
+
+    def __init__(self, onTitle=None, dns=None):
+        self.onTitle = onTitle
+        self.dns = dns
+        self.url = None
+        self.task = None
+        self.title = None
+        self.meta = {}
+        self.updated = 0.0
+        self.bytesRead = 0
+        # called with (url, exception) when reading the stream fails
+        self.onError = None
+
+    # Follow the titles of url after delay seconds, a different url
+    # replaces the one watched
+    def watch(self, url, delay=0.0):
+        if url == self.url and self.task is not None and not self.task.done():
+            return
+        self.stop()
+        self.url = url
+        self.task = asyncio.ensure_future(self.run(url, delay))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.url = None
+        self.title = None
+        self.meta = {}
+
+    async def run(self, url, wait=0.0):
+        if wait > 0:
+            await asyncio.sleep(wait)
+        delay = reconnectDelay
+        while True:
+            try:
+                reader, writer, metaint = await asyncio.wait_for(openIcy(url, self.dns), metaTimeout)
+            except (checkEngine.ProbeError, OSError, ValueError, asyncio.TimeoutError) as ex:
+                self.failed(url, ex)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, maxReconnectDelay)
+                continue
+            try:
+                if metaint <= 0:
+                    # no titles from this station
+                    return
+                parser = IcyParser(metaint)
+                while True:
+                    data = await asyncio.wait_for(reader.read(readSize), metaTimeout)
+                    if not data:
+                        break
+                    self.bytesRead += len(data)
+                    for meta in parser.feed(data):
+                        delay = reconnectDelay
+                        self.update(url, meta)
+            except (OSError, asyncio.TimeoutError) as ex:
+                self.failed(url, ex)
+            finally:
+                checkEngine.closeWriter(writer)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, maxReconnectDelay)
+
+    def update(self, url, meta):
+        title = meta.get("StreamTitle")
+        if not title:
+            return
+        self.meta = meta
+        self.updated = time.time()
+        if title != self.title:
+            self.title = title
+            if self.onTitle is not None:
+                self.onTitle(url, title)
+
+    def failed(self, url, ex):
+        if self.onError is not None:
+            self.onError(url, ex)
+
+
+# Spends at most rate bytes a second, on average
+class ByteRate:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.spent = 0
+
+    async def spend(self, n):
+        self.spent += n
+        if self.rate <= 0:
+            return
+        ahead = self.spent / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+
+class TitleScanner:
+
+    def __init__(self, concurrency=scanConcurrency, maxBytes=scanMaxBytes, rate=scanRate,
+                 timeout=scanTimeout, ttl=titleTtl, dns=None):
+        self.concurrency = concurrency
+        self.maxBytes = maxBytes
+        self.rate = rate
+        self.timeout = timeout
+        self.ttl = ttl
+        self.dns = dns
+        # key: (title, time found, url)
+        self.titles = {}
+        self.task = None
+        # what the last scan did
+        self.scanned = 0
+        self.found = 0
+        self.failed = 0
+        self.noMetadata = 0
+        self.bytesRead = 0
+        self.open = 0
+        self.peakOpen = 0
+        self.seconds = 0.0
+        self.finished = 0.0
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    # Scan in the background, unless a scan is running. stations is a
+    # list of (key, url), the key is what search returns
+    def start(self, stations):
+        if self.running():
+            return self.task
+        self.task = asyncio.ensure_future(self.scan(stations))
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def scan(self, stations):
+        started = time.monotonic()
+        self.scanned = self.found = self.failed = self.noMetadata = 0
+        self.bytesRead = 0
+        self.peakOpen = 0
+        limit = asyncio.Semaphore(max(1, self.concurrency))
+        budget = ByteRate(self.rate)
+
+        async def one(key, url):
+            async with limit:
+                try:
+                    title = await asyncio.wait_for(self.scanOne(url, budget), self.timeout)
+                except (checkEngine.ProbeError, OSError, ValueError, asyncio.TimeoutError):
+                    self.failed += 1
+                    return
+                self.scanned += 1
+                if title is None:
+                    self.noMetadata += 1
+                else:
+                    self.found += 1
+                    self.titles[key] = (title, time.time(), url)
+
+        await asyncio.gather(*[one(k, u) for k, u in stations])
+        self.seconds = time.monotonic() - started
+        self.finished = time.time()
+        self.expire()
+
+    async def scanOne(self, url, budget):
+        self.open += 1
+        self.peakOpen = max(self.peakOpen, self.open)
+        writer = None
+        try:
+            reader, writer, metaint = await openIcy(url, self.dns)
+            if metaint <= 0:
+                return None
+            parser = IcyParser(metaint)
+            n = 0
+            while n < self.maxBytes:
+                data = await reader.read(min(readSize, self.maxBytes - n))
+                if not data:
+                    break
+                n += len(data)
+                self.bytesRead += len(data)
+                await budget.spend(len(data))
+                for meta in parser.feed(data):
+                    if meta.get("StreamTitle"):
+                        return meta["StreamTitle"]
+            return None
+        finally:
+            self.open -= 1
+            if writer is not None:
+                checkEngine.closeWriter(writer)
+
+    def expire(self):
+        old = time.time() - self.ttl
+        for k in [k for k, v in self.titles.items() if v[1] < old]:
+            del self.titles[k]
+
+    # True when the titles are older than ttl or there are none
+    def stale(self):
+        return time.time() - self.finished > self.ttl
+
+    # (key, title) of the titles holding every word, any case
+    def search(self, text):
+        self.expire()
+        words = text.lower().split()
+        found = []
+        for k, v in self.titles.items():
+            t = v[0].lower()
+            if all(w in t for w in words):
+                found.append((k, v[0]))
+        found.sort(key=lambda kt: kt[1].lower())
+        return found
+
+    def report(self):
+        state = "scanning" if self.running() else "idle"
+        return ["title scan %s: %d titles kept, last scan %d stations, %d titles, %d without titles, "
+                "%d failed, %.1f s" % (state, len(self.titles), self.scanned + self.failed, self.found,
+                                      self.noMetadata, self.failed, self.seconds),
+                "   %.0f KB read, %d sockets at most (limit %d), %d KB per station, %d KB/s" %
+                (self.bytesRead / 1024.0, self.peakOpen, self.concurrency,
+                 self.maxBytes // 1024, self.rate // 1024)]
+
+
+#########################
+
+if __name__ == "__main__":
+    # python3 streamMeta.py url, prints the titles as they change
+    import sys
+
+    async def main(url):
+        watcher = MetaWatcher(lambda u, t: print(time.strftime("%H:%M:%S ") + t))
+        watcher.onError = lambda u, ex: print("error: " + (str(ex) or type(ex).__name__))
+        watcher.watch(url)
+        await watcher.task
+
+    try:
+        asyncio.run(main(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
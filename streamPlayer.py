@@ -3,8 +3,7 @@
 
 #########################
 #
-# streamPlayer.py is a python3 script to play internet radio using mpd
-# and mpc.
+# streamPlayer.py is a python3 script to play internet radio using mpd.
 #
 # One goal of writing this script was to understand how these commands
 # could be used in a larger alarm clock radio project to play internet
@@ -20,7 +19,7 @@
 #
 # This script requires the following:
 #
-#    $ sudo apt-get install mpc mpd -y
+#    $ sudo apt-get install mpd -y
 #    $ sudo apt-get alsa -y
 #
 #    HiFiBerry AMP 2 top board, barrel power supply and Speaker
@@ -68,12 +67,34 @@
 #          $ sudo service mpd start
 #          $ sudo service --status-all | grep mpd
 #
-#       details of the mpc and mpd commands
+#       details of the mpd commands
 #          man mpd
-#          man mpc
+#          https://www.musicpd.org/doc/html/protocol.html
+#
+#       streamPlayer.py talks to mpd directly over one connection (see
+#       mpdClient.py). Set MPD_HOST and MPD_PORT to use a different mpd,
+#       for example fakeMpd.py when testing without a Raspberry Pi
+#
+#       the menu runs in an asyncio event loop. Commands are read in a
+#       thread, mpd commands and the mixer run in the background, so a slow
+#       stream start never freezes the menu. Pressing n or p again while
+#       a station is still starting cancels that switch
+#
+#       on start the stations are opened while mpd is connected and the
+#       mixer started, and the saved station plays as soon as mpd
+#       answers. Loading the stations into the mpd queue waits until
+#       the menu is up
+#
+#       with --daemon there is no menu. The stations, mpd and the mixer
+#       are controlled through a Unix socket taking json commands (see
+#       playerApi.py), for the alarm clock GUI and scripts. When
+#       /home/pi/radio/zones.conf lists the mpd of other rooms (see
+#       playerZones.py), the socket also plays stations there
 #
 # Start the script running using:
 #    python3 streamPlayer.py
+# or without the menu:
+#    python3 streamPlayer.py --daemon [--socket /home/pi/radio/streamPlayer.sock]
 #
 # Notes:
 #    If music file name contains a backquote, you will get error message:
@@ -81,18 +102,35 @@
 #
 #########################
 
+import argparse
+import asyncio
 import time
-import datetime
 import os
+import signal
 import sys
 import subprocess
+import threading
+
+import mpdClient
+import playerApi
+import playerCore
+import playerState
+import playerZones
+import stationCatalog
+import stationQueue
+import stationSearch
+import streamLog
+import streamMeta
+import streamResolver
+import streamStats
+import volumeControl
 
 #########################
 # Global Variables
 
-fileLog = open('/home/pi/radio/streamPlayer.log', 'w+')
+# the log is appended to and rotated, see streamLog.py
+log = streamLog.Logger('/home/pi/radio/streamPlayer.log')
 currentStationConfig = '/home/pi/radio/streamPlayer.conf'
-tempStationFile = '/home/pi/radio/streamPlayer.tmp'
 allStationsFile = '/home/pi/Stations/playlists/all_stations.m3u'
 
 directoryStations = "/home/pi/Stations"
@@ -102,6 +140,7 @@ defaultVolume = 60
 currentVolume = defaultVolume
 
 muteVolume = False
+previousVolume = defaultVolume
 
 # mpd doesn't remember the current playlist
 # so, mpc has no way to retrieve it
@@ -112,88 +151,237 @@ currentPlaylist = defaultPlaylist
 
 # data structure to store radio stations: station, brief, long and stream
 # mpd doesn't store enough meaningful information in the playlist
+# stationList[i] is a tuple, see stationCatalog.py
 stationList = list()
 
+# search index over stationList, loaded the first time s= or f= is used
+stationIndex = None
+
 # Instead of starting with the first station every time, remember last station
-# played or get current station playing and start playing it
-# ??? if exit with x, then get currently playing stream when restarting rather than
-#     last known station to be playing ???
-# currentStation is an index into stationList
-currentStation = ""
+# played and start playing it. The station, volume, mute and playlist are
+# kept in currentStationConfig (see playerState.py), saved at most once a
+# second while they change and right away on exit
+# cStation is an index into stationList
 cStation = 0
+state = playerState.StateStore(currentStationConfig)
+
+# mpdHost and mpdPort of None use MPD_HOST and MPD_PORT, or
+# localhost:6600. Point them at fakeMpd.py to run without a Raspberry Pi.
+# mpd is only used to stop the music on the way out, after the event
+# loop has finished
+mpdHost = None
+mpdPort = None
+mpd = mpdClient.MPDClient(mpdHost, mpdPort)
+
+# in memory copy of the mpd state (current stream, volume, queue, ...),
+# kept up to date by mpd idle notifications, even when another program
+# changes mpd. Commands are sent over core.mpd
+core = playerCore.PlayerCore(mpdHost, mpdPort)
 
-# On commands like play, prev and next, mpc outputs a line similar to:
+# In queue mode the stations are loaded into the mpd queue once, and
+# changing stations is a single "play n". queueWindow limits the queue
+# to that many stations around the current one, 0 loads all stations
+queueMode = True
+queueWindow = 0
 #
-#    volume: n/a repeat: off random: off single: off consume: off
+# With resolveStreams the redirects and playlists in front of a stream
+# are followed once, and mpd is given the final url (see
+# streamResolver.py). The queue holds the final urls known when it was
+# synced, queuedVersion tells if the resolver found new ones since. A
+# switch replaces only the entries whose url changed (updateQueue)
+resolveStreams = True
+resolver = streamResolver.ResolverCache(streamResolver.resolvedFileName(allStationsFile))
+queuedVersion = 0
+if resolveStreams:
+    mpdQueue = stationQueue.StationQueue(core.mpd, queueWindow, resolver.cached)
+else:
+    mpdQueue = stationQueue.StationQueue(core.mpd, queueWindow)
+
+# size and mtime of allStationsFile when stationList was loaded, it is
+# checked every stationsCheckInterval seconds
+stationsStat = None
+stationsCheckInterval = 2
+
+# Commands that wait on mpd or the mixer run as background tasks, so the
+# menu keeps reading input. startupTask finishes the start up (syncing
+# the mpd queue) after the menu is shown, switches wait for it.
+# switchTask is the station switch in flight, a newer switch cancels it.
+# audioTask waits (up to audioTimeout seconds) for mpd to report audio
+# from the new station
+pendingTasks = set()
+startupTask = None
+switchTask = None
+audioTask = None
+audioTimeout = 15
+audioPoll = 0.25
+
+# The volume is set through one "amixer -s" process kept open, quick
+# presses are combined into one change (see volumeControl.py). Use
+# volumeControl.MPDMixer(core.mpd) to let mpd set the volume instead.
+# Mute and unmute fade over muteRamp seconds
+mixer = volumeControl.AmixerMixer("Digital")
+volume = volumeControl.VolumeControl(mixer)
+muteRamp = 0.5
+
+# counters and timings of mpd commands, switches, first audio, mixer
+# and file access, shown by the stats command. When statsFile is set
+# they are also written there every statsInterval seconds for the
+# node_exporter textfile collector, for example
+#    /var/lib/node_exporter/textfile_collector/streamplayer.prom
+stats = streamStats.Stats("streamplayer")
+statsFile = None
+statsInterval = 15
+core.mpd.stats = stats
+volume.stats = stats
+
+# The song title shown by C and sent with the nowplaying event is the
+# one mpd reads from the stream it plays (Title of the current song).
+# With watchTitles a stream mpd has no title for titleWait seconds after
+# it started is read a second time for its ICY metadata (see
+# streamMeta.py), mpd does not pass on the titles of every server
+watchTitles = True
+titleWait = 10.0
+titles = streamMeta.MetaWatcher(dns=resolver.dns)
 #
-# adding the following to any mpc command suppresses that output
+# titleScanner reads what every station plays right now for t=, when
+# its titles are older than its ttl. With titleScanInterval above 0 all
+# stations are scanned again every titleScanInterval seconds
+titleScanner = streamMeta.TitleScanner(dns=resolver.dns)
+titleScanInterval = 0
 
-limitMPCoutput = " | grep \"[-,'[']\""
+# In daemon mode the menu is replaced by the control socket apiSocket.
+# api publishes "nowplaying" and "volume" events to the clients that
+# subscribed, quitEvent is set by the quit command and SIGTERM
+daemonMode = False
+apiSocket = playerApi.defaultSocket
+api = None
+quitEvent = None
 
+# the mpd of other rooms, one name=host[:port] per line, see
+# playerZones.py. zones is None when zonesFile does not exist
+zonesFile = '/home/pi/radio/zones.conf'
+zones = None
 
-#########################
-# Log messages should be time stamped
-def timeStamp():
-    t = time.time()
-    s = datetime.datetime.fromtimestamp(t).strftime('%Y/%m/%d %H:%M:%S - ')
-    return s
-
-# Write messages in a standard format
-def printMsg(s):
-    fileLog.write(timeStamp() + s + "\n")
-
-def lastStation():
-    f = tempStationFile
-    cmd = "mpc current > " + f
-    subprocess.call(cmd, shell=True)
-    try:
-        fileStation = open(f, 'r')
-        stream = fileStation.readline()
-        stream = stream.rstrip()
-        fileStation.close()
-    except Exception as ex:
-        printMsg("Exception in lastStation = [" + ex + "]")
-        stream = ""
 
-    return stream
+#########################
+# Write messages in a standard format, time stamped by the log writer.
+# fields are written as key=value after the message
+def printMsg(s, **fields):
+    log.msg(s, **fields)
 
+# Read the saved state. The station is resumed from it without asking mpd
 def readStreamPlayerConfig():
-    global currentStation
+    global cStation
     global currentVolume
+    global previousVolume
+    global muteVolume
     global currentPlaylist
 
-    stream = lastStation()
+    state.onError = lambda ex: printMsg("Exception in state = [" + str(ex) + "]")
+    with stats.timed("read_config"):
+        st = state.load({"station": -1, "stream": "", "volume": defaultVolume,
+                         "mute": False, "playlist": defaultPlaylist})
 
     try:
-        f = open(currentStationConfig, 'r')
-        stream2 = f.readline()
-        if stream2 == "":
-            currentStation = stream
-        else:
-            currentStation = stream2.rstrip()
-
-        l = f.readline()
-        v = l.rstrip()
-        currentVolume = int(v)
-        l = f.readline()
-        currentPlaylist = l.rstrip()
-        f.close()
-    except Exception as ex:
-        printMsg("Exception in readStreamPlayerConfig [" + ex + "]")
-        currentStation = ""
-        currentVolume = defaultVolume
-        currentPlaylist = defaultPlaylist
-        f.close()
-
-    printMsg("read streamPlayer config")
-    printMsg(" stream = [" + currentStation + "]")
-    printMsg(" volume = [" + str(currentVolume) + "]")
-    printMsg(" playlist = [" + currentPlaylist + "]")
-
-    cmd = "rm " + tempStationFile
-    subprocess.call(cmd, shell=True)
+        cStation = max(0, int(st["station"]))
+        muteVolume = bool(st["mute"])
+        previousVolume = int(st["volume"])
+    except (TypeError, ValueError):
+        cStation = 0
+        muteVolume = False
+        previousVolume = defaultVolume
+    currentVolume = 0 if muteVolume else previousVolume
+    currentPlaylist = str(st["playlist"])
+
+    printMsg("read streamPlayer config", station=st["station"], stream=st["stream"],
+             volume=previousVolume, mute=muteVolume, playlist=currentPlaylist)
     return
 
+# Index of the saved station in stationList, None if it is not there
+# (all_stations.m3u changed) or nothing was saved
+def resumeStation():
+    stream = state.get("stream", "")
+    if stream == "":
+        return None
+    if cStation < len(stationList) and stationList.field(cStation, 3) == stream:
+        return cStation
+    # the station moved
+    for i in range(len(stationList)):
+        if stationList.field(i, 3) == stream:
+            return i
+    printMsg("saved stream is no longer a station", stream=stream)
+    return None
+
+def saveStation(station):
+    state.update(station=station, stream=stationList.field(station, 3))
+
+def saveVolume():
+    if muteVolume:
+        state.update(volume=previousVolume, mute=True)
+    else:
+        state.update(volume=currentVolume, mute=False)
+
+# Set the volume to level (0 to 100), unmuting
+def changeVolume(level):
+    global currentVolume
+    global muteVolume
+
+    currentVolume = max(0, min(100, level))
+    muteVolume = False
+    volume.set(currentVolume)
+    saveVolume()
+    publishVolume()
+
+# Mute (on True), unmute (on False) or toggle (on None), fading over muteRamp
+def setMute(on=None):
+    global currentVolume
+    global previousVolume
+    global muteVolume
+
+    if on is None:
+        on = not muteVolume
+    if on == muteVolume:
+        return
+    muteVolume = on
+    if muteVolume:
+        previousVolume = currentVolume
+        currentVolume = 0
+    else:
+        currentVolume = previousVolume
+    volume.ramp(currentVolume, muteRamp)
+    saveVolume()
+    publishVolume()
+
+# The volume, or the volume before mute
+def volumeLevel():
+    return previousVolume if muteVolume else currentVolume
+
+def volumeInfo():
+    return {"volume": volumeLevel(), "mute": muteVolume}
+
+def stationInfo(i):
+    s = stationList[i]
+    return {"station": i, "call": s[0], "brief": s[1], "long": s[2], "stream": s[3]}
+
+def nowPlaying():
+    info = stationInfo(cStation) if 0 <= cStation < len(stationList) else {"station": cStation}
+    info["state"] = core.state()
+    info["switching"] = switchTask is not None and not switchTask.done()
+    info["audio"] = core.audioStarted()
+    info["title"] = songTitle()
+    return info
+
+def songTitle():
+    return core.song.get("Title") or titles.title
+
+def publishVolume():
+    if api is not None:
+        api.publish("volume", volumeInfo())
+
+def publishNowPlaying():
+    if api is not None:
+        api.publish("nowplaying", nowPlaying())
+
 def incrementCurrentStation(i):
     global stationList
     global cStation
@@ -206,8 +394,11 @@ def incrementCurrentStation(i):
     if cStation >= last:
         cStation = last-1
 
-def switchStation(station):
-    global stationList
+# Start playing station. A switch still in flight is cancelled, so rapid
+# n and p presses end on the last station pressed
+def requestSwitch(station):
+    global switchTask
+    global cStation
 
     last = len(stationList)
     if station < 0:
@@ -215,69 +406,382 @@ def switchStation(station):
     if station >= last:
         station = last-1
 
-    cmd = 'mpc clear'
-    subprocess.call(cmd, shell=True)
+    print("Station = " + stationList[station][0] + ", " + stationList[station][1])
+    cStation = station
+    saveStation(station)
+
+    if switchTask is not None and not switchTask.done():
+        printMsg("station switch superseded", station=station)
+        stats.count("switches_superseded")
+        switchTask.cancel()
+    if audioTask is not None and not audioTask.done():
+        audioTask.cancel()
+    switchTask = startTask(switchStation(station))
+    publishNowPlaying()
+
+async def switchStation(station):
+    global audioTask
 
+    started = time.time()
+    if startupTask is not None and not startupTask.done():
+        # the mpd queue is still being loaded
+        await asyncio.shield(startupTask)
     stream = stationList[station][3]
-    print("Station = " + stationList[station][0] + ", " + stationList[station][1])
-    cmd = 'mpc insert "' + stream + '"' + limitMPCoutput
-    subprocess.call(cmd, shell=True)
+    url = stream
+    if resolveStreams:
+        url = resolver.lookup(stream)
+        # n or p probably comes next
+        resolver.prefetch([stationList.field(j, 3) for j in (station - 1, station + 1)
+                           if 0 <= j < len(stationList)])
 
-    cmd = "mpc play "  + limitMPCoutput
-    subprocess.call(cmd, shell=True)
+    if queueMode:
+        try:
+            if queuedVersion != resolver.version:
+                await updateQueue(station)
+            await mpdQueue.playAsync(stationList, station, core)
+        except mpdClient.MPDConnectionError:
+            raise
+        except mpdClient.MPDError as ex:
+            # the queue was shortened outside this script, read it from
+            # mpd (the mirror may not have seen the change yet) and load
+            # it again
+            printMsg("Exception in switchStation = [" + str(ex) + "]")
+            await syncQueue(station)
+            await mpdQueue.playAsync(stationList, station)
+    else:
+        # clear, add and play are sent to mpd in one round trip
+        await core.mpd.playStream(url)
+    log.event("switch", time.time() - started, station=station)
+    stats.observe("switch", time.time() - started)
 
-    return
+    audioTask = startTask(waitForAudio(station, url, started))
 
-def writeStreamPlayerTxt():
-    global currentStation
+# mpd does not announce the first audio of a stream, so poll its status
+async def waitForAudio(station, url, started):
+    global switchTask
 
-    # current stream can be null
-    o = subprocess.check_output("mpc current", shell=True)
-    stream = o.decode("utf-8")
-    if stream != "":
-        stream = stream.rstrip()
+    while not (core.audioStarted() and core.currentStream() == url):
+        if time.time() - started > audioTimeout:
+            printMsg("no audio", stream=url, timeout=audioTimeout)
+            stats.count("no_audio")
+            stream = stationList.field(station, 3)
+            if url != stream:
+                # the final url stopped working, go back to the stream
+                resolver.invalidate(stream)
+                switchTask = startTask(switchStation(station))
+            return
+        await asyncio.sleep(audioPoll)
+        await core.refreshStatus()
+    log.event("audio", time.time() - started, stream=url)
+    stats.observe("first_audio", time.time() - started)
+    publishNowPlaying()
 
-    currentStation = stream
+# Another mpd client (or mpd at the end of a stream) changed the song,
+# follow it unless this script is switching stations itself
+def followMpd(subsystem):
+    global cStation
 
-    f = open(currentStationConfig, 'w')
-    f.write(currentStation + "\n")
-    f.write(str(currentVolume) + "\n")
-    f.write(currentPlaylist + "\n")
-    f.close()
+    if subsystem != "player":
+        return
+    if switchTask is not None and not switchTask.done():
+        return
+    if queueMode:
+        pos = core.songPosition()
+        if 0 <= pos < mpdQueue.count and mpdQueue.first + pos < len(stationList):
+            cStation = mpdQueue.first + pos
+            saveStation(cStation)
+    publishNowPlaying()
+
+# Read the titles of whatever mpd plays, also when another program
+# changed the station, when mpd does not have them
+def followTitle(subsystem):
+    if subsystem != "player" or not watchTitles:
+        return
+    if core.state() == "play" and core.currentStream() != "" and not core.song.get("Title"):
+        titles.watch(core.currentStream(), titleWait)
+    else:
+        titles.stop()
 
-def init():
+def titleChanged(url, title):
+    printMsg("title", title=title)
+    publishNowPlaying()
+
+# Run a command in the background, so input is read while it waits on
+# mpd
+def startTask(coroutine):
+    task = asyncio.ensure_future(logFailure(coroutine))
+    pendingTasks.add(task)
+    task.add_done_callback(pendingTasks.discard)
+    # a task cancelled before it ran never started coroutine
+    task.add_done_callback(lambda t: coroutine.close())
+    return task
+
+async def logFailure(coroutine):
+    try:
+        await coroutine
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        printMsg("Exception in background command = [" + str(ex) + "]")
+
+def readStations():
+    st = os.stat(allStationsFile)
+    with stats.timed("load_stations"):
+        stations = stationCatalog.loadStations(allStationsFile)
+    return stations, (st.st_mtime_ns, st.st_size)
+
+# The stations are opened in a thread, so rebuilding the catalog does not
+# hold up mpd events and input. The mpd queue is synced unless sync is
+# False
+async def loadStations(sync=True):
     global stationList
+    global stationIndex
+    global stationsStat
 
-    # on start up initialize the station list
-    stationList = list()
+    loop = asyncio.get_running_loop()
+    stationList, stationsStat = await loop.run_in_executor(None, readStations)
+    stationIndex = None
 
-    # open all stations and fill in the stationList data structure
-    f = open(allStationsFile, 'r')
+    if queueMode and sync:
+        await syncStationQueue()
 
-    print("Loading stations")
-    for line in f:
-        line = line.strip()
-        if line:
-            # line is not blank
-            l = line.split(',') 
-            d = (l[0],l[1],l[2],l[3])
-            stationList.append(d)
+# fresh reads the queue from mpd instead of the mirror, which may not
+# have seen a change made just before. playing is the station playing
+# and its url, found in the mirror when not given
+async def syncStationQueue(fresh=False, playing=None):
+    queued = core.queue if core.connected and not fresh else None
+    if playing is None:
+        playing = playingStation()
+    n = await syncQueue(cStation, queued, playing)
+    printMsg("station queue synced, " + str(n) + " commands")
+
+# The station whose queue entry is playing and the url it plays, None
+# if the song playing is not one of the stations
+def playingStation():
+    if core.state() != "play":
+        return None
+    pos = core.songPosition()
+    i = mpdQueue.first + pos
+    if not (0 <= pos < mpdQueue.count and pos < len(core.queue) and i < len(stationList)):
+        return None
+    url = core.queue[pos]
+    if not resolver.isUrlOf(stationList.field(i, 3), url):
+        return None
+    return i, url
+
+# The queue only counts as synced to the resolver version it was built
+# from, and only once the commands went through: a switch cancelled by a
+# newer one leaves the changes for the next switch. The url playing
+# stays in the queue, its change is taken later
+async def syncQueue(center, queued=None, playing=None):
+    global queuedVersion
+
+    version = resolver.version
+    changes = dict(resolver.changed)
+    n = await mpdQueue.syncAsync(stationList, center, queued, playing)
+    if playing is not None:
+        changes.pop(stationList.field(playing[0], 3), None)
+    resolver.applied(changes)
+    if not resolver.changed:
+        queuedVersion = version
+    return n
+
+# Replace the queue entries whose url changed, but not the song playing
+async def updateQueue(station):
+    global queuedVersion
+
+    version = resolver.version
+    changes = dict(resolver.changed)
+    keep = core.songPosition() if core.state() == "play" else None
+    if keep == mpdQueue.position(station):
+        # played again right after
+        keep = None
+    resolver.applied(await mpdQueue.updateAsync(stationList, core.queue, changes, keep))
+    if not resolver.changed:
+        queuedVersion = version
+
+# Reload the stations and update the mpd queue if all_stations.m3u changed
+async def checkStations():
+    st = os.stat(allStationsFile)
+    if (st.st_mtime_ns, st.st_size) != stationsStat:
+        printMsg("stations changed, reloading " + allStationsFile)
+        old = stationList
+        await loadStations()
+        old.close()
+
+async def watchStations():
+    while True:
+        await asyncio.sleep(stationsCheckInterval)
+        try:
+            await checkStations()
+            resolver.save()
+        except (OSError, mpdClient.MPDError) as ex:
+            printMsg("Exception in watchStations = [" + str(ex) + "]")
+
+def writeStats():
+    if statsFile is None:
+        return
+    try:
+        stats.writePrometheus(statsFile)
+    except OSError as ex:
+        printMsg("Exception in writeStats = [" + str(ex) + "]")
+
+async def writeStatsLoop():
+    while True:
+        await asyncio.sleep(statsInterval)
+        writeStats()
+
+# Ranked (index, score) list of the stations matching t
+def searchStations(t, limit):
+    global stationIndex
+
+    if stationIndex is None:
+        with stats.timed("load_index"):
+            stationIndex = stationSearch.loadIndex(allStationsFile, stationList)
+    with stats.timed("search"):
+        return stationIndex.search(t, limit)
+
+# Read the current titles of the stations (all for None) in the
+# background, unless a scan is running
+def startTitleScan(indices=None):
+    if titleScanner.running():
+        return 0
+    if indices is None:
+        indices = range(len(stationList))
+    streams = [(i, resolver.cached(stationList.field(i, 3))) for i in indices if 0 <= i < len(stationList)]
+    startTask(scanTitles(streams))
+    return len(streams)
+
+async def scanTitles(streams):
+    started = time.time()
+    await titleScanner.start(streams)
+    log.event("title scan", time.time() - started, stations=len(streams), titles=titleScanner.found,
+              failed=titleScanner.failed, kb=titleScanner.bytesRead // 1024, sockets=titleScanner.peakOpen)
+    stats.count("title_scan_bytes", titleScanner.bytesRead)
+    stats.observe("title_scan", time.time() - started)
+
+async def scanTitlesLoop():
+    while True:
+        startTitleScan()
+        await asyncio.sleep(titleScanInterval)
 
-    f.close()
+# Write the state now, it is only saved once a second while it changes
+def writeStreamPlayerTxt():
+    with stats.timed("write_config"):
+        state.flush()
+
+# stop the music on the way out, even if mpd went away
+def stopPlaying():
+    try:
+        mpd.stop()
+        mpd.close()
+    except mpdClient.MPDError as ex:
+        printMsg("Exception in stopPlaying = [" + str(ex) + "]")
+
+# Play the saved stream as soon as mpd answers, before the stations are
+# loaded. Returns the url playing (None if nothing was started) and
+# whether the mpd queue was replaced
+async def resumeEarly():
+    stream = state.get("stream", "")
+    if stream == "" or not core.connected:
+        return None, False
+    url = stream
+    if resolveStreams:
+        url = resolver.lookup(stream)
+    if core.state() == "play" and core.currentStream() == url:
+        # left playing with x, nothing to do
+        printMsg("still playing", stream=url)
+    elif queueMode and url in core.queue:
+        await core.mpd.play(core.queue.index(url))
+    else:
+        # the queue is brought up to date later, without stopping it
+        await core.mpd.playStream(url)
+        return url, True
+    return url, False
+
+# After the menu is up: wait for the audio of the station started early
+# (a switch cancels the wait), then load the mpd queue, and start the
+# saved station if it could not be started early
+async def finishStartup(station, url, replaced, started):
+    global audioTask
+
+    if station is not None and url is not None:
+        audioTask = startTask(waitForAudio(station, url, started))
+        await asyncio.wait([audioTask])
+    if queueMode:
+        playing = None
+        if station is not None and url is not None and core.currentStream() == url:
+            # the stream started early stays, also when the resolver
+            # found a newer url for it meanwhile
+            playing = (station, url)
+        await syncStationQueue(replaced, playing)
+    if station is None:
+        if url is None:
+            await core.mpd.play()
+    elif url is None:
+        requestSwitch(station)
+
+# The steps of start up that do not need each other run at the same
+# time: the stations are opened, mpd connected and the mixer started.
+# The saved station plays before the stations are loaded
+async def init():
+    global cStation
+    global startupTask
+
+    started = time.time()
 
+    # the station to resume comes from the saved state, not from mpd
     readStreamPlayerConfig()
 
+    resolver.onError = lambda stream, ex: printMsg("cannot resolve", stream=stream, error=str(ex))
+    resolver.load()
+
+    # the mixer starts in the background
     print("volume = [" + str(currentVolume) + "]")
-    cmd = "amixer set Digital " + str(currentVolume) + "%"
-    subprocess.call(cmd, shell=True)
+    volume.onError = lambda ex: printMsg("Exception in volume = [" + str(ex) + "]")
+    volume.set(currentVolume)
 
-    if currentStation == "":
-        cmd = "mpc play " + limitMPCoutput
-        subprocess.call(cmd, shell=True)
-    else:
-        switchStation(cStation)
+    # on start up open the compiled station catalog, it is rebuilt from
+    # all_stations.m3u only when that file changed
+    print("Loading stations")
+    stations = asyncio.ensure_future(loadStations(False))
+
+    # follow the mpd state from now on
+    await core.start()
+    core.addListener(followMpd)
+    core.addListener(followTitle)
+    titles.onTitle = titleChanged
+    titles.onError = lambda url, ex: printMsg("cannot read titles", stream=url, error=str(ex) or type(ex).__name__)
+    try:
+        url, replaced = await resumeEarly()
+    except mpdClient.MPDError as ex:
+        printMsg("Exception in resumeEarly = [" + str(ex) + "]")
+        url, replaced = None, True
+
+    await stations
+    i = resumeStation()
+    cStation = 0 if i is None else i
+    log.event("startup", time.time() - started, stations=len(stationList))
+    stats.observe("startup", time.time() - started)
+    startupTask = startTask(finishStartup(i, url, replaced, started))
+    # left playing, mpd will not announce it
+    followTitle("player")
     return
 
+# stdin is read in a thread, so waiting for a command never holds up mpd
+# events, station switches or the station file check
+def startInput(loop, lines):
+    def read():
+        while True:
+            l = sys.stdin.readline()
+            if l == "":
+                # end of input, exit and turn off music like Return
+                loop.call_soon_threadsafe(lines.put_nowait, "")
+                return
+            loop.call_soon_threadsafe(lines.put_nowait, l.rstrip("\n"))
+
+    threading.Thread(target=read, daemon=True).start()
+
 
 def printMenu():
     print (" ")
@@ -293,141 +797,381 @@ def printMenu():
     print ("   -      Decrease volume")
     print ("Station Commands:")
     print ("   C      Current station")
-    print ("   f=s    Find and play the first stream containing the string s")
-    print ("          escape spaces and other character with backslash")
-    print ("   s[=s]  Show all stations or just station descriptions containing the string s")
-    print ("          escape spaces and other character with backslash")
+    print ("   stats  Counters and timings of mpd, switches, audio and mixer")
+    print ("   f=s    Find and play the station best matching the words s")
+    print ("   s[=s]  Show all stations or just the stations matching the words s")
+    print ("          words match call letters and descriptions, any case,")
+    print ("          the start of a word or with a typo")
+    print ("   t[=s]  Show the stations playing a song title with the words s now,")
+    print ("          t alone shows the last scan of the station titles")
     print ("Exit Commands")
     print ("   o      Shut raspberry pi off")
     print ("   x      Exit and leave music playing")
     print (" Return   Press Enter or Return key to exit and turn off music")
 
+# Run one menu command, returns False for the exit commands. Commands
+# that wait on mpd or the mixer are started in the background
+def runCommand(ans):
+    global cStation
+
+    stats.count("commands")
+
+    # command order was by type, but changed to alphabetic because it
+    # is easier to find the command
+    if ans != "" and ans[0] == ">":
+        ans2 = ans[1:]
+        if ans2 != "" and ans[1] == "=":
+            # play station number n
+            s = ans[2:]
+            requestSwitch(int(s))
+        else:
+            # play
+            print("play")
+            startTask(core.mpd.play())
+    elif ans == "!":
+        # pause
+        print("pause")
+        startTask(core.mpd.stop())
+    elif ans == "+":
+        # volume up
+        print ("volume up")
+        stats.count("volume_presses")
+        changeVolume(volumeLevel() + 5)
+    elif ans == "-":
+        # volume down
+        print ("volume down")
+        stats.count("volume_presses")
+        changeVolume(volumeLevel() - 5)
+    elif ans == "C":
+        # Display current station
+        s = stationList[cStation][0]
+        print("Station playing = " + s)
+        s = stationList[cStation][1]
+        print("Description     = " + s)
+        print("mpd state       = " + core.state())
+        if songTitle():
+            print("Now playing     = " + songTitle())
+    elif ans != "" and ans[0] == "f":
+        ans2 = ans[1:]
+        if ans2 != "" and ans[1] == "=":
+            # find and play station description containing string t
+            t = ans[2:]
+            print("find and play station containing " + t)
+            found = searchStations(t, 1)
+            if found:
+                i = found[0][0]
+                s = stationList[i]
+                print (str(i) + ": " + s[0] + ", " + s[1])
+                requestSwitch(i)
+            else:
+                print("no station matches " + t)
+        else:
+            print("f requires a string")
+    elif ans == "m":
+        # mute
+        print ("unmute" if muteVolume else "mute")
+        setMute()
+    elif ans == "n":
+        # next
+        print("next")
+        incrementCurrentStation(1)
+        requestSwitch(int(cStation))
+    elif ans == "o":
+        # shutoff raspberry pi and radio
+        return False
+    elif ans == "p":
+        # previous
+        print("previous")
+        incrementCurrentStation(-1)
+        requestSwitch(int(cStation))
+    elif ans == "stats":
+        # counters and timings since start
+        for l in stats.report():
+            print(l)
+    elif ans != "" and ans[0] == "s":
+        ans2 = ans[1:]
+        if ans2 != "" and ans[1] == "=":
+            # search call letters and descriptions to find string t,
+            # best matches first
+            print ("find and list streams matching a string")
+            t = ans[2:]
+            for i, score in searchStations(t, 50):
+                s = stationList[i]
+                print (str(i) + ": " + s[0] + ", " + s[1])
+        else:
+            # list all stations
+            i = 0
+            for s in stationList:
+                print (str(i) + ": " + s[0] + ", " + s[1])
+                i += 1
+    elif ans != "" and ans[0] == "t":
+        ans2 = ans[1:]
+        if ans2 != "" and ans[1] == "=":
+            # stations playing a title containing the words t
+            t = ans[2:]
+            found = titleScanner.search(t)
+            for i, title in found:
+                if i < len(stationList):
+                    print (str(i) + ": " + stationList[i][0] + ", " + title)
+            if titleScanner.stale():
+                n = startTitleScan()
+                if n:
+                    print("reading the titles of " + str(n) + " stations, try t=" + t + " again in a few seconds")
+                else:
+                    print("still reading the titles, try t=" + t + " again in a few seconds")
+            elif not found:
+                print("no station is playing " + t)
+        else:
+            for l in titleScanner.report():
+                print(l)
+    elif ans == "x":
+        # exit and leave music playing
+        return False
+    elif ans == "":
+        # exit and stop music
+        return False
+    else:
+        print("Unrecognized command: " + ans)
+    return True
+
 #########################
+# Control socket commands, see playerApi.py. Each takes the json request
+# and returns the json result
 
-printMsg("Starting streamPlayer")
-print("If after reboot, mpd loads last station or playlist. Please wait ...")
+def stationArgument(request, name="station"):
+    i = int(request[name])
+    if not 0 <= i < len(stationList):
+        raise playerApi.ApiError("no station " + str(i))
+    return i
 
-try:
+def apiStatus(request):
+    info = nowPlaying()
+    info.update(volumeInfo())
+    info["stations"] = len(stationList)
+    return info
 
-    ans = True
-    init()
+# {"cmd": "play"} plays the current station, {"cmd": "play", "station": n}
+# station n
+def apiPlay(request):
+    if "station" in request:
+        requestSwitch(stationArgument(request))
+    else:
+        startTask(core.mpd.play())
+    return stationInfo(cStation)
+
+def apiStop(request):
+    startTask(core.mpd.stop())
+
+def apiNext(request):
+    incrementCurrentStation(1)
+    requestSwitch(cStation)
+    return stationInfo(cStation)
+
+def apiPrevious(request):
+    incrementCurrentStation(-1)
+    requestSwitch(cStation)
+    return stationInfo(cStation)
 
+def apiFind(request):
+    found = searchStations(str(request["query"]), 1)
+    if not found:
+        raise playerApi.ApiError("no station matches " + str(request["query"]))
+    requestSwitch(found[0][0])
+    return stationInfo(cStation)
+
+def apiSearch(request):
+    limit = int(request.get("limit", 50))
+    return [stationInfo(i) for i, score in searchStations(str(request["query"]), limit)]
+
+def apiStations(request):
+    first = max(0, int(request.get("first", 0)))
+    count = max(0, int(request.get("count", len(stationList))))
+    return [stationInfo(i) for i in range(first, min(first + count, len(stationList)))]
+
+# {"volume": n} sets the volume, {"delta": n} changes it
+def apiVolume(request):
+    if "volume" in request:
+        changeVolume(int(request["volume"]))
+    elif "delta" in request:
+        changeVolume(volumeLevel() + int(request["delta"]))
+    return volumeInfo()
+
+# {"mute": true or false}, without it mute toggles
+def apiMute(request):
+    on = request.get("mute")
+    setMute(None if on is None else bool(on))
+    return volumeInfo()
+
+# {"query": words}, the stations playing a title holding the words
+def apiTitles(request):
+    found = []
+    for i, title in titleScanner.search(str(request.get("query", ""))):
+        if i < len(stationList):
+            info = stationInfo(i)
+            info["title"] = title
+            found.append(info)
+    return {"titles": found, "scanning": titleScanner.running(), "stale": titleScanner.stale()}
+
+# {"stations": [n, ...]} reads the titles of those stations, all without
+def apiTitleScan(request):
+    indices = request.get("stations")
+    if indices is not None:
+        indices = [int(i) for i in indices]
+    return {"stations": startTitleScan(indices), "report": titleScanner.report()}
+
+def apiStats(request):
+    return stats.report()
+
+# Stop the daemon, with {"keepPlaying": true} the music keeps playing
+def apiQuit(request):
+    global ans
+
+    ans = "x" if request.get("keepPlaying") else ""
+    quitEvent.set()
+
+def zoneNames(request):
+    if zones is None:
+        raise playerApi.ApiError("no zones, see " + zonesFile)
+    names = request.get("zones")
+    if isinstance(names, str):
+        names = [names]
+    return names
+
+async def apiZones(request):
+    return await zones.refresh(zoneNames(request))
+
+# {"station": n, "zones": [...], "sync": true} plays station n in the
+# zones named (all without zones), starting them together with sync
+async def apiZonePlay(request):
+    names = zoneNames(request)
+    stream = stationList.field(stationArgument(request), 3)
+    url = resolver.lookup(stream) if resolveStreams else stream
+    if request.get("sync"):
+        return await zones.syncPlay(url, names)
+    return await zones.play(url, names)
+
+async def apiZoneStop(request):
+    return await zones.stop(zoneNames(request))
+
+def apiZoneVolume(request):
+    zones.setVolume(int(request["volume"]), zoneNames(request))
+
+apiCommands = {
+    "status": apiStatus,
+    "play": apiPlay,
+    "stop": apiStop,
+    "next": apiNext,
+    "previous": apiPrevious,
+    "find": apiFind,
+    "search": apiSearch,
+    "stations": apiStations,
+    "volume": apiVolume,
+    "mute": apiMute,
+    "stats": apiStats,
+    "titles": apiTitles,
+    "titlescan": apiTitleScan,
+    "quit": apiQuit,
+    "zones": apiZones,
+    "zoneplay": apiZonePlay,
+    "zonestop": apiZoneStop,
+    "zonevolume": apiZoneVolume,
+}
+
+# Run the menu until an exit command
+async def runMenu():
+    global ans
+
+    lines = asyncio.Queue()
+    startInput(asyncio.get_running_loop(), lines)
     while ans:
         printMenu()
+        print(">", end="", flush=True)
+        ans = await lines.get()
+        if not runCommand(ans):
+            break
 
-        # command order was by type, but changed to alphabetic because it
-        # is easier to find the command
-        ans = input(">")
-        if ans != "" and ans[0] == ">":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # play station number n
-                s = ans[2:]
-                switchStation(int(s))
-            else:
-                # play
-                print("play")
-                cmd = "mpc play" + limitMPCoutput
-                subprocess.call(cmd, shell=True)
-        elif ans == "!":
-            # pause
-            print("pause")
-            cmd = "mpc stop " + limitMPCoutput
-            subprocess.call(cmd, shell=True)
-        elif ans == "+":
-            # volume up
-            print ("volume up")
-            currentVolume +=5
-            if currentVolume > 100:
-                currentVolume = 100
-            cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans == "-":
-            # volume down
-            print ("volume down")
-            currentVolume -=5
-            if currentVolume < 0:
-                currentVolume = 0
-            cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans == "C":
-            # Display current station
-            s = stationList[cStation][0]
-            print("Station playing = " + s)
-            s = stationList[cStation][1]
-            print("Description     = " + s)
-        elif ans != "" and ans[0] == "f":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # find and play station description containing string t
-                t = ans[2:]
-                print("find and play station containing " + t)
-                i = 0
-                for s in stationList:
-                    # if t in s[1]
-                    if t in s[1]:
-                        print (str(i) + ": " + s[0] + ", " + s[1])
-                        switchStation(i)
-                        cStation = i
-                        break
-                    i += 1
-            else:
-                print("f requires a string")
-        elif ans == "m":
-            # mute
-            muteVolume = not muteVolume
-            if muteVolume == True:
-                print ("mute")
-                previousVolume = currentVolume
-                currentVolume = 0
-                cmd = "amixer set Digital " + str(currentVolume) + "%"
-            else:
-                print ("unmute")
-                currentVolume = previousVolume
-                cmd = "amixer set Digital " + str(currentVolume) + "%"
-            subprocess.call(cmd, shell=True)
-        elif ans == "n":
-            # next
-            print("next")
-            incrementCurrentStation(1)
-            switchStation(int(cStation))
-        elif ans == "o":
-            # shutoff raspberry pi and radio
-            sys.exit()
-        elif ans == "p":
-            # previous
-            print("previous")
-            incrementCurrentStation(-1)
-            switchStation(int(cStation))
-        elif ans != "" and ans[0] == "s":
-            ans2 = ans[1:]
-            if ans2 != "" and ans[1] == "=":
-                # search brief description in stationList to find string t
-                print ("find and list streams matching a string (case sensitive)")
-                t = ans[2:]
-                # list all stations
-                i = 0
-                for s in stationList:
-                    # if t in s[1]
-                    if t in s[1]:
-                        print (str(i) + ": " + s[0] + ", " + s[1])
-                    i += 1
-            else:
-                # list all stations
-                i = 0
-                for s in stationList:
-                    print (str(i) + ": " + s[0] + ", " + s[1])
-                    i += 1
-        elif ans == "x":
-            # exit and leave music playing
-            sys.exit()
-        elif ans == "":
-            # exit and stop music
-            sys.exit()
+# Serve the control socket until quit or SIGTERM, SIGTERM stops the music
+async def runDaemon():
+    global api
+    global quitEvent
+    global zones
+
+    quitEvent = asyncio.Event()
+    def terminate():
+        global ans
+        ans = ""
+        quitEvent.set()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, terminate)
+
+    if os.path.exists(zonesFile):
+        zones = playerZones.ZoneController(playerZones.readZones(zonesFile))
+        printMsg("zones", count=len(zones.zones))
+
+    api = playerApi.ApiServer(apiSocket, apiCommands)
+    api.onError = lambda request, ex: printMsg("Exception in api command = [" + str(ex) + "]",
+                                               cmd=request.get("cmd"), error=type(ex).__name__)
+    await api.start()
+    printMsg("control socket open", socket=apiSocket)
+    try:
+        await quitEvent.wait()
+    finally:
+        await api.stop()
+        api = None
+        if zones is not None:
+            await zones.close()
+
+# Input or the control socket, mpd events, station switches and the
+# station file check all run in one event loop, none of them waits for
+# another
+async def main():
+    await init()
+    watcher = asyncio.ensure_future(watchStations())
+    statsWriter = asyncio.ensure_future(writeStatsLoop())
+    titleScans = None
+    if titleScanInterval > 0:
+        titleScans = asyncio.ensure_future(scanTitlesLoop())
+
+    try:
+        if daemonMode:
+            await runDaemon()
         else:
-            print("Unrecognized command: " + ans)
+            await runMenu()
+    finally:
+        watcher.cancel()
+        statsWriter.cancel()
+        titles.stop()
+        titleScanner.stop()
+        if titleScans is not None:
+            titleScans.cancel()
+        if audioTask is not None:
+            audioTask.cancel()
+        # switches and volume changes already asked for are finished
+        if pendingTasks:
+            await asyncio.wait(list(pendingTasks), timeout=mpdClient.defaultTimeout)
+        await volume.close()
+        await core.stop()
+        try:
+            resolver.save()
+        except OSError as ex:
+            printMsg("Exception in resolver save = [" + str(ex) + "]")
+        writeStats()
 
-    sys.exit()
+#########################
+
+parser = argparse.ArgumentParser(description="play internet radio using mpd")
+parser.add_argument("--daemon", action="store_true", help="no menu, take commands on the control socket")
+parser.add_argument("--socket", default=apiSocket, help="control socket for --daemon")
+args = parser.parse_args()
+daemonMode = args.daemon
+apiSocket = args.socket
+
+printMsg("Starting streamPlayer")
+print("If after reboot, mpd loads last station or playlist. Please wait ...")
+
+try:
+
+    ans = True
+    asyncio.run(main())
 
 except KeyboardInterrupt: # trap a CTRL+C keyboard interrupt
     printMsg("keyboard exception occurred")
@@ -440,13 +1184,13 @@ finally:
     writeStreamPlayerTxt()
     if ans == "x":
         printMsg("... Stream still playing")
-        fileLog.close()
+        log.close()
     elif ans == "o":
-        subprocess.call("mpc stop ", shell=True)
+        stopPlaying()
         printMsg("... Shutting down raspberry pi")
-        fileLog.close()
+        log.close()
         subprocess.call("sudo shutdown -h 0", shell=True)
     else:
-        subprocess.call("mpc stop ", shell=True)
-        fileLog.close()
+        stopPlaying()
+        log.close()
 
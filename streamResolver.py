@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# streamResolver.py finds the url the audio of a station really comes
+# from, and remembers it.
+#
+# Many streams in all_stations.m3u and in downloaded m3u files do not
+# play at the url given. The server redirects (often several times, with
+# tokens), or answers with another playlist (.pls or .m3u) holding the
+# next url. mpd walks that chain again on every station change. The
+# resolver walks it once:
+#
+#    redirects   301, 302, 303, 307 and 308 are followed
+#    playlists   an answer with a playlist content type (or a .m3u or
+#                .pls url answered with something that is not audio) is
+#                read and its first stream is followed. HLS playlists
+#                are left to mpd
+#
+# ResolverCache keeps the final url of every stream for ttl seconds,
+# shorter when a redirect or playlist on the way says so with
+# Cache-Control (max-age, no-cache, no-store) or Expires. Final urls
+# often hold a token that runs out, so ttl is well below the hours such
+# tokens last; the headers of the audio itself are not taken, icecast
+# sends no-cache with every stream. lookup never waits: it answers from
+# the cache (or with the stream itself) and resolves in the background
+# when the entry is missing or old. When resolving fails the old entry
+# stays, or the stream itself is used. The cache is saved as json
+# (all_stations.m3u.resolved) so a restart starts with the urls already
+# known, except the ones that ran out meanwhile.
+#
+# version counts the changes of the url a stream plays at (a stream
+# resolved to itself is no change), and changed holds the streams whose
+# url changed since the mpd queue took them, as (url before, url now),
+# so the queue replaces only those entries.
+#
+# The hops of a chain on the same host are not looked up again, the
+# addresses are kept in a checkEngine.DNSCache.
+#
+#########################
+
+import asyncio
+import email.utils
+import json
+import os
+import time
+import urllib.parse
+
+import checkEngine
+
+defaultTtl = 900.0
+# a final url is kept this long even when the headers say less
+minTtl = 60.0
+failureTtl = 300.0
+resolveTimeout = 10.0
+maxHops = 8
+maxPlaylistBytes = 64 * 1024
+# resolutions running at the same time in the background
+backgroundLimit = 4
+
+
+class ResolveError(Exception):
+    pass
+
+
+async def readBody(reader, limit):
+    data = b""
+    while len(data) < limit:
+        b = await reader.read(limit - len(data))
+        if not b:
+            break
+        data += b
+    return data
+
+# Seconds the headers of an answer let it be kept, None if they do not say
+def headerTtl(headers, now=None):
+    for d in headers.get("cache-control", "").lower().split(","):
+        d = d.strip()
+        if d in ("no-cache", "no-store"):
+            return 0.0
+        if d.startswith("max-age="):
+            try:
+                return max(0.0, float(d[len("max-age="):]))
+            except ValueError:
+                return 0.0
+    if "expires" in headers:
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+        except (TypeError, ValueError):
+            # an invalid date is in the past
+            return 0.0
+        return max(0.0, expires - (now or time.time()))
+    return None
+
+def keepFor(headers, ttls):
+    if ttls is not None:
+        ttl = headerTtl(headers)
+        if ttl is not None:
+            ttls.append(ttl)
+
+# Follow redirects and playlists from url to the url that answers with
+# audio, waiting for the first byte of audio with firstByte. ttls, if
+# given, gets what the headers of the redirects and playlists allow (see
+# headerTtl). Raises ResolveError, checkEngine.ProbeError or OSError
+async def resolveChain(url, dns=None, firstByte=False, ttls=None):
+    for hop in range(maxHops):
+        reader, writer = await checkEngine.openStream(url, dns)
+        try:
+            status, headers, reader = await checkEngine.readHead(reader)
+            if status in checkEngine.redirectStatus and "location" in headers:
+                keepFor(headers, ttls)
+                url = urllib.parse.urljoin(url, headers["location"])
+                continue
+            if not 200 <= status < 300:
+                raise ResolveError("HTTP " + str(status) + " from " + url)
+            if checkEngine.isPlaylist(url, headers):
+                text = (await readBody(reader, maxPlaylistBytes)).decode("utf-8", "replace")
+                if checkEngine.hlsMarker in text:
+                    return url
+                nextUrl = checkEngine.playlistStream(text)
+                if nextUrl is None:
+                    raise ResolveError("empty playlist at " + url)
+                keepFor(headers, ttls)
+                url = urllib.parse.urljoin(url, nextUrl)
+                continue
+            if firstByte and not await reader.read(1):
+                raise ResolveError("no audio from " + url)
+            return url
+        finally:
+            checkEngine.closeWriter(writer)
+    raise ResolveError("more than " + str(maxHops) + " hops")
+
+async def resolveUrl(url, dns=None, timeout=resolveTimeout, ttls=None):
+    try:
+        return await asyncio.wait_for(resolveChain(url, dns, False, ttls), timeout)
+    except asyncio.TimeoutError:
+        raise ResolveError("timed out resolving " + url)
+
+def resolvedFileName(stationFile):
+    return stationFile + ".resolved"
+
+
+class ResolverCache:
+
+    def __init__(self, fileName=None, ttl=defaultTtl):
+        self.fileName = fileName
+        self.ttl = ttl
+        self.dns = checkEngine.DNSCache()
+        # stream: [final url, expires (time.time()), resolved (True) or
+        # failed and the stream itself (False)]
+        self.entries = {}
+        self.running = {}
+        self.limit = None
+        self.dirty = False
+        # counts changes of a final url, to notice that the mpd queue
+        # holds an old one. changed is stream: (url before, url now) for
+        # the changes the queue has not taken yet
+        self.version = 0
+        self.changed = {}
+        self.hits = 0
+        self.misses = 0
+        # called with (stream, exception) when a stream cannot be resolved
+        self.onError = None
+
+    def load(self):
+        if self.fileName is None:
+            return
+        try:
+            f = open(self.fileName, 'r')
+            data = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict):
+            now = time.time()
+            for k, v in data.items():
+                if not isinstance(v, list) or len(v) != 3 or not isinstance(v[1], (int, float)) or v[1] <= now:
+                    # ran out while the player was not running
+                    self.dirty = True
+                    continue
+                if v[1] > now + self.ttl:
+                    # kept by a longer ttl
+                    v[1] = now + self.ttl
+                    self.dirty = True
+                self.entries[k] = v
+
+    def save(self):
+        if self.fileName is None or not self.dirty:
+            return
+        tmp = self.fileName + ".tmp"
+        f = open(tmp, 'w')
+        json.dump(self.entries, f)
+        f.close()
+        os.replace(tmp, self.fileName)
+        self.dirty = False
+
+    # Url to give mpd for stream, right away. Resolves in the background
+    # when the cache has nothing or only something old
+    def lookup(self, stream):
+        e = self.entries.get(stream)
+        if e is None or e[1] < time.time():
+            self.refreshLater(stream)
+        if e is None:
+            self.misses += 1
+            return stream
+        self.hits += 1
+        return e[0]
+
+    # The cached url if there is one, without resolving anything
+    def cached(self, stream):
+        e = self.entries.get(stream)
+        if e is None:
+            return stream
+        return e[0]
+
+    def prefetch(self, streams):
+        now = time.time()
+        for s in streams:
+            e = self.entries.get(s)
+            if e is None or e[1] < now:
+                self.refreshLater(s)
+
+    def refreshLater(self, stream):
+        if stream in self.running:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = asyncio.ensure_future(self.refresh(stream))
+        self.running[stream] = task
+        task.add_done_callback(lambda t: self.running.pop(stream, None))
+
+    async def refresh(self, stream):
+        if self.limit is None:
+            self.limit = asyncio.Semaphore(backgroundLimit)
+        ttls = []
+        async with self.limit:
+            try:
+                final = await resolveUrl(stream, self.dns, resolveTimeout, ttls)
+            except (ResolveError, checkEngine.ProbeError, OSError, ValueError) as ex:
+                if self.onError is not None:
+                    self.onError(stream, ex)
+                self.failed(stream)
+                return stream
+        self.store(stream, final, time.time() + max(minTtl, min([self.ttl] + ttls)), True)
+        return final
+
+    # Resolving failed, keep an earlier final url or play stream itself
+    def failed(self, stream):
+        e = self.entries.get(stream)
+        if e is not None and e[2]:
+            e[1] = time.time() + failureTtl
+            self.dirty = True
+        else:
+            self.store(stream, stream, time.time() + failureTtl, False)
+
+    # The final url did not play, go back to stream until it is resolved again
+    def invalidate(self, stream):
+        self.store(stream, stream, time.time() + failureTtl, False)
+
+    def store(self, stream, final, expires, resolved):
+        e = self.entries.get(stream)
+        old = stream if e is None else e[0]
+        if final != old:
+            self.version += 1
+            c = self.changed.get(stream)
+            if c is not None:
+                old = c[0]
+            if final == old:
+                # back to the url the queue holds
+                del self.changed[stream]
+            else:
+                self.changed[stream] = (old, final)
+        self.entries[stream] = [final, expires, resolved]
+        self.dirty = True
+
+    # The queue took the changes (a dict like changed), the ones that
+    # changed again since stay
+    def applied(self, changes):
+        for stream, c in changes.items():
+            if self.changed.get(stream) == c:
+                del self.changed[stream]
+
+    # True if url is, or was until a change the queue has not taken, the
+    # url of stream
+    def isUrlOf(self, stream, url):
+        if url == stream or url == self.cached(stream):
+            return True
+        c = self.changed.get(stream)
+        return c is not None and c[0] == url
+
+    async def wait(self):
+        while self.running:
+            await asyncio.gather(*list(self.running.values()), return_exceptions=True)
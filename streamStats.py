@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# streamStats.py counts what streamPlayer.py and m3uCheck.py do and how
+# long it takes.
+#
+#    count     a counter, for example mpd_errors or probes_good
+#    observe   a duration in seconds, kept in a histogram with fixed
+#              buckets (count, sum, largest and the number in each bucket)
+#    timed     measures a with block and observes it
+#
+# Recording is a dictionary lookup and a bisect, cheap enough to leave on.
+# report gives the lines the stats command of streamPlayer.py prints,
+# percentiles are read from the buckets (the bucket bound at or above
+# them). writePrometheus writes everything in the Prometheus text format
+# for the node_exporter textfile collector, for example:
+#
+#    /var/lib/node_exporter/textfile_collector/streamplayer.prom
+#
+# The file is written to a temporary file and renamed, so node_exporter
+# never reads half of it.
+#
+#########################
+
+import bisect
+import os
+import time
+
+# bucket upper bounds in seconds
+bucketBounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+
+    def __init__(self):
+        # the last bucket counts what is above the largest bound
+        self.counts = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(bucketBounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # The bucket bound at or above the p percentile, max for the last one
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        want = p / 100.0 * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= want and c:
+                if i < len(bucketBounds):
+                    return min(bucketBounds[i], self.max)
+                return self.max
+        return self.max
+
+
+class Stats:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.observe(seconds)
+
+    def timed(self, name):
+        return Timer(self, name)
+
+    # Lines for people, times in milliseconds
+    def report(self):
+        lines = ["up %.0f s" % (time.time() - self.started)]
+        for name in sorted(self.counters):
+            lines.append("%-24s %8d" % (name, self.counters[name]))
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            lines.append("%-24s %8d  mean=%9.3f p50<=%9.3f p95<=%9.3f p99<=%9.3f max=%9.3f ms" %
+                         (name, h.count, h.sum / h.count * 1000.0, h.percentile(50) * 1000.0,
+                          h.percentile(95) * 1000.0, h.percentile(99) * 1000.0, h.max * 1000.0))
+        return lines
+
+    def prometheus(self):
+        p = self.prefix
+        out = []
+        for name in sorted(self.counters):
+            m = p + "_" + name + "_total"
+            out.append("# TYPE " + m + " counter")
+            out.append(m + " " + str(self.counters[name]))
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            m = p + "_" + name + "_seconds"
+            out.append("# TYPE " + m + " histogram")
+            n = 0
+            for bound, c in zip(bucketBounds, h.counts):
+                n += c
+                out.append(m + '_bucket{le="' + repr(bound) + '"} ' + str(n))
+            out.append(m + '_bucket{le="+Inf"} ' + str(h.count))
+            out.append(m + "_sum " + repr(h.sum))
+            out.append(m + "_count " + str(h.count))
+        m = p + "_start_time_seconds"
+        out.append("# TYPE " + m + " gauge")
+        out.append(m + " " + "%.3f" % self.started)
+        return "\n".join(out) + "\n"
+
+    def writePrometheus(self, fileName):
+        tmp = fileName + ".tmp"
+        f = open(tmp, 'w')
+        f.write(self.prometheus())
+        f.close()
+        os.replace(tmp, fileName)
+
+
+class Timer:
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.stats.observe(self.name, time.perf_counter() - self.start)
+        if excType is not None:
+            self.stats.count(self.name + "_errors")
+        return False
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+
+#########################
+#
+# volumeControl.py sets the volume for streamPlayer.py without starting
+# a process for every key press.
+#
+# streamPlayer.py used to run "amixer set Digital N%" through the shell
+# for each +, - and m. Holding a key started dozens of processes and the
+# volume lagged behind. Here one mixer channel is kept open:
+#
+#    AmixerMixer   one "amixer -s" process, commands are written to its
+#                  stdin ("sset Digital N%")
+#    MPDMixer      mpd's setvol over an mpd connection
+#
+# VolumeControl coalesces changes. set only records the new target, the
+# mixer is told the target once the presses stop for debounce seconds
+# (or at least every maxDelay seconds while a key is held), so 50 quick
+# presses become one or two mixer commands. ramp moves the volume to a
+# level in small steps over some seconds, a set or a new ramp cancels a
+# ramp in progress.
+#
+#########################
+
+import asyncio
+import time
+
+defaultDebounce = 0.05
+defaultMaxDelay = 0.2
+rampStep = 0.05
+
+
+class AmixerMixer:
+
+    def __init__(self, control="Digital", command=("amixer", "-s")):
+        self.control = control
+        self.command = command
+        self.process = None
+        self.commands = 0
+
+    async def open(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL)
+
+    async def set(self, level):
+        line = ("sset " + self.control + " " + str(level) + "%\n").encode()
+        # amixer is started again once if it went away
+        for attempt in (1, 2):
+            if self.process is None or self.process.returncode is not None:
+                await self.open()
+            try:
+                self.process.stdin.write(line)
+                await self.process.stdin.drain()
+                self.commands += 1
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                self.process = None
+                if attempt == 2:
+                    raise
+
+    async def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            await asyncio.wait_for(self.process.wait(), 2)
+        except (OSError, asyncio.TimeoutError):
+            self.process.kill()
+        self.process = None
+
+
+# mpd as the mixer, connection is a playerCore.AsyncMPDConnection
+class MPDMixer:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = 0
+
+    async def set(self, level):
+        await self.connection.command("setvol", level)
+        self.commands += 1
+
+    async def close(self):
+        pass
+
+
+class VolumeControl:
+
+    def __init__(self, mixer, debounce=defaultDebounce, maxDelay=defaultMaxDelay):
+        self.mixer = mixer
+        self.debounce = debounce
+        self.maxDelay = maxDelay
+        # level is the volume the mixer was last set to, None if unknown
+        self.target = None
+        self.level = None
+        self.changedAt = 0.0
+        self.pendingSince = None
+        self.task = None
+        self.rampTask = None
+        # called with the exception when the mixer cannot be set
+        self.onError = None
+        # optional streamStats.Stats, mixer commands are observed as mixer_set
+        self.stats = None
+
+    # Ask for level, the mixer is set once the changes stop
+    def set(self, level):
+        if self.rampTask is not None and not self.rampTask.done():
+            self.rampTask.cancel()
+        self.setTarget(level)
+
+    def setTarget(self, level):
+        level = max(0, min(100, int(level)))
+        now = time.monotonic()
+        self.target = level
+        self.changedAt = now
+        if self.pendingSince is None:
+            self.pendingSince = now
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.applyLoop())
+
+    async def applyLoop(self):
+        while self.target != self.level:
+            if self.pendingSince is None:
+                self.pendingSince = self.changedAt
+            now = time.monotonic()
+            quiet = self.changedAt + self.debounce - now
+            held = self.pendingSince + self.maxDelay - now
+            wait = min(quiet, held)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            level = self.target
+            self.pendingSince = None
+            start = time.perf_counter()
+            try:
+                await self.mixer.set(level)
+            except Exception as ex:
+                if self.stats is not None:
+                    self.stats.count("mixer_errors")
+                if self.onError is not None:
+                    self.onError(ex)
+                return
+            if self.stats is not None:
+                self.stats.observe("mixer_set", time.perf_counter() - start)
+            self.level = level
+        self.pendingSince = None
+
+    # Move to level in steps over seconds, from the target asked for last
+    def ramp(self, level, seconds):
+        if self.rampTask is not None and not self.rampTask.done():
+            self.rampTask.cancel()
+        self.rampTask = asyncio.ensure_future(self.rampLoop(level, seconds))
+        return self.rampTask
+
+    async def rampLoop(self, level, seconds):
+        start = self.target if self.target is not None else level
+        steps = max(1, int(seconds / rampStep))
+        for i in range(1, steps + 1):
+            self.setTarget(round(start + (level - start) * i / steps))
+            # a ramp step does not wait for the key presses to stop
+            self.pendingSince = self.changedAt - self.maxDelay
+            if i < steps:
+                await asyncio.sleep(seconds / steps)
+
+    # Wait until the mixer is at the level asked for last
+    async def wait(self):
+        while True:
+            tasks = [t for t in (self.rampTask, self.task) if t is not None and not t.done()]
+            if not tasks:
+                return
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close(self):
+        await self.wait()
+        await self.mixer.close()